@@ -0,0 +1,447 @@
+import asyncpg
+from config import Configurator
+from db import HREFS_ATTEMPT, HREFS_COMPLETE, HREFS_UPSERT, HREFS_VERSION_BUMP
+from expressions import labels, parse
+from responses import Responser
+from statements import numbered
+from yadisk import AsyncAPI
+
+
+class AsyncDatabaser:
+    # rows fetched from a cursor per round trip in streaming mode
+    stream_chunk_size = 1000
+
+    def __init__(self, database):
+        """
+        Client reads of the async serving mode over asyncpg.
+        Queries, response cache, data versioning and writes are shared with the sync Databaser
+        :param database: Databaser
+        """
+        self.database = database
+        self.pool = None
+        self.api = None
+        self.checkout_timeout = None
+        Configurator.subscribe(self.reconfigure)
+
+    def reconfigure(self, config):
+        """
+        Drops Yandex Disk client to rebuild it with the reloaded config on the next refresh
+        :param config: Configurator
+        """
+        self.api = None
+
+    async def start(self):
+        """
+        Opens the connection pool
+        """
+        config = Configurator()
+        pool = config.database_pool()
+        self.checkout_timeout = pool["checkout_timeout"]
+        try:
+            self.pool = await asyncpg.create_pool(min_size=pool["min_connections"],
+                                                  max_size=pool["max_connections"], **config.database_params())
+        except Exception as e:
+            print(e)
+            self.pool = None
+
+    async def close(self):
+        """
+        Closes the connection pool and Yandex Disk client
+        """
+        if self.pool is not None:
+            await self.pool.close()
+        if self.api is not None:
+            await self.api.close()
+
+    async def fetch(self, query, values):
+        """
+        Runs query on a pooled connection through the statement cache of the connection, so asyncpg
+        prepares it once per connection
+        :param query: query with %s placeholders
+        :param values: query values
+        :return: column names (empty when there are no rows) and rows as tuples
+        """
+        async with self.pool.acquire(timeout=self.checkout_timeout) as connection:
+            rows = await connection.fetch(numbered(query), *values)
+            return self.columns(rows), [tuple(row) for row in rows]
+
+    @staticmethod
+    def columns(rows):
+        """
+        Reads column names of fetched records
+        :param rows: asyncpg records
+        :return: column names, empty when there are no rows
+        """
+        return list(rows[0].keys()) if len(rows) > 0 else []
+
+    async def read(self, responser, query, values):
+        """
+        Runs read query, reporting failures through the responser
+        :return: column names and rows, or json error
+        """
+        if self.pool is None:
+            return responser.connection_error()
+        try:
+            return await self.fetch(query, values)
+        except Exception as e:
+            print(e)
+            return responser.communication_error(str(e))
+
+    async def get_photo_by_id(self, photo_id, return_hidden=False, return_incomplete=False, hrefs=False):
+        """
+        Return photo from database by id
+        :return: json with data
+        """
+        responser = Responser()
+        responser.request = {"photo_id": photo_id, "expected": "photo by id"}
+        try:
+            _, query, values = self.database.photo_by_id_query(int(photo_id), return_hidden, return_incomplete, hrefs)
+        except ValueError as e:
+            return responser.communication_error(str(e))
+        result = await self.read(responser, query, values)
+        if isinstance(result, str):
+            return result
+        columns, rows = result
+        if len(rows) == 0:
+            return responser.id_not_found_error()
+        if hrefs:
+            self.database.note_href_reads([rows[0][0]])
+        return responser.json_response(columns, rows[0])
+
+    async def get_photos_by_ids(self, photo_ids, return_hidden=False, return_incomplete=False, hrefs=False):
+        """
+        Returns photos from database by list of ids in one query
+        :return: json with photos mapped by id, null for not found ones
+        """
+        responser = Responser()
+        responser.request = {"photo_ids": photo_ids, "expected": "photos by ids"}
+        _, query, values = self.database.photos_by_ids_query(photo_ids, return_hidden, return_incomplete, hrefs)
+        result = await self.read(responser, query, values)
+        if isinstance(result, str):
+            return result
+        columns, rows = result
+        if hrefs:
+            self.database.note_href_reads([row[0] for row in rows])
+        return responser.map_response(columns, rows, photo_ids)
+
+    async def get_categories_by_photos(self, photo_ids, return_hidden=False):
+        """
+        Returns categories that are assigned with each of specified photos in one query
+        :return: json with lists of categories mapped by photo id
+        """
+        responser = Responser()
+        responser.request = {"photo_ids": photo_ids, "expected": "categories by photos"}
+        categories = None
+        _, query, values = self.database.categories_by_photos_query(photo_ids, return_hidden)
+        if self.database.index_enabled and self.database.index.ready:
+            _, query, values, categories = self.database.indexed_categories_by_photos_query(photo_ids, return_hidden)
+        result = await self.read(responser, query, values)
+        if isinstance(result, str):
+            return result
+        columns, rows = result
+        if categories is not None:
+            columns, rows = self.database.categories_of_photos_rows(categories, columns, rows)
+        return responser.map_response(columns, rows, photo_ids, grouped=True)
+
+    async def get_categories_by_photo(self, photo_id, return_hidden=False):
+        """
+        Returns categories that are assigned with specified photo id
+        :return: json with data and errors
+        """
+        responser = Responser()
+        responser.request = {"photo_id": photo_id, "expected": "categories by photo"}
+        try:
+            _, query, values = self.database.categories_by_photo_query(int(photo_id), return_hidden)
+            if self.database.index_enabled and self.database.index.ready:
+                _, query, values = self.database.indexed_categories_by_photo_query(photo_id, return_hidden)
+        except ValueError as e:
+            return responser.communication_error(str(e))
+        if query is None:
+            return responser.id_not_found_error()
+        result = await self.read(responser, query, values)
+        if isinstance(result, str):
+            return result
+        columns, rows = result
+        if len(rows) == 0:
+            return responser.id_not_found_error()
+        return responser.json_response(columns, rows)
+
+    async def get_category_by_label(self, category_label, return_hidden=False):
+        """
+        Return category from database by label (id or alias)
+        :return: json with data
+        """
+        responser = Responser()
+        responser.request = {"category_label": category_label, "expected": "category by label"}
+        _, query, values = self.database.category_by_label_query(category_label, return_hidden)
+        result = await self.read(responser, query, values)
+        if isinstance(result, str):
+            return result
+        columns, rows = result
+        if len(rows) == 0:
+            return responser.id_not_found_error()
+        return responser.json_response(columns, rows[0])
+
+    async def get_photos_by_category(self, category_label, return_hidden=False, return_incomplete=False,
+                                     stream=False, hrefs=False):
+        """
+        Json-constructed (Responser) array in parent photos
+        :return: json response, async generator of json chunks if streamed successfully
+        """
+        responser = Responser()
+        responser.request = {"category_label": category_label, "expected": "photos by category"}
+        _, query, values = self.database.photos_by_category_query(category_label, return_hidden,
+                                                                  return_incomplete, hrefs)
+        if stream:
+            return await self.stream_query(responser, query, values)
+        if self.database.index_enabled and self.database.index.ready:
+            _, query, values = self.database.indexed_photos_by_category_query(category_label, return_hidden,
+                                                                              return_incomplete, hrefs)
+            if query is None:
+                return responser.id_not_found_error()
+        result = await self.read(responser, query, values)
+        if isinstance(result, str):
+            return result
+        columns, rows = result
+        if len(rows) == 0:
+            return responser.id_not_found_error()
+        if hrefs:
+            self.database.note_href_reads([row[0] for row in rows])
+        return responser.json_response(columns, rows)
+
+    async def get_gallery_index(self, categories=False, return_hidden=False, return_incomplete=False, limit=None,
+                                after=None, stream=False, hrefs=False):
+        """
+        Returns json with all photos or categories that are not hidden, ordered by id
+        :return: json response, with next_cursor if there are more pages;
+        async generator of json chunks if streamed successfully
+        """
+        responser = Responser()
+        if categories:
+            responser.request = {"expected": "categories index"}
+        else:
+            responser.request = {"expected": "photos index"}
+        if limit is not None:
+            responser.request["limit"] = limit
+            responser.request["after"] = after
+        _, query, values, id_column = self.database.gallery_index_query(categories, return_hidden,
+                                                                        return_incomplete, limit, after, hrefs)
+        if stream:
+            return await self.stream_query(responser, query, values, id_column, limit)
+        result = await self.read(responser, query, values)
+        if isinstance(result, str):
+            return result
+        columns, index = result
+        if limit is not None and len(index) > limit:
+            index = index[:limit]
+            responser.next_cursor = index[-1][columns.index(id_column)]
+        if hrefs and not categories:
+            self.database.note_href_reads([row[0] for row in index])
+        return responser.json_response(columns, index)
+
+    async def get_search_results(self, terms, categories=False, return_hidden=False, return_incomplete=False,
+                                 limit=100, after=None, hrefs=False):
+        """
+        Full-text search of photos or categories by name and description, ordered by rank, then by id
+        :return: json response, with "rank:id" next_cursor if there are more pages
+        """
+        responser = Responser()
+        responser.request = {"terms": terms, "expected": "categories search" if categories else "photos search",
+                             "limit": limit, "after": self.database.search_cursor(after)}
+        _, query, values, id_column = self.database.search_query(terms, categories, return_hidden,
+                                                                 return_incomplete, limit, after, hrefs)
+        result = await self.read(responser, query, values)
+        if isinstance(result, str):
+            return result
+        columns, data = result
+        if len(data) > limit:
+            data = data[:limit]
+            responser.next_cursor = self.database.search_cursor((data[-1][columns.index("rank")],
+                                                                 data[-1][columns.index(id_column)]))
+        if hrefs and not categories:
+            self.database.note_href_reads([row[0] for row in data])
+        return responser.json_response(columns, data)
+
+    async def get_timeline(self, date_from=None, date_to=None, return_hidden=False, return_incomplete=False,
+                           limit=None, after=None, hrefs=False):
+        """
+        Returns photos taken within a date range, ordered by date taken, then by id
+        :return: json response, with "date:id" next_cursor if there are more pages
+        """
+        responser = Responser()
+        responser.request = {"expected": "photos timeline", "from": self.database.timeline_date(date_from),
+                             "to": self.database.timeline_date(date_to)}
+        if limit is not None:
+            responser.request["limit"] = limit
+            responser.request["after"] = self.database.timeline_cursor(after)
+        _, query, values = self.database.timeline_query(date_from, date_to, return_hidden, return_incomplete, limit,
+                                                        after, hrefs)
+        result = await self.read(responser, query, values)
+        if isinstance(result, str):
+            return result
+        columns, data = result
+        if limit is not None and len(data) > limit:
+            data = data[:limit]
+            responser.next_cursor = self.database.timeline_cursor((data[-1][columns.index("date_taken")],
+                                                                   data[-1][columns.index("photo_id")]))
+        if hrefs:
+            self.database.note_href_reads([row[0] for row in data])
+        return responser.json_response(columns, data)
+
+    async def get_timeline_counts(self, group, date_from=None, date_to=None, return_hidden=False,
+                                  return_incomplete=False):
+        """
+        Returns numbers of photos taken per year, month or day within a date range
+        :return: json response, periods in chronological order with their counts
+        """
+        responser = Responser()
+        responser.request = {"expected": "timeline counts", "group": group,
+                             "from": self.database.timeline_date(date_from),
+                             "to": self.database.timeline_date(date_to)}
+        _, query, values = self.database.timeline_counts_query(group, date_from, date_to, return_hidden,
+                                                               return_incomplete)
+        result = await self.read(responser, query, values)
+        if isinstance(result, str):
+            return result
+        columns, data = result
+        return responser.json_response(columns, data)
+
+    async def get_photos_by_filter(self, expression, return_hidden=False, return_incomplete=False, limit=None,
+                                   after=None, hrefs=False):
+        """
+        Returns photos matching boolean expression over category labels, ordered by id
+        :return: json response, with next_cursor if there are more pages
+        """
+        responser = Responser()
+        responser.request = {"expression": expression, "expected": "photos by filter"}
+        if limit is not None:
+            responser.request["limit"] = limit
+            responser.request["after"] = after
+        tree = parse(expression)
+        _, query, values = self.database.category_ids_query(labels(tree))
+        result = await self.read(responser, query, values)
+        if isinstance(result, str):
+            return result
+        category_ids, errors = self.database.label_ids(labels(tree), result[1])
+        columns = []
+        data = []
+        for condition, condition_values in self.database.filter_plan(tree, category_ids, after, limit):
+            result = await self.read(responser, *self.database.photos_filter_query(
+                condition, condition_values, return_hidden, return_incomplete, limit, after, hrefs))
+            if isinstance(result, str):
+                return result
+            columns, rows = result
+            data += rows
+            if limit is not None and len(data) > limit:
+                break
+        responser.errors = errors
+        if limit is not None and len(data) > limit:
+            data = data[:limit]
+            responser.next_cursor = data[-1][0]
+        if hrefs:
+            self.database.note_href_reads([row[0] for row in data])
+        return responser.json_response(columns, data)
+
+    async def stream_query(self, responser, query, values, id_column=None, limit=None):
+        """
+        Streams rows of query through the responser. The stream acquires its own connection when it is started
+        and releases it when it is exhausted or closed, a stream that is closed before it is started holds
+        no connection. Errors are reported in the tail of the stream
+        :param responser: responser of the calling method
+        :param query: select query
+        :param values: query values
+        :param id_column: optional - keyset column for next_cursor
+        :param limit: optional - page size; the query is expected to select one extra row
+        :return: async generator of json chunks, or json error if there is no connection pool
+        """
+        if self.pool is None:
+            return responser.connection_error()
+        return self.stream_chunks(responser, query, values, id_column, limit)
+
+    async def stream_chunks(self, responser, query, values, id_column, limit):
+        """
+        Yields json parts of rows fetched in chunks from a cursor, then closes the transaction
+        and releases the connection
+        :return: async generator of json prepared response parts
+        """
+        yield responser.stream_head()
+        try:
+            connection = await self.pool.acquire(timeout=self.checkout_timeout)
+        except Exception as e:
+            print(e)
+            responser.errors += [{"error_id": -3, "error_description": "database connection issue",
+                                  "raw_error": str(e)}]
+            yield responser.stream_tail()
+            return
+        transaction = connection.transaction()
+        first = True
+        sent = 0
+        last_row = None
+        try:
+            await transaction.start()
+            cursor = await connection.cursor(numbered(query), *values)
+            rows = await cursor.fetch(self.stream_chunk_size)
+            columns = self.columns(rows)
+            while len(rows) > 0:
+                if limit is not None and sent + len(rows) > limit:
+                    # the extra row only marks that there is a next page
+                    rows = rows[:limit - sent]
+                    if len(rows) > 0:
+                        last_row = rows[-1]
+                        yield responser.stream_part(columns, rows, first)
+                    responser.next_cursor = last_row[columns.index(id_column)]
+                    break
+                sent += len(rows)
+                last_row = rows[-1]
+                yield responser.stream_part(columns, rows, first)
+                first = False
+                rows = await cursor.fetch(self.stream_chunk_size)
+        except Exception as e:
+            print(e)
+            responser.errors += [{"error_id": -2, "error_description": "database communication issue",
+                                  "raw_error": str(e)}]
+        finally:
+            await self.release(connection, transaction)
+        yield responser.stream_tail()
+
+    async def release(self, connection, transaction):
+        """
+        Rolls back read transaction and returns its connection to the pool
+        """
+        try:
+            await transaction.rollback()
+        except Exception as e:
+            print(e)
+        await self.pool.release(connection)
+
+    async def refresh_expiring_hrefs(self, batch_size):
+        """
+        Refreshes a batch of hrefs that are close to expiry, the most read ones first
+        :param batch_size: maximum number of photos to refresh
+        :return: ids of refreshed photos
+        """
+        if self.pool is None:
+            return []
+        _, rows = await self.fetch(*self.database.expiring_hrefs_query(batch_size))
+        if len(rows) == 0:
+            return []
+        chosen = self.database.popular_hrefs([row[0] for row in rows], batch_size)
+        async with self.pool.acquire(timeout=self.checkout_timeout) as connection:
+            await connection.execute(numbered(HREFS_ATTEMPT), chosen)
+        if self.api is None:
+            self.api = AsyncAPI()
+        batch = []
+        async for photo_id, hrefs, error in self.api.fetch_hrefs(chosen):
+            if error is not None:
+                print(error)
+            elif "" not in (hrefs["preview"], hrefs["medium"], hrefs["large"]):
+                batch += [(photo_id, hrefs["preview"], hrefs["medium"], hrefs["large"])]
+        if len(batch) == 0:
+            return []
+        async with self.pool.acquire(timeout=self.checkout_timeout) as connection:
+            async with connection.transaction():
+                await connection.executemany(HREFS_UPSERT.format("($1, $2, $3, $4, now())"), batch)
+                await connection.execute(numbered(HREFS_COMPLETE), [row[0] for row in batch])
+                versions = await connection.fetchrow(HREFS_VERSION_BUMP)
+        self.database.hrefs_changed(tuple(versions))
+        return [row[0] for row in batch]
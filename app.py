@@ -1,16 +1,211 @@
 # -*- coding: utf-8 -*-
+import datetime
+import math
+import re
+import time
 from flask import Flask
+from flask import Response
+from flask import g
+from flask import make_response
 from flask import request
-from db import Databaser
+from db import Databaser, Versioner
+from exporter import Exporter
+from expressions import labels, parse
 from responses import Responser
 from auth import Authorizer
 from config import Configurator
+from config import Watcher
+from membership import Rebuilder
+from metrics import measurer
+from refresher import Refresher
 
 responser = Responser()
 database = Databaser()
 authorizer = Authorizer()
 app = Flask(__name__)
 
+refresher = Refresher(database)
+if Configurator().hrefs_refresh()["enabled"]:
+    refresher.start()
+
+rebuilder = Rebuilder(database)
+if Configurator().membership_index()["enabled"]:
+    rebuilder.start()
+
+versioner = Versioner(database)
+versioner.start()
+
+exporter = None
+if Configurator().static_export()["enabled"]:
+    exporter = Exporter(database)
+    exporter.start()
+
+watcher = Watcher(Configurator().reload_interval())
+if watcher.interval > 0:
+    watcher.start()
+
+measurer.enable(Configurator().metrics()["enabled"])
+REQUEST_SECONDS = measurer.histogram("gallery_request_seconds",
+                                     "Request latency by route, task and status; time to first byte for streams",
+                                     ["route", "task", "subject", "status"])
+measurer.collector("gallery_cache", "Response cache metrics", "gauge", database.cache.stats)
+measurer.collector("gallery_pool", "Database connection pool metrics", "gauge",
+                   lambda: database.pool.stats() if database.pool is not None else {})
+
+# label values of request latency, other values are labelled "other" to keep the number of series bounded
+CLIENT_TASKS = frozenset(("photo", "photos", "category", "photos_of_category", "categories_of_photo",
+                          "categories_of_photos", "index", "categories_index", "filter", "search", "timeline"))
+MASTER_TASKS = frozenset(("insert", "import", "modify", "get", "index", "add", "replace", "delete"))
+MASTER_SUBJECTS = frozenset(("photo", "category", "relation", "config"))
+
+MAX_PAGE_SIZE = 1000
+SEARCH_PAGE_SIZE = 100
+MAX_SEARCH_TERMS = 8
+
+
+def pagination(source):
+    """
+    Parses keyset pagination arguments
+    :param source: request args or form
+    :return: limit and after cursor, both None if pagination is not requested
+    :raise ValueError: if arguments are not positive integers or limit is too big
+    """
+    _limit = source.get("limit", default=None)
+    _after = source.get("after", default=None)
+    if _limit is not None:
+        _limit = int(_limit)
+        if not 0 < _limit <= MAX_PAGE_SIZE:
+            raise ValueError("limit out of range")
+    if _after is not None:
+        _after = int(_after)
+    return _limit, _after
+
+
+def id_list(source):
+    """
+    Parses list of ids given as repeated or comma separated ids argument
+    :param source: request args or form
+    :return: list of unique ids in requested order
+    :raise ValueError: if ids are not integers, missing or there are too many of them
+    """
+    ids = []
+    for value in source.getlist("ids"):
+        ids += [int(unit_id) for unit_id in value.split(",") if unit_id.strip() != ""]
+    ids = list(dict.fromkeys(ids))
+    if not 0 < len(ids) <= MAX_PAGE_SIZE:
+        raise ValueError("ids count out of range")
+    return ids
+
+
+def search_request(source):
+    """
+    Parses full-text search arguments
+    :param source: request args
+    :return: search terms, page size and (rank, id) cursor or None
+    :raise ValueError: if there are no terms or too many of them, or pagination arguments are malformed
+    """
+    terms = re.findall(r"[^\W_]+", source.get("q", default="").lower())
+    if not 0 < len(terms) <= MAX_SEARCH_TERMS:
+        raise ValueError("terms count out of range")
+    _limit = int(source.get("limit", default=SEARCH_PAGE_SIZE))
+    if not 0 < _limit <= MAX_PAGE_SIZE:
+        raise ValueError("limit out of range")
+    _after = source.get("after", default=None)
+    if _after is not None:
+        rank, unit_id = _after.rsplit(":", 1)
+        _after = (float(rank), int(unit_id))
+        if not math.isfinite(_after[0]):
+            raise ValueError("rank out of range")
+    return terms, _limit, _after
+
+
+def timeline_request(source):
+    """
+    Parses timeline arguments, dates are iso formatted dates or timestamps
+    :param source: request args
+    :return: from and to datetimes or None, page size and (date taken, id) cursor or None
+    :raise ValueError: if dates or pagination arguments are malformed
+    """
+    _from = source.get("from", default=None)
+    _to = source.get("to", default=None)
+    if _from is not None:
+        _from = datetime.datetime.fromisoformat(_from)
+    if _to is not None:
+        _to = datetime.datetime.fromisoformat(_to)
+    _limit = source.get("limit", default=None)
+    if _limit is not None:
+        _limit = int(_limit)
+        if not 0 < _limit <= MAX_PAGE_SIZE:
+            raise ValueError("limit out of range")
+    _after = source.get("after", default=None)
+    if _after is not None:
+        date_taken, unit_id = _after.rsplit(":", 1)
+        _after = (datetime.datetime.fromisoformat(date_taken), int(unit_id))
+    return _from, _to, _limit, _after
+
+
+def label_tag(label):
+    """
+    Normalizes category label (id or alias) for cache tags
+    :param label: category label
+    :return: id without leading zeros or alias as is
+    """
+    try:
+        return str(int(label))
+    except ValueError:
+        return label
+
+
+def respond(result):
+    """
+    Wraps streamed database result into a streaming json response
+    :param result: json string or generator of json parts
+    :return: flask response
+    """
+    if isinstance(result, str):
+        return result
+    return Response(result, mimetype="application/json")
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def observe_latency(response):
+    if "started" in g:
+        args = request.view_args or {}
+        task, subject = latency_labels(str(request.endpoint), args.get("task"), args.get("subject"),
+                                       response.status_code)
+        REQUEST_SECONDS.observe(time.perf_counter() - g.started, str(request.endpoint), task, subject,
+                                str(response.status_code))
+    return response
+
+
+def latency_labels(endpoint, task, subject, status):
+    """
+    Task and subject labels of request latency, shared by the sync and async serving modes. Requests that failed
+    authorization or named an unknown task are labelled "other", as well as any value that is not a known one
+    :param endpoint: endpoint name
+    :param task: task of the url, None if the route has no task
+    :param subject: subject of the url, None if the route has no subject
+    :param status: response status
+    :return: task and subject labels
+    """
+    known = status not in (401, 404)
+    tasks = CLIENT_TASKS if endpoint.startswith("serve_client") else MASTER_TASKS
+    task = "" if task is None else task if known and task in tasks else "other"
+    subject = "" if subject is None else subject if known and subject in MASTER_SUBJECTS else "other"
+    return task, subject
+
+
+@app.route('/metrics', methods=['GET'])
+def serve_metrics():
+    if not measurer.enabled:
+        return not_found("")
+    return Response(measurer.exposition(), mimetype="text/plain; version=0.0.4")
+
 
 # Master requests
 @app.route('/master/<task>/<subject>', methods=['POST'])
@@ -43,6 +238,10 @@ def serve_master(task, subject, infra_subject=None):
                         _name = request.form.get('name', default=None)
                         return database.modify_photo(_id, _name, _description, _timestamp, _hidden)
 
+                # insert photos in bulk from json lines or csv body
+                elif task == "import":
+                    return database.import_photos(request.stream, request.mimetype == "text/csv")
+
                 # get photo by id
                 elif task == "get":
                     try:
@@ -51,13 +250,22 @@ def serve_master(task, subject, infra_subject=None):
                         return bad_request("")
                     _hidden = bool(request.form.get('include_hidden', default=False))
                     _incomplete = bool(request.form.get('include_incomplete', default=False))
-                    return database.get_photo_by_id(_id, _hidden, _incomplete)
+                    _hrefs = bool(request.form.get('hrefs', default=False))
+                    return database.get_photo_by_id(_id, _hidden, _incomplete, hrefs=_hrefs)
 
                 # get photos index
                 elif task == "index":
                     _hidden = bool(request.form.get('include_hidden', default=False))
                     _incomplete = bool(request.form.get('include_incomplete', default=False))
-                    return database.get_gallery_index(return_hidden=_hidden, return_incomplete=_incomplete)
+                    _stream = bool(request.form.get('stream', default=False))
+                    _hrefs = bool(request.form.get('hrefs', default=False))
+                    try:
+                        _limit, _after = pagination(request.form)
+                    except ValueError:
+                        return bad_request("")
+                    return respond(database.get_gallery_index(return_hidden=_hidden, return_incomplete=_incomplete,
+                                                              limit=_limit, after=_after, stream=_stream,
+                                                              hrefs=_hrefs))
 
             elif subject == "category":
                 if task in ("insert", "modify"):
@@ -95,7 +303,12 @@ def serve_master(task, subject, infra_subject=None):
                 # get categories index
                 elif task == "index":
                     _hidden = bool(request.form.get('include_hidden', default=False))
-                    return database.get_gallery_index(categories=True, return_hidden=_hidden)
+                    try:
+                        _limit, _after = pagination(request.form)
+                    except ValueError:
+                        return bad_request("")
+                    return database.get_gallery_index(categories=True, return_hidden=_hidden, limit=_limit,
+                                                      after=_after)
 
             # work with relations between categories and photos
             elif subject == "relation":
@@ -123,7 +336,10 @@ def serve_master(task, subject, infra_subject=None):
                     elif task == "delete":
                         return database.delete_category_to_photos(_category_id)
                     elif task == "get":
-                        return database.get_photos_by_category(_category_id, _hidden)
+                        _stream = bool(request.form.get('stream', default=False))
+                        _hrefs = bool(request.form.get('hrefs', default=False))
+                        return respond(database.get_photos_by_category(_category_id, _hidden, stream=_stream,
+                                                                       hrefs=_hrefs))
 
             # modify yandex api configuration
             elif subject == "config":
@@ -142,31 +358,154 @@ def serve_master(task, subject, infra_subject=None):
 # Client requests
 @app.route('/client/<task>', methods=['GET'])
 def serve_client(task):
-    _id = request.args.get('id', None)
-    _label = request.args.get('label', None)
-    if task == "photo":
+    _hrefs = bool(request.args.get('hrefs', default=False))
+    _stream = bool(request.args.get('stream', default=False))
+    try:
+        method, kwargs, _tags = client_request(task, request.args, _hrefs, _stream)
+    except ValueError:
+        return bad_request("")
+    except KeyError:
+        return not_found("")
+
+    # answer conditional requests by the gallery data version only
+    _etag, _modified = database.data_version(_hrefs)
+    if is_not_modified(request.if_none_match, request.if_modified_since, _etag, _modified):
+        return not_modified(_etag, _modified)
+
+    # streamed responses are not cached
+    if not _stream:
+        _key = cache_key(task, request.args)
+        cached, _since = database.cache.get(_key)
+        if cached is not None:
+            return versioned(cached, _etag, _modified)
+
+    response = getattr(database, method)(**kwargs)
+
+    if not _stream and Responser.is_successful(response):
+        database.cache.put(_key, response, _tags, _since)
+    return versioned(respond(response), _etag, _modified)
+
+
+def client_request(task, args, hrefs, stream):
+    """
+    Parses client request into a read call, shared by the sync and async serving modes
+    :param task: client task
+    :param args: request args
+    :param hrefs: if hrefs are requested
+    :param stream: if the response should be streamed
+    :return: name of the read method of Databaser and AsyncDatabaser, its keyword arguments
+    and tags of data a successful response depends on, for cache invalidation
+    :raise ValueError: if required arguments are missing or malformed
+    :raise KeyError: if the task is unknown
+    """
+    _id = args.get('id', None)
+    _label = args.get('label', None)
+    if task in ("photo", "categories_of_photo"):
         if _id is None:
-            return bad_request("")
-        return database.get_photo_by_id(_id)
-    elif task == "category":
-        if _label is None:
-            return bad_request("")
-        return database.get_category_by_label(_label)
-    elif task == "photos_of_category":
+            raise ValueError("id is required")
+        if task == "photo":
+            call = ("get_photo_by_id", {"photo_id": _id, "hrefs": hrefs}, ["photo:{}".format(label_tag(_id))])
+        else:
+            call = ("get_categories_by_photo", {"photo_id": _id}, ["categories_of_photo:{}".format(label_tag(_id))])
+    elif task in ("photos", "categories_of_photos"):
+        _ids = id_list(args)
+        if task == "photos":
+            call = ("get_photos_by_ids", {"photo_ids": _ids, "hrefs": hrefs},
+                    ["photo:{}".format(unit_id) for unit_id in _ids])
+        else:
+            call = ("get_categories_by_photos", {"photo_ids": _ids},
+                    ["categories_of_photo:{}".format(unit_id) for unit_id in _ids])
+    elif task in ("category", "photos_of_category"):
         if _label is None:
-            return bad_request("")
-        _id = database.get_category_id_by_label(_label)
-        return database.get_photos_by_category(_id)
-    elif task == "categories_of_photo":
-        if _id is None:
-            return bad_request("")
-        return database.get_categories_by_photo(_id)
-    elif task == "index":
-        return database.get_gallery_index()
-    elif task == "categories_index":
-        return database.get_gallery_index(categories=True)
+            raise ValueError("label is required")
+        if task == "category":
+            call = ("get_category_by_label", {"category_label": _label}, [])
+        else:
+            call = ("get_photos_by_category", {"category_label": _label, "stream": stream, "hrefs": hrefs}, [])
+        call[2].append("{}:{}".format(task, label_tag(_label)))
+    elif task in ("index", "categories_index"):
+        _limit, _after = pagination(args)
+        call = ("get_gallery_index", {"categories": task == "categories_index", "limit": _limit, "after": _after,
+                                      "stream": stream, "hrefs": hrefs},
+                ["photos_index" if task == "index" else "categories_index"])
+    elif task == "search":
+        _terms, _limit, _after = search_request(args)
+        _categories = bool(args.get('categories', default=False))
+        call = ("get_search_results", {"terms": _terms, "categories": _categories, "limit": _limit, "after": _after,
+                                       "hrefs": hrefs},
+                ["categories_index" if _categories else "photos_index"])
+    elif task == "timeline":
+        _from, _to, _limit, _after = timeline_request(args)
+        _group = args.get('group', None)
+        if _group is None:
+            call = ("get_timeline", {"date_from": _from, "date_to": _to, "limit": _limit, "after": _after,
+                                     "hrefs": hrefs}, ["photos_index"])
+        elif _group in Databaser.timeline_groups:
+            call = ("get_timeline_counts", {"group": _group, "date_from": _from, "date_to": _to}, ["photos_index"])
+        else:
+            raise ValueError("unknown timeline group")
+    elif task == "filter":
+        _expression = args.get('expression', None)
+        _limit, _after = pagination(args)
+        call = ("get_photos_by_filter", {"expression": _expression, "limit": _limit, "after": _after, "hrefs": hrefs},
+                ["photos_index"] + ["photos_of_category:{}".format(label_tag(label))
+                                    for label in labels(parse(_expression))])
     else:
-        return not_found("")
+        raise KeyError(task)
+    if hrefs:
+        call[2].append("hrefs")
+    return call
+
+
+def cache_key(task, args):
+    """
+    Key of client response in the response cache
+    :param task: client task
+    :param args: request args
+    :return: hashable key
+    """
+    return task, tuple(sorted(args.items(multi=True)))
+
+
+def is_not_modified(if_none_match, if_modified_since, etag, modified):
+    """
+    Checks conditional request validators against the gallery data version
+    :param if_none_match: parsed If-None-Match entity tags
+    :param if_modified_since: parsed If-Modified-Since time or None
+    :param etag: gallery data entity tag, None if the version is unknown
+    :param modified: gallery data modification time
+    :return: if the client copy is up to date
+    """
+    if etag is None:
+        return False
+    if if_none_match:
+        return if_none_match.contains(etag)
+    return if_modified_since is not None and modified <= if_modified_since
+
+
+def versioned(response, etag, modified):
+    """
+    Sets validators of the gallery data version on a client response
+    :param response: json string or flask response
+    :param etag: gallery data entity tag
+    :param modified: gallery data modification time
+    :return: flask response
+    """
+    response = make_response(response)
+    if etag is not None:
+        response.set_etag(etag)
+        response.last_modified = modified
+    return response
+
+
+def not_modified(etag, modified):
+    """
+    Empty response for a conditional request of unchanged data
+    :param etag: gallery data entity tag
+    :param modified: gallery data modification time
+    :return: flask response with 304 status
+    """
+    return versioned(Response(status=304), etag, modified)
 
 
 @app.errorhandler(400)
@@ -185,7 +524,7 @@ def not_found(e):
 
 
 @app.errorhandler(405)
-def not_found(e):
+def method_not_allowed(e):
     return responser.unallowed_method(), 405
 
 
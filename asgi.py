@@ -0,0 +1,200 @@
+"""
+Async serving mode: the same api on an ASGI stack, e.g. uvicorn asgi:app
+
+Client reads run on the event loop over asyncpg, so slow queries do not hold a worker.
+Master requests and /metrics are handed to the sync flask app in worker threads.
+"""
+import asyncio
+import io
+import sys
+import time
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import http_date, parse_date, parse_etags, quote_etag
+
+import app as sync
+from aiodb import AsyncDatabaser
+from config import Configurator
+from responses import Responser
+
+database = AsyncDatabaser(sync.database)
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    elif scope["type"] == "http":
+        parts = scope["path"].strip("/").split("/")
+        if scope["method"] == "GET" and len(parts) == 2 and parts[0] == "client":
+            await serve_client(parts[1], scope, receive, send)
+        else:
+            await serve_sync(scope, receive, send)
+
+
+async def lifespan(receive, send):
+    refresh_task = None
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await database.start()
+            if Configurator().hrefs_refresh()["enabled"]:
+                # hrefs are refreshed on the event loop instead of the refresher thread
+                sync.refresher.stop()
+                refresh_task = asyncio.create_task(refresh_hrefs())
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if refresh_task is not None:
+                refresh_task.cancel()
+            await database.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def refresh_hrefs():
+    while True:
+        refresh = Configurator().hrefs_refresh()
+        await asyncio.sleep(refresh["interval"])
+        try:
+            await database.refresh_expiring_hrefs(refresh["batch_size"])
+        except Exception as e:
+            print(e)
+
+
+async def serve_client(task, scope, receive, send):
+    started = time.perf_counter()
+    args = MultiDict(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True))
+    headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+    _hrefs = bool(args.get('hrefs', default=False))
+    _stream = bool(args.get('stream', default=False))
+    status = None
+    response = None
+    try:
+        method, kwargs, _tags = sync.client_request(task, args, _hrefs, _stream)
+    except ValueError:
+        status, response = 400, Responser().bad_request()
+    except KeyError:
+        status, response = 404, Responser().not_found()
+
+    # answer conditional requests by the gallery data version only
+    _etag, _modified = sync.database.data_version(_hrefs)
+    if status is None and sync.is_not_modified(parse_etags(headers.get("if-none-match")),
+                                               parse_date(headers.get("if-modified-since")), _etag, _modified):
+        status = 304
+
+    # streamed responses are not cached
+    if status is None and not _stream:
+        _key = sync.cache_key(task, args)
+        response, _since = sync.database.cache.get(_key)
+        if response is not None:
+            status = 200
+
+    if status is None:
+        status = 200
+        response = await getattr(database, method)(**kwargs)
+        if not _stream and Responser.is_successful(response):
+            sync.database.cache.put(_key, response, _tags, _since)
+
+    if status in (200, 304):
+        status = await respond(send, status, response, _etag, _modified, receive)
+    else:
+        status = await respond(send, status, response)
+    sync.REQUEST_SECONDS.observe(time.perf_counter() - started, "serve_client_async",
+                                 *sync.latency_labels("serve_client_async", task, None, status), str(status))
+
+
+async def respond(send, status, response, etag=None, modified=None, receive=None):
+    """
+    Sends json string or async generator of json parts with the content types of the sync mode
+    :param receive: optional - receive channel of the request, streams are cancelled when the client disconnects
+    :return: response status
+    """
+    headers = []
+    if etag is not None:
+        headers += [(b"etag", quote_etag(etag).encode()), (b"last-modified", http_date(modified).encode())]
+    if response is None:
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": b""})
+    elif isinstance(response, str):
+        headers += [(b"content-type", b"text/html; charset=utf-8")]
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": response.encode()})
+    else:
+        headers += [(b"content-type", b"application/json")]
+
+        async def stream():
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+            async for part in response:
+                await send({"type": "http.response.body", "body": part.encode(), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+
+        # a send to a disconnected client may wait for the write buffer to drain forever
+        sending = asyncio.ensure_future(stream())
+        watching = asyncio.ensure_future(disconnected(receive)) if receive is not None else None
+        try:
+            await asyncio.wait([task for task in (sending, watching) if task is not None],
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (sending, watching):
+                if task is not None:
+                    task.cancel()
+            await asyncio.gather(sending, return_exceptions=True)
+            # releases the connection of a stream that was cancelled before it was started
+            await response.aclose()
+    return status
+
+
+async def disconnected(receive):
+    """
+    Waits until the client disconnects
+    :param receive: receive channel of the request
+    """
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def serve_sync(scope, receive, send):
+    """
+    Serves request with the sync flask app in a worker thread
+    """
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            break
+    server = scope.get("server") or ("localhost", 80)
+    environ = {"REQUEST_METHOD": scope["method"], "SCRIPT_NAME": scope.get("root_path", ""),
+               "PATH_INFO": scope["path"], "QUERY_STRING": scope["query_string"].decode("latin-1"),
+               "SERVER_NAME": server[0], "SERVER_PORT": str(server[1]),
+               "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"), "CONTENT_LENGTH": str(len(body)),
+               "wsgi.version": (1, 0), "wsgi.url_scheme": scope.get("scheme", "http"), "wsgi.input": io.BytesIO(body),
+               "wsgi.errors": sys.stderr, "wsgi.multithread": True, "wsgi.multiprocess": False,
+               "wsgi.run_once": False}
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ[name] = value
+        elif name != "CONTENT_LENGTH":
+            environ["HTTP_" + name] = environ["HTTP_" + name] + "," + value if "HTTP_" + name in environ else value
+
+    def call():
+        started = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = response_headers
+
+        result = sync.app(environ, start_response)
+        try:
+            content = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return started["status"], started["headers"], content
+
+    status, headers, content = await asyncio.to_thread(call)
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]})
+    await send({"type": "http.response.body", "body": content})
@@ -3,7 +3,15 @@ from config import Configurator
 
 class Authorizer:
     def __init__(self):
-        config = Configurator()
+        self.admin_password = None
+        self.reconfigure(Configurator())
+        Configurator.subscribe(self.reconfigure)
+
+    def reconfigure(self, config):
+        """
+        Applies admin password of the reloaded config
+        :param config: Configurator
+        """
         self.admin_password = config.authorization()
 
     def authorize(self, password):
@@ -0,0 +1,125 @@
+"""
+Check of query plans of client reads: every query built by the Databaser read methods is explained
+with the custom plan of its first executions and the generic plan its prepared statement switches to,
+and scans of the large tables are expected to go through indexes.
+Needs the database from config.ini upgraded by schema.py and filled with enough data for the planner
+to prefer indexes, e.g. python -m benchmarks.load seed --photos 100000 --categories 200.
+Run from the repository root: python -m benchmarks.explain
+Exits with status 1 if any plan scans a large table sequentially.
+"""
+import json
+import sys
+
+import psycopg2
+
+from config import Configurator
+from db import Databaser
+from expressions import parse
+from statements import numbered
+
+# tables that must not be scanned sequentially by client reads
+LARGE_TABLES = ("photos", "photos_categories", "hrefs")
+
+
+def queries(database, cursor):
+    """
+    Client read queries with values of existing rows
+    :return: list of (name, query, values)
+    """
+    cursor.execute("SELECT photo_id FROM photos WHERE hidden = false AND incomplete = false ORDER BY photo_id LIMIT 1")
+    photo_id = cursor.fetchone()[0]
+    cursor.execute("SELECT category_id, alias FROM categories ORDER BY category_id LIMIT 2")
+    (category_id, alias), (other_id, _) = cursor.fetchall()
+    tree = parse("{} and not {}".format(category_id, other_id))
+    condition, values = database.filter_condition(tree, {str(category_id): category_id, str(other_id): other_id})
+    window = list(range(photo_id, photo_id + 1000))
+    cursor.execute("SELECT min(date_taken), max(date_taken) FROM photos")
+    date_from, date_to = cursor.fetchone()
+    return [
+        database.photo_by_id_query(photo_id),
+        database.photo_by_id_query(photo_id, hrefs=True),
+        database.photos_by_ids_query(window[:100]),
+        database.categories_by_photo_query(photo_id),
+        database.categories_by_photos_query(window[:100]),
+        database.category_by_label_query(category_id),
+        database.category_by_label_query(alias),
+        database.photos_by_category_query(category_id),
+        database.photos_by_category_query(alias, hrefs=True),
+        database.gallery_index_query(limit=100)[:3],
+        database.gallery_index_query(limit=100, after=photo_id + 500)[:3],
+        database.gallery_index_query(limit=100, hrefs=True)[:3],
+        database.gallery_index_query(categories=True, limit=100)[:3],
+        ("filter_sql",) + database.photos_filter_query(condition, values, limit=100),
+        ("filter_window",) + database.photos_filter_query("photos.photo_id = ANY(%s)", [window], limit=100),
+        database.search_query(["kalomi"], limit=100)[:3],
+        database.search_query(["ka"], limit=100, after=(0.5, photo_id))[:3],
+        database.search_query(["ka"], categories=True, limit=100)[:3],
+        database.timeline_query(date_from, date_to, limit=100),
+        database.timeline_query(date_from, limit=100, after=(date_from, photo_id), hrefs=True),
+        database.timeline_counts_query("day", date_from, date_to),
+        database.timeline_counts_query("year"),
+        ("expiring_hrefs",) + database.expiring_hrefs_query(50),
+    ]
+
+
+def scans(plan):
+    """
+    Scan nodes of a json plan
+    :return: list of (node type, relation, index)
+    """
+    found = []
+    if "Relation Name" in plan:
+        found += [(plan["Node Type"], plan["Relation Name"], plan.get("Index Name"))]
+    for child in plan.get("Plans", []):
+        found += scans(child)
+    return found
+
+
+def explain(connection, name, query, values, generic):
+    """
+    Plan of a query, as a prepared statement with forced generic plan if requested
+    :return: list of scans
+    """
+    with connection.cursor() as cursor:
+        if generic:
+            cursor.execute("SET plan_cache_mode = force_generic_plan")
+            cursor.execute("PREPARE explained AS " + numbered(query))
+            placeholders = ", ".join(["%s"] * len(values))
+            cursor.execute("EXPLAIN (FORMAT JSON) EXECUTE explained" + (" ({})".format(placeholders) * bool(values)),
+                           values)
+        else:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + query, values)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+    connection.rollback()
+    with connection.cursor() as cursor:
+        cursor.execute("DEALLOCATE ALL")
+    return scans(plan[0]["Plan"])
+
+
+def main():
+    database = Databaser()
+    connection = psycopg2.connect(Configurator().database())
+    with connection.cursor() as cursor:
+        checked = queries(database, cursor)
+        cursor.execute("SHOW random_page_cost")
+        print("random_page_cost", cursor.fetchone()[0])
+    connection.rollback()
+    failed = 0
+    print(f"{'query':>36} {'plan':>8}  scans")
+    for name, query, values in checked:
+        for generic in (False, True):
+            found = explain(connection, name, query, values, generic)
+            sequential = [relation for node, relation, _ in found if node == "Seq Scan" and relation in LARGE_TABLES]
+            failed += len(sequential) > 0
+            described = ", ".join(f"{node} {relation}" + (f" using {index}" if index else "")
+                                  for node, relation, index in found)
+            print(f"{name:>36} {'generic' if generic else 'custom':>8}  {described}" +
+                  ("  <- sequential scan" if sequential else ""))
+    connection.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Local fake of Yandex Disk resources api for hrefs synchronization testing and benchmarks.
+Serves files {folder}{size}/{photo_id}_{size}.jpg of photos 1..photos for sizes preview, medium and large,
+and paginated listings of the size folders.
+Point api_url of the YADISK.SYNC config section to it.
+Run from the repository root: python -m benchmarks.fake_yadisk [--port 8765] [--photos 1000] [--latency 50]
+"""
+import argparse
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SIZES = ("preview", "medium", "large")
+FILE_PATTERN = re.compile(r"(?P<size>preview|medium|large)/(?P<photo_id>\d+)_(?P=size)\.jpg$")
+FOLDER_PATTERN = re.compile(r"(?P<size>preview|medium|large)/?$")
+
+
+class FakeDisk(BaseHTTPRequestHandler):
+    photos = 1000
+    latency = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/v1/disk/resources":
+            return self.reply(404, {"error": "NotFound"})
+        if not self.headers.get("Authorization", "").startswith("OAuth "):
+            return self.reply(401, {"error": "UnauthorizedError"})
+        time.sleep(self.latency)
+        query = parse_qs(url.query)
+        path = query.get("path", [""])[0]
+        folder = FOLDER_PATTERN.search(path)
+        if folder is not None:
+            limit = int(query.get("limit", ["20"])[0])
+            offset = int(query.get("offset", ["0"])[0])
+            items = [self.item(path.rstrip("/") + "/{}_{}.jpg".format(photo_id, folder.group("size")))
+                     for photo_id in range(offset + 1, min(offset + limit, self.photos) + 1)]
+            return self.reply(200, {"type": "dir", "path": "disk:" + path,
+                                    "_embedded": {"items": items, "limit": limit, "offset": offset,
+                                                  "total": self.photos}})
+        match = FILE_PATTERN.search(path)
+        if match is None or not 0 < int(match.group("photo_id")) <= self.photos:
+            return self.reply(404, {"error": "DiskNotFoundError"})
+        return self.reply(200, self.item(path))
+
+    def item(self, path):
+        name = path.rsplit("/", 1)[-1]
+        return {"type": "file", "path": "disk:" + path, "name": name,
+                "file": "http://{}/download/{}".format(self.headers.get("Host"), name)}
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Yandex Disk resources api")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--photos", type=int, default=1000, help="photos 1..photos have files")
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds added to every response")
+    args = parser.parse_args()
+    FakeDisk.photos = args.photos
+    FakeDisk.latency = args.latency / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), FakeDisk)
+    print(f"fake yandex disk api at http://127.0.0.1:{args.port}, {args.photos} photos")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
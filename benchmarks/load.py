@@ -0,0 +1,235 @@
+"""
+Load testing of the api: seeds the database from config.ini with a synthetic gallery
+and replays a weighted mix of client requests, reporting latency percentiles and throughput per route.
+
+Run from the repository root:
+    python -m benchmarks.load seed [--photos 10000] [--categories 100] [--density 3] [--seed 1]
+    python -m benchmarks.load run [--requests 5000] [--concurrency 8] [--url http://127.0.0.1:5000]
+                                  [--mix mix.json] [--output result.json] [--compare previous.json]
+
+Seeding replaces all data of the database. Without --url requests go through the flask test client in process.
+Mix file is a json object of request templates to weights, templates may use {photo_id}, {category_id},
+{photo_ids}, {word} and {prefix} placeholders. Descriptions are seeded with words of a synthetic vocabulary
+of 1000 words, so {word} searches match about 0.4% of photos and {prefix} (first two syllables) ones about 4%.
+"""
+import argparse
+import io
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MIX = {
+    "/client/index?limit=100": 20,
+    "/client/categories_index": 10,
+    "/client/photo?id={photo_id}": 30,
+    "/client/photos?ids={photo_ids}": 10,
+    "/client/photos_of_category?label={category_id}": 20,
+    "/client/categories_of_photo?id={photo_id}": 10,
+    "/client/search?q={word}&limit=20": 5,
+    "/client/search?q={prefix}&limit=20": 5,
+}
+
+SYLLABLES = ("ka", "lo", "mi", "ra", "to", "ne", "su", "vi", "de", "po")
+WORDS = [first + second + third for first in SYLLABLES for second in SYLLABLES for third in SYLLABLES]
+
+
+def copy_rows(cursor, table, columns, rows):
+    """
+    Loads rows into table with COPY
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join("\\N" if value is None else str(value) for value in row) + "\n")
+    buffer.seek(0)
+    cursor.copy_expert("COPY {} ({}) FROM STDIN".format(table, ", ".join(columns)), buffer)
+
+
+def seed(args):
+    import psycopg2
+    from config import Configurator
+    from schema import Migrator
+
+    generator = random.Random(args.seed)
+    connection = psycopg2.connect(Configurator().database())
+    Migrator(connection).upgrade()
+    with connection.cursor() as cursor:
+        cursor.execute("TRUNCATE photos_categories, hrefs, photos, categories RESTART IDENTITY CASCADE")
+        copy_rows(cursor, "categories", ("category_id", "name", "description", "hidden", "alias"),
+                  ((i, f"category {i}", f"synthetic category {i} " + " ".join(generator.choices(WORDS, k=2)),
+                    generator.random() < args.hidden, f"category-{i}") for i in range(1, args.categories + 1)))
+        copy_rows(cursor, "photos", ("photo_id", "name", "description", "date_taken", "hidden", "incomplete"),
+                  ((i, f"photo {i}", f"synthetic photo {i} " + " ".join(generator.choices(WORDS, k=4)),
+                    time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(1420070400 + generator.randrange(315360000))),
+                    generator.random() < args.hidden, False)
+                   for i in range(1, args.photos + 1)))
+        relations = set()
+        for photo_id in range(1, args.photos + 1):
+            for _ in range(max(0, round(generator.gauss(args.density, args.density / 2)))):
+                relations.add((photo_id, generator.randint(1, args.categories)))
+        copy_rows(cursor, "photos_categories", ("photo_id", "category_id"), sorted(relations))
+        copy_rows(cursor, "hrefs", ("photo_id", "href_preview", "href_medium", "href_large"),
+                  ((i, f"https://example.invalid/preview/{i}", f"https://example.invalid/medium/{i}",
+                    f"https://example.invalid/large/{i}") for i in range(1, args.photos + 1)))
+        for table, column in (("photos", "photo_id"), ("categories", "category_id")):
+            cursor.execute("SELECT setval(pg_get_serial_sequence(%s, %s), (SELECT max({}) FROM {}))"
+                           .format(column, table), (table, column))
+        cursor.execute("ANALYZE")
+    connection.commit()
+    connection.close()
+    print(f"seeded {args.photos} photos, {args.categories} categories, {len(relations)} relations")
+
+
+def percentile(timings, share):
+    if len(timings) == 0:
+        return None
+    return timings[min(len(timings) - 1, int(len(timings) * share))]
+
+
+class Replayer:
+    def __init__(self, args):
+        self.args = args
+        self.local = threading.local()
+        if args.url is None:
+            from app import app
+            self.app = app
+
+    def get(self, path):
+        """
+        Requests path
+        :return: status code
+        """
+        if self.args.url is None:
+            if not hasattr(self.local, "client"):
+                self.local.client = self.app.test_client()
+            return self.local.client.get(path).status_code
+        try:
+            with urllib.request.urlopen(self.args.url.rstrip("/") + path) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+def plan(args):
+    """
+    Draws request paths from the weighted mix
+    :return: list of (template, path)
+    """
+    mix = DEFAULT_MIX
+    if args.mix is not None:
+        with open(args.mix) as mix_file:
+            mix = json.load(mix_file)
+    generator = random.Random(args.seed)
+    templates = generator.choices(list(mix), weights=list(mix.values()), k=args.requests)
+    requests = []
+    for template in templates:
+        requests += [(template, template.format(
+            photo_id=generator.randint(1, args.photos), category_id=generator.randint(1, args.categories),
+            photo_ids=",".join(str(generator.randint(1, args.photos)) for _ in range(50)),
+            word=generator.choice(WORDS), prefix=generator.choice(WORDS)[:4]))]
+    return requests
+
+
+def run(args):
+    replayer = Replayer(args)
+    requests = plan(args)
+    timings = {}
+    failures = {}
+    lock = threading.Lock()
+
+    def replay(request):
+        template, path = request
+        started = time.perf_counter()
+        status = replayer.get(path)
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            timings.setdefault(template, []).append(elapsed)
+            if status >= 400:
+                failures[template] = failures.get(template, 0) + 1
+
+    # warm up caches and connections
+    for request in requests[:args.concurrency]:
+        replay(request)
+    timings.clear()
+    failures.clear()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(replay, requests))
+    wall = time.perf_counter() - started
+
+    routes = {}
+    for template in sorted(timings):
+        route_timings = sorted(timings[template])
+        routes[template] = {"requests": len(route_timings), "failures": failures.get(template, 0),
+                            "rps": len(route_timings) / wall,
+                            "p50_ms": percentile(route_timings, 0.50), "p95_ms": percentile(route_timings, 0.95),
+                            "p99_ms": percentile(route_timings, 0.99)}
+    all_timings = sorted(timing for route_timings in timings.values() for timing in route_timings)
+    result = {"meta": {"commit": commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                       "mode": "test client" if args.url is None else args.url,
+                       "requests": args.requests, "concurrency": args.concurrency, "seed": args.seed},
+              "total": {"requests": len(all_timings), "failures": sum(failures.values()),
+                        "rps": len(all_timings) / wall, "p50_ms": percentile(all_timings, 0.50),
+                        "p95_ms": percentile(all_timings, 0.95), "p99_ms": percentile(all_timings, 0.99)},
+              "routes": routes}
+    report(result, args.compare)
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+
+
+def report(result, compare=None):
+    previous = {}
+    if compare is not None:
+        with open(compare) as previous_file:
+            previous = json.load(previous_file)["routes"]
+    print(f"{'route':<50} {'reqs':>6} {'fail':>5} {'rps':>8} {'p50, ms':>8} {'p95, ms':>8} {'p99, ms':>8}"
+          + (f" {'p95 change':>11}" if previous else ""))
+    for template, route in list(result["routes"].items()) + [("total", result["total"])]:
+        line = (f"{template:<50} {route['requests']:>6} {route['failures']:>5} {route['rps']:>8.1f} "
+                f"{route['p50_ms']:>8.2f} {route['p95_ms']:>8.2f} {route['p99_ms']:>8.2f}")
+        if template in previous:
+            line += f" {route['p95_ms'] / previous[template]['p95_ms'] - 1:>+10.0%}"
+        print(line)
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed synthetic gallery and replay request mix")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ("seed", "run"):
+        command = commands.add_parser(name)
+        command.add_argument("--photos", type=int, default=10000)
+        command.add_argument("--categories", type=int, default=100)
+        command.add_argument("--seed", type=int, default=1)
+    commands.choices["seed"].add_argument("--density", type=float, default=3, help="mean categories per photo")
+    commands.choices["seed"].add_argument("--hidden", type=float, default=0.05, help="share of hidden entries")
+    commands.choices["run"].add_argument("--requests", type=int, default=5000)
+    commands.choices["run"].add_argument("--concurrency", type=int, default=8)
+    commands.choices["run"].add_argument("--url", default=None, help="server address, flask test client if omitted")
+    commands.choices["run"].add_argument("--mix", default=None, help="json file of request templates to weights")
+    commands.choices["run"].add_argument("--output", default=None, help="json file to save results to")
+    commands.choices["run"].add_argument("--compare", default=None, help="previous results json to compare with")
+    args = parser.parse_args()
+    if args.command == "seed":
+        seed(args)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
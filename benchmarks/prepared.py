@@ -0,0 +1,88 @@
+"""
+Benchmark of hot client reads: plain statements against statements prepared once per connection.
+Reports planning time of every query from EXPLAIN ANALYZE and round trip latency of both ways; planning time of the
+prepared way is measured on EXECUTE after the timed runs, when the server may already use a generic plan.
+Needs the database from config.ini with some data, e.g. seeded with python -m benchmarks.load seed.
+Run from the repository root: python -m benchmarks.prepared [iterations]
+"""
+import re
+import statistics
+import sys
+import time
+
+import psycopg2
+
+from config import Configurator
+from db import Databaser
+from statements import Preparer
+
+
+def queries(database):
+    """
+    Hot client reads, built by the same *_query builders as the Databaser read methods use
+    :param database: Databaser
+    :return: list of (name, query, values)
+    """
+    return [
+        database.photo_by_id_query(1),
+        database.category_by_label_query("1"),
+        database.category_by_label_query("category-1"),
+        database.gallery_index_query(limit=100, after=100)[:3],
+    ]
+
+
+def planning_ms(cursor, query, values):
+    """
+    Planning time of a query as reported by the server
+    :return: milliseconds
+    """
+    cursor.execute("EXPLAIN (ANALYZE, SUMMARY) " + query, values)
+    plan = "\n".join(row[0] for row in cursor.fetchall())
+    return float(re.search(r"Planning Time: ([\d.]+) ms", plan).group(1))
+
+
+def executed(name, values):
+    """
+    EXECUTE statement of a prepared query, the way Preparer runs it
+    :return: statement text with %s placeholders
+    """
+    return "EXECUTE {} ({})".format(name, ", ".join(["%s"] * len(values))) if values else "EXECUTE " + name
+
+
+def measure(connection, preparer, name, query, values, iterations):
+    timings = []
+    with connection.cursor() as cursor:
+        for _ in range(iterations):
+            started = time.perf_counter()
+            preparer.execute(cursor, name, query, values)
+            cursor.fetchall()
+            connection.commit()
+            timings += [(time.perf_counter() - started) * 1000]
+    timings.sort()
+    return {"mean_ms": statistics.mean(timings), "p50_ms": timings[len(timings) // 2],
+            "p95_ms": timings[int(len(timings) * 0.95) - 1]}
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    database = Databaser()
+    connection = psycopg2.connect(Configurator().database())
+    print(f"{iterations} iterations per query and mode")
+    print(f"{'query':>26} {'planning, ms':>13} {'mode':>9} {'mean, ms':>9} {'p50, ms':>8} {'p95, ms':>8}")
+    for name, query, values in queries(database):
+        for mode, preparer in (("plain", Preparer(enabled=False)), ("prepared", Preparer())):
+            result = measure(connection, preparer, name, query, values, iterations)
+            statement = executed(name, values) if preparer.enabled else query
+            with connection.cursor() as cursor:
+                planning = statistics.median(planning_ms(cursor, statement, values) for _ in range(20))
+            connection.commit()
+            print(f"{name:>26} {planning:>13.3f} {mode:>9} {result['mean_ms']:>9.3f} {result['p50_ms']:>8.3f} "
+                  f"{result['p95_ms']:>8.3f}")
+        with connection.cursor() as cursor:
+            cursor.execute("DEALLOCATE ALL")
+        connection.commit()
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark of photos by category lookup: previous multi-query path against the single JOIN query, plain and prepared
+the way Databaser reads run it.
+Needs the database from config.ini with some data.
+Run from the repository root: python -m benchmarks.relations <category label> [iterations]
+"""
+import functools
+import statistics
+import sys
+import time
+
+import psycopg2
+
+from config import Configurator
+from db import Databaser
+from statements import Preparer
+
+HIDDEN = (False,)
+INCOMPLETE = (False,)
+
+
+def legacy_path(cursor, label):
+    """
+    Previous implementation: alias lookup, relations lookup, then photos by collected ids
+    :return: photos and number of round trips
+    """
+    round_trips = 0
+    try:
+        category_id = int(label)
+    except ValueError:
+        cursor.execute("select category_id from categories where alias=%s", [label])
+        round_trips += 1
+        result = cursor.fetchall()
+        if len(result) == 0:
+            return [], round_trips
+        category_id = result[0][0]
+    cursor.execute("SELECT * FROM photos_categories WHERE category_id=%s", [category_id])
+    round_trips += 1
+    photo_ids = [tup[0] for tup in cursor.fetchall()]
+    if len(photo_ids) == 0:
+        return [], round_trips
+    cursor.execute("select * from photos where photo_id in %s and hidden in %s and incomplete in %s",
+                   (tuple(photo_ids), HIDDEN, INCOMPLETE))
+    round_trips += 1
+    return cursor.fetchall(), round_trips
+
+
+def join_path(database, preparer, cursor, label):
+    """
+    Current implementation: one statement resolving id or alias, built by Databaser.photos_by_category_query
+    :return: photos and number of round trips
+    """
+    name, query, values = database.photos_by_category_query(label)
+    preparer.execute(cursor, name, query, values)
+    return cursor.fetchall(), 1
+
+
+def measure(connection, path, label, iterations):
+    timings = []
+    round_trips = 0
+    rows = []
+    with connection.cursor() as cursor:
+        for _ in range(iterations):
+            started = time.perf_counter()
+            rows, round_trips = path(cursor, label)
+            connection.commit()
+            timings += [(time.perf_counter() - started) * 1000]
+    timings.sort()
+    return {"rows": len(rows), "round_trips": round_trips, "mean_ms": statistics.mean(timings),
+            "p50_ms": timings[len(timings) // 2], "p95_ms": timings[int(len(timings) * 0.95) - 1]}
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip())
+        sys.exit(1)
+    label = sys.argv[1]
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    database = Databaser()
+    connection = psycopg2.connect(Configurator().database())
+    print(f"photos of category {label!r}, {iterations} iterations")
+    print(f"{'path':>8} {'rows':>6} {'trips':>6} {'mean, ms':>9} {'p50, ms':>8} {'p95, ms':>8}")
+    for name, path in (("legacy", legacy_path),
+                       ("join", functools.partial(join_path, database, Preparer(enabled=False))),
+                       ("prepared", functools.partial(join_path, database, Preparer()))):
+        result = measure(connection, path, label, iterations)
+        print(f"{name:>8} {result['rows']:>6} {result['round_trips']:>6} {result['mean_ms']:>9.3f} "
+              f"{result['p50_ms']:>8.3f} {result['p95_ms']:>8.3f}")
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Microbenchmark of Responser.json_response against the previous per-cell implementation.
+Run from the repository root: python -m benchmarks.serializer
+"""
+import datetime
+import gc
+import json
+import sys
+import time
+
+import responses
+from responses import Responser
+
+ROWS = (10000, 100000)
+REPEATS = 5
+KEYS = ["photo_id", "name", "description", "date_taken", "hidden", "incomplete"]
+
+
+def legacy_json_response(keys, data, request=None, errors=()):
+    """
+    Previous implementation: type check and index lookup per cell, stdlib json
+    """
+    to_dump = {}
+    if request is not None:
+        to_dump["request"] = request
+    pre_json = []
+    for unit in data:
+        pre_json += [{}]
+        for key_i in range(len(keys)):
+            if type(unit[key_i]) == datetime.datetime:
+                pre_json[-1][keys[key_i]] = unit[key_i].strftime("%d.%m.%y %H:%M")
+            else:
+                pre_json[-1][keys[key_i]] = unit[key_i]
+    to_dump["response"] = pre_json
+    to_dump["errors"] = list(errors)
+    return json.dumps(to_dump)
+
+
+def synthetic_rows(count):
+    base = datetime.datetime(2020, 1, 1)
+    return [(i, f"photo {i}", f"description of photo {i}" if i % 3 else None,
+             base + datetime.timedelta(minutes=i) if i % 5 else None, False, False)
+            for i in range(count)]
+
+
+def best_of(function):
+    timings = []
+    for _ in range(REPEATS):
+        gc.collect()
+        started = time.perf_counter()
+        function()
+        timings += [time.perf_counter() - started]
+    return min(timings)
+
+
+def main():
+    request = {"expected": "photos index"}
+    backend = "orjson" if responses.orjson is not None else "json"
+    print(f"python {sys.version.split()[0]}, json backend: {backend}, best of {REPEATS}")
+    print(f"{'rows':>8} {'legacy, s':>10} {'planned, s':>11} {'speedup':>8}")
+    for count in ROWS:
+        rows = synthetic_rows(count)
+        assert json.loads(legacy_json_response(KEYS, rows))["response"] == \
+            json.loads(Responser().json_response(KEYS, rows))["response"]
+
+        def planned():
+            responser = Responser()
+            responser.request = request
+            responser.json_response(KEYS, rows)
+
+        legacy = best_of(lambda: legacy_json_response(KEYS, rows, request))
+        current = best_of(planned)
+        print(f"{count:>8} {legacy:>10.3f} {current:>11.3f} {legacy / current:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
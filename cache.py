@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class Cacher:
+    def __init__(self, max_entries=1024, ttl=60.0):
+        """
+        Thread-safe LRU cache of responses with ttl and tag-based invalidation
+        :param max_entries: maximum number of cached responses, 0 disables the cache
+        :param ttl: seconds a response stays valid
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.tagged = {}
+        self.invalidations = {}
+        self.cleared = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.metrics = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key):
+        """
+        Returns cached response
+        :param key: hashable request key
+        :return: cached response and None, or None and invalidation sequence to pass to put
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.metrics["hits"] += 1
+                    return entry[1], None
+                self.remove(key)
+            self.metrics["misses"] += 1
+            return None, self.sequence
+
+    def put(self, key, value, tags, since):
+        """
+        Caches response unless any of its tags has been invalidated since the response was computed
+        :param key: hashable request key
+        :param value: response
+        :param tags: tags of data the response depends on
+        :param since: invalidation sequence returned by get before computing the response
+        """
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            if self.cleared >= since:
+                return
+            for tag in tags:
+                if self.invalidations.get(tag, -1) >= since:
+                    return
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, value, tuple(tags))
+            for tag in tags:
+                self.tagged.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self.remove(next(iter(self.entries)))
+                self.metrics["evictions"] += 1
+
+    def invalidate(self, tags):
+        """
+        Drops every response that depends on any of the tags
+        :param tags: tags of changed data
+        """
+        with self.lock:
+            for tag in tags:
+                self.invalidations[tag] = self.sequence
+                for key in tuple(self.tagged.get(tag, ())):
+                    self.remove(key)
+                    self.metrics["invalidations"] += 1
+            self.sequence += 1
+
+    def clear(self):
+        """
+        Drops every cached response
+        """
+        with self.lock:
+            self.metrics["invalidations"] += len(self.entries)
+            self.entries.clear()
+            self.tagged.clear()
+            self.cleared = self.sequence
+            self.sequence += 1
+
+    def remove(self, key):
+        """
+        Removes entry and its tag references; the lock must be held
+        :param key: hashable request key
+        """
+        entry = self.entries.pop(key)
+        for tag in entry[2]:
+            keys = self.tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self.tagged[tag]
+
+    def stats(self):
+        """
+        Cache usage metrics
+        :return: dict of metrics
+        """
+        with self.lock:
+            stats = dict(self.metrics)
+            stats["entries"] = len(self.entries)
+            return stats
@@ -1,10 +1,61 @@
+import os
+import threading
 from configparser import ConfigParser
 
+CONFIG_FILE = "config.ini"
+
 
 class Configurator:
+    # parsed config shared by every instance, re-parsed only when the file changes
+    shared = None
+    stamp = None
+    subscribers = []
+    lock = threading.Lock()
+
     def __init__(self):
-        self.config = ConfigParser()
-        self.config.read("config.ini")
+        if Configurator.shared is None:
+            Configurator.reload()
+        self.config = Configurator.shared
+
+    @classmethod
+    def reload(cls, force=False):
+        """
+        Re-parses config file if its modification time or size has changed and notifies subscribers
+        :param force: re-parse even if the file looks unchanged
+        :return: if the config was re-parsed
+        """
+        try:
+            stat = os.stat(CONFIG_FILE)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stamp = None
+        with cls.lock:
+            if cls.shared is not None and stamp == cls.stamp and not force:
+                return False
+            config = ConfigParser()
+            config.read(CONFIG_FILE)
+            initial = cls.shared is None
+            cls.shared, cls.stamp = config, stamp
+            subscribers = list(cls.subscribers)
+        if not initial:
+            for callback in subscribers:
+                try:
+                    callback(Configurator())
+                except Exception as e:
+                    print(e)
+        return True
+
+    @classmethod
+    def subscribe(cls, callback):
+        """
+        Registers a callback to reconfigure its owner in place after the config is re-parsed
+        :param callback: function of Configurator
+        """
+        with cls.lock:
+            cls.subscribers += [callback]
+
+    def reload_interval(self):
+        return self.config.getfloat("CONFIG", "reload_interval", fallback=5.0)
 
     def database(self):
         info = ""
@@ -12,6 +63,64 @@ class Configurator:
             info += key + "=" + self.config["DATABASE"][key]+" "
         return info.strip()
 
+    def database_params(self):
+        # keyword arguments of the async driver
+        section = self.config["DATABASE"]
+        # -cname=value server settings of libpq options
+        settings = dict(option[2:].split("=", 1) for option in section.get("options", "").split()
+                        if option.startswith("-c") and "=" in option)
+        return {"database": section.get("dbname"), "host": section.get("host"),
+                "port": int(section["port"]) if section.get("port") else None,
+                "user": section.get("user"), "password": section.get("password") or None,
+                "server_settings": settings or None}
+
+    def database_pool(self):
+        section = "DATABASE.POOL"
+        return {"min_connections": self.config.getint(section, "min_connections", fallback=1),
+                "max_connections": self.config.getint(section, "max_connections", fallback=10),
+                "checkout_timeout": self.config.getfloat(section, "checkout_timeout", fallback=10.0),
+                "health_check_interval": self.config.getfloat(section, "health_check_interval", fallback=30.0)}
+
+    def database_statements(self):
+        section = "DATABASE.STATEMENTS"
+        return {"enabled": self.config.getboolean(section, "prepared", fallback=True)}
+
+    def database_schema(self):
+        section = "DATABASE.SCHEMA"
+        return {"upgrade": self.config.getboolean(section, "upgrade", fallback=True)}
+
+    def cache(self):
+        section = "CACHE"
+        return {"max_entries": self.config.getint(section, "max_entries", fallback=1024),
+                "ttl": self.config.getfloat(section, "ttl", fallback=60.0)}
+
+    def data_version(self):
+        section = "DATA.VERSION"
+        return {"poll_interval": self.config.getfloat(section, "poll_interval", fallback=1.0)}
+
+    def membership_index(self):
+        section = "MEMBERSHIP.INDEX"
+        return {"enabled": self.config.getboolean(section, "enabled", fallback=True),
+                "rebuild_interval": self.config.getfloat(section, "rebuild_interval", fallback=300.0),
+                "max_photos": self.config.getint(section, "max_photos", fallback=200)}
+
+    def photos_import(self):
+        section = "PHOTOS.IMPORT"
+        return {"max_rows": self.config.getint(section, "max_rows", fallback=100000)}
+
+    def static_export(self):
+        section = "STATIC.EXPORT"
+        return {"enabled": self.config.getboolean(section, "enabled", fallback=False),
+                "directory": self.config.get(section, "directory", fallback=""),
+                "shard_size": self.config.getint(section, "shard_size", fallback=1000),
+                "delay": self.config.getfloat(section, "delay", fallback=1.0),
+                "full_interval": self.config.getfloat(section, "full_interval", fallback=3600.0),
+                "gzip_level": self.config.getint(section, "gzip_level", fallback=9)}
+
+    def metrics(self):
+        section = "METRICS"
+        return {"enabled": self.config.getboolean(section, "enabled", fallback=True)}
+
     def authorization(self):
         return self.config["AUTHORIZATION"]["adminPassword"]
 
@@ -21,6 +130,26 @@ class Configurator:
             folder += "/"
         return self.config["YADISK.API"]["api_token"], folder
 
+    def yadisk_sync(self):
+        section = "YADISK.SYNC"
+        return {"api_url": self.config.get(section, "api_url", fallback="https://cloud-api.yandex.net"),
+                "concurrency": self.config.getint(section, "concurrency", fallback=8),
+                "rate_limit": self.config.getfloat(section, "rate_limit", fallback=20.0),
+                "retries": self.config.getint(section, "retries", fallback=3),
+                "backoff": self.config.getfloat(section, "backoff", fallback=0.5),
+                "timeout": self.config.getfloat(section, "timeout", fallback=10.0),
+                "batch_size": self.config.getint(section, "batch_size", fallback=100),
+                "discovery": self.config.get(section, "discovery", fallback="listing"),
+                "page_size": self.config.getint(section, "page_size", fallback=1000)}
+
+    def hrefs_refresh(self):
+        section = "HREFS.REFRESH"
+        return {"enabled": self.config.getboolean(section, "enabled", fallback=True),
+                "ttl": self.config.getfloat(section, "ttl", fallback=3600.0),
+                "margin": self.config.getfloat(section, "margin", fallback=600.0),
+                "interval": self.config.getfloat(section, "interval", fallback=30.0),
+                "batch_size": self.config.getint(section, "batch_size", fallback=50)}
+
     def yadisk_api_rewrite(self, token, remote_folder):
         """
         Re-configurator for api module
@@ -32,7 +161,35 @@ class Configurator:
             token = original_token
         if remote_folder is None:
             remote_folder = original_folder
-        self.config.set("YADISK.API", "api_token", token)
-        self.config.set("YADISK.API", "remote_folder", remote_folder)
-        with open("config.ini", "w") as configfile:
-            self.config.write(configfile)
+        # the shared config is never modified in place, readers get the new one after reload
+        config = ConfigParser()
+        config.read_dict(self.config)
+        config.set("YADISK.API", "api_token", token)
+        config.set("YADISK.API", "remote_folder", remote_folder)
+        with open(CONFIG_FILE, "w") as configfile:
+            config.write(configfile)
+        Configurator.reload(force=True)
+
+
+class Watcher(threading.Thread):
+    def __init__(self, interval):
+        """
+        Background thread that reloads the config when its file changes
+        :param interval: seconds between checks of the file modification time
+        """
+        super().__init__(name="config-watcher", daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                Configurator.reload()
+            except Exception as e:
+                print(e)
+
+    def stop(self):
+        """
+        Stops watching the config file
+        """
+        self.stopped.set()
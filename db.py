@@ -1,20 +1,198 @@
-import psycopg2
-import json
+import bisect
+import collections
+import csv
+import datetime
+import functools
+import io
+import itertools
+import threading
+import time
+from psycopg2 import extensions
+from psycopg2.extras import execute_values
+from cache import Cacher
 from config import Configurator
+from expressions import labels, parse
+from importer import copy_line, photo, records
+from membership import Indexer
+from metrics import measurer, ROWS_BUCKETS
+from pool import Pooler
 from responses import Responser
+from schema import COLUMNS, Migrator
+from statements import Preparer
 from yadisk import API
 
+SQL_SECONDS = measurer.histogram("gallery_sql_seconds", "SQL statement latency by Databaser method", ["query"])
+SQL_ROWS = measurer.histogram("gallery_sql_rows", "Rows returned or affected by SQL statement by Databaser method",
+                              ["query"], ROWS_BUCKETS)
+
+
+# upsert of fetched hrefs, formatted with the values placeholder of the driver
+HREFS_UPSERT = """insert into hrefs (photo_id, href_preview, href_medium, href_large, fetched_at)
+               values {}
+               on conflict (photo_id) do update set href_preview=excluded.href_preview,
+               href_medium=excluded.href_medium, href_large=excluded.href_large,
+               fetched_at=excluded.fetched_at, refresh_attempts=0, refresh_attempted_at=null"""
+HREFS_COMPLETE = "UPDATE photos SET incomplete=false where photo_id = ANY(%s) and incomplete=true"
+# refresh attempt of hrefs, successfully refreshed ones are reset by the upsert
+HREFS_ATTEMPT = """UPDATE hrefs SET refresh_attempts=refresh_attempts + 1, refresh_attempted_at=now()
+                where photo_id = ANY(%s)"""
+# gallery data and hrefs versions, shared by processes through the database
+DATA_VERSION = "SELECT version, hrefs_version, modified, hrefs_modified FROM data_version"
+DATA_VERSION_BUMP = """UPDATE data_version SET version=version + 1, modified=now()
+                    RETURNING version, hrefs_version, modified, hrefs_modified"""
+HREFS_VERSION_BUMP = """UPDATE data_version SET hrefs_version=hrefs_version + 1, hrefs_modified=now()
+                     RETURNING version, hrefs_version, modified, hrefs_modified"""
+
+
+class MeasuredCursor(extensions.cursor):
+    """
+    Cursor recording latency and row count of every statement under the name of the running Databaser method
+    """
+    query = "unknown"
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            SQL_SECONDS.observe(time.perf_counter() - started, self.query)
+            if self.rowcount >= 0:
+                SQL_ROWS.observe(self.rowcount, self.query)
+
+
+def pooled(method):
+    """
+    Checks out a pooled connection with its own cursor for the duration of a Databaser method.
+    Nested calls in the same thread reuse the connection that is already checked out
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.pool is None:
+            return method(self, *args, **kwargs)
+        if self.connection is not None:
+            outer, self.cursor.query = self.cursor.query, method.__name__
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.cursor.query = outer
+        # the pool may be replaced by a config reload meanwhile, the connection goes back where it came from
+        pool = self.pool
+        try:
+            connection = pool.getconn()
+        except Exception as e:
+            print(e)
+            return method(self, *args, **kwargs)
+        self.local.connection = connection
+        self.local.cursor = connection.cursor(cursor_factory=MeasuredCursor)
+        self.local.cursor.query = method.__name__
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.local.cursor.close()
+            self.local.cursor = None
+            self.local.connection = None
+            pool.putconn(connection)
+    return wrapper
+
 
 class Databaser:
+    # rows fetched from a server-side cursor per round trip in streaming mode
+    stream_chunk_size = 1000
+    # photo ids from the membership index passed to a query of a filter page at once
+    filter_window = 1000
+    # timeline count periods and their formats
+    timeline_groups = {"year": "YYYY", "month": "YYYY-MM", "day": "YYYY-MM-DD"}
+
     def __init__(self):
+        self.local = threading.local()
+        self.stream_names = itertools.count()
+        self.reads_lock = threading.Lock()
+        self.href_reads = collections.Counter()
+        self.version_lock = threading.Lock()
+        # versions of the database, None until they are read
+        self.version = None
+        self.hrefs_version = None
+        self.modified = None
+        self.hrefs_modified = None
+        config = Configurator()
+        self.cache = Cacher(**config.cache())
+        self.href_ttl = config.hrefs_refresh()["ttl"]
+        self.import_max_rows = config.photos_import()["max_rows"]
+        self.preparer = Preparer(**config.database_statements())
+        self.pool_settings = (config.database(), config.database_pool())
         try:
-            config = Configurator()
-            self.connection = psycopg2.connect(config.database())
-            self.cursor = self.connection.cursor()
+            self.pool = Pooler(config.database(), **config.database_pool())
         except Exception as e:
             print(e)
-            self.connection = None
+            self.pool = None
+        self.api = None
+        self.api_lock = threading.Lock()
+        self.subscribers = []
+        if config.database_schema()["upgrade"]:
+            self.upgrade_schema()
+        self.index = Indexer()
+        self.read_version()
+        self.index_enabled = config.membership_index()["enabled"]
+        self.index_max_photos = config.membership_index()["max_photos"]
+        if self.index_enabled:
+            self.build_index()
+        Configurator.subscribe(self.reconfigure)
+
+    def reconfigure(self, config):
+        """
+        Applies the reloaded config in place: cache limits, hrefs ttl, import limit, statements mode, membership index,
+        connection pool (replaced only if its settings changed) and Yandex Disk client
+        :param config: Configurator
+        """
+        cache = config.cache()
+        self.cache.max_entries = cache["max_entries"]
+        self.cache.ttl = cache["ttl"]
+        self.href_ttl = config.hrefs_refresh()["ttl"]
+        self.import_max_rows = config.photos_import()["max_rows"]
+        self.preparer.enabled = config.database_statements()["enabled"]
+        pool_settings = (config.database(), config.database_pool())
+        if pool_settings != self.pool_settings:
+            try:
+                pool = Pooler(config.database(), **config.database_pool())
+            except Exception as e:
+                print(e)
+            else:
+                retired, self.pool, self.pool_settings = self.pool, pool, pool_settings
+                if retired is not None:
+                    retired.retire()
+        with self.api_lock:
+            # rebuilt on the next synchronization, running ones finish with the previous client
+            self.api = None
+        self.index_enabled = config.membership_index()["enabled"]
+        self.index_max_photos = config.membership_index()["max_photos"]
+        if self.index_enabled and not self.index.ready:
+            self.build_index()
+
+    def yadisk(self):
+        """
+        Yandex Disk client shared by hrefs synchronizations
+        :return: API
+        """
+        with self.api_lock:
+            if self.api is None:
+                self.api = API()
+            return self.api
 
+    @property
+    def connection(self):
+        """
+        Connection checked out by the current thread
+        """
+        return getattr(self.local, "connection", None)
+
+    @property
+    def cursor(self):
+        """
+        Cursor of the connection checked out by the current thread
+        """
+        return getattr(self.local, "cursor", None)
+
+    @pooled
     def insert_photo(self, photo_name, photo_description=None, timestamp=None, hidden=False):
         """
         Inserts photo to database
@@ -45,8 +223,87 @@ class Databaser:
         except Exception as e:
             print(e)
             return responser.communication_error(str(e))
+        self.data_changed(["photo:{}".format(photo_id), "photos_index"])
         return responser.json_response(["photo_id"], (photo_id,))
 
+    @pooled
+    def import_photos(self, stream, csv_format=False):
+        """
+        Inserts photos in bulk. Valid rows are loaded with COPY into staging tables, then inserted into photos
+        and assigned with their categories in one transaction; rows with errors or unknown aliases are skipped
+        :param stream: binary stream of the request body, see importer.records
+        :param csv_format: if the body is csv, json lines otherwise
+        :return: json with photo id of every input row (null for skipped ones), errors of skipped rows in errors tag
+        """
+        responser = Responser()
+        responser.request = {"expected": "photos import", "format": "csv" if csv_format else "jsonl"}
+        if not self.check_connection():
+            return responser.connection_error()
+        photos = io.StringIO()
+        aliases = io.StringIO()
+        numbers = []
+        # (row number, error) of skipped rows
+        skipped = []
+        try:
+            for number, record in records(stream, csv_format):
+                if number > self.import_max_rows:
+                    return responser.bad_request("more than {} rows".format(self.import_max_rows))
+                numbers += [number]
+                try:
+                    name, description, timestamp, hidden, categories = photo(record)
+                except ValueError as e:
+                    skipped += [(number, {"error_id": -5, "error_description": "bad request",
+                                          "raw_error": "row {}: {}".format(number, e)})]
+                    continue
+                photos.write(copy_line((number, name, description, timestamp, hidden)))
+                aliases.writelines(copy_line((number, alias)) for alias in categories)
+        except (UnicodeDecodeError, csv.Error) as e:
+            return responser.bad_request(str(e))
+        if len(numbers) == 0:
+            return responser.empty_request()
+        cursor = self.cursor
+        try:
+            # COPY takes photo ids in the order of input rows
+            cursor.execute("""CREATE TEMP TABLE import_photos (row integer PRIMARY KEY,
+                           photo_id integer NOT NULL DEFAULT nextval(pg_get_serial_sequence('photos', 'photo_id')),
+                           name text, description text, date_taken timestamp, hidden boolean) ON COMMIT DROP""")
+            cursor.execute("CREATE TEMP TABLE import_categories (row integer, alias text) ON COMMIT DROP")
+            photos.seek(0)
+            cursor.copy_expert("COPY import_photos (row, name, description, date_taken, hidden) FROM STDIN", photos)
+            aliases.seek(0)
+            cursor.copy_expert("COPY import_categories (row, alias) FROM STDIN", aliases)
+            cursor.execute("""SELECT row, alias FROM import_categories WHERE NOT EXISTS (
+                               SELECT FROM categories WHERE categories.alias=import_categories.alias)""")
+            unknown = {}
+            for number, alias in cursor.fetchall():
+                unknown.setdefault(number, []).append(alias)
+            cursor.execute("DELETE FROM import_photos WHERE row = ANY(%s)", [list(unknown)])
+            cursor.execute("""INSERT INTO photos (photo_id, name, description, date_taken, hidden)
+                           SELECT photo_id, name, description, date_taken, hidden FROM import_photos""")
+            cursor.execute("""INSERT INTO photos_categories (photo_id, category_id)
+                           SELECT import_photos.photo_id, categories.category_id FROM import_categories
+                           JOIN import_photos ON import_photos.row=import_categories.row
+                           JOIN categories ON categories.alias=import_categories.alias
+                           ORDER BY 1, 2 RETURNING photo_id, category_id""")
+            pairs = cursor.fetchall()
+            cursor.execute("SELECT row, photo_id FROM import_photos")
+            photo_ids = dict(cursor.fetchall())
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            print(e)
+            return responser.communication_error(str(e))
+        skipped += [(number, {"error_id": -1, "error_description": "id not found",
+                              "raw_error": "row {}: category alias {}".format(number, ", ".join(unknown[number]))})
+                    for number in unknown]
+        responser.errors += [error for _, error in sorted(skipped, key=lambda item: item[0])]
+        if len(photo_ids) > 0:
+            self.index.update(added=pairs)
+            self.data_changed(["photo:{}".format(photo_id) for photo_id in photo_ids.values()] + ["photos_index"] +
+                              self.pairs_tags(pairs))
+        return responser.json_response(["row", "photo_id"], [(number, photo_ids.get(number)) for number in numbers])
+
+    @pooled
     def modify_photo(self, photo_id, photo_name=None, photo_description=None, timestamp=None, hidden=None):
         """
         Replaces entry at photos table with specified data maintaining photo id
@@ -96,57 +353,79 @@ class Databaser:
                 self.connection.rollback()
                 print(e)
                 return responser.communication_error(str(e))
+            self.data_changed(["photo:{}".format(int(photo_id)), "photos_index"] +
+                              self.relation_tags(photo_ids=[photo_id]))
             return responser.simple_response()
 
+    @pooled
     def assign_photo_to_categories(self, photo_id, category_ids):
         """
-        Creates assignment of the photo id with the category ids
+        Creates assignment of the photo id with the category ids in one statement.
+        Existing assignments are kept, ids that are not found are reported in errors
         :return: json with errors and success status
         """
         responser = Responser()
         responser.request = {"photo_id": photo_id, "expected": "categories assignment"}
         if not self.check_connection():
             return responser.connection_error()
-        if len(category_ids) > 0:
-            for category_id in category_ids:
-                responser.errors += self.assign_photo_category(photo_id, category_id)
+        try:
+            errors, pairs = self.insert_relations([photo_id], category_ids)
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            print(e)
+            return responser.communication_error(str(e))
+        responser.errors += errors
+        self.index.update(added=pairs)
+        self.data_changed(self.pairs_tags(pairs))
         return responser.simple_response()
 
+    @pooled
     def modify_photo_to_categories(self, photo_id, category_ids):
         """
         Re-assigns the photo id with the category ids
-        by deleting previous assignation and adding new one
+        by deleting previous assignation and adding new one in one transaction
         :return: json with errors and success status
         """
         responser = Responser()
         responser.request = {"photo_id": photo_id, "expected": "categories re-assignment"}
         if not self.check_connection():
             return responser.connection_error()
-        delete = self.delete_photo_to_categories(photo_id)
-        if "success" in json.loads(delete)["response"]:
-            return self.assign_photo_to_categories(photo_id, category_ids)
-        else:
-            return delete
+        try:
+            deleted = self.delete_relations(photo_id=photo_id)
+            errors, pairs = self.insert_relations([photo_id], category_ids)
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            print(e)
+            return responser.communication_error(str(e))
+        responser.errors += errors
+        self.index.update(removed=deleted, added=pairs)
+        self.data_changed(self.pairs_tags(deleted + pairs))
+        return responser.simple_response()
 
+    @pooled
     def delete_photo_to_categories(self, photo_id):
         """
         Deletes assignation with any category
         :return: json with errors and success status
         """
-        cursor = self.cursor
         responser = Responser()
         responser.request = {"photo_id": photo_id, "expected": "categories un-assignment"}
         if not self.check_connection():
             return responser.connection_error()
         try:
-            cursor.execute("DELETE FROM photos_categories WHERE photo_id=%s", [photo_id])
+            deleted = self.delete_relations(photo_id=photo_id)
             self.connection.commit()
         except Exception as e:
             self.connection.rollback()
             print(e)
-            responser.communication_error(str(e))
+            return responser.communication_error(str(e))
+        self.index.update(removed=deleted)
+        self.data_changed(["categories_of_photo:{}".format(int(photo_id))] + self.pairs_tags(deleted))
         return responser.simple_response()
 
+    @pooled
     def insert_category(self, category_name, alias, category_description=None, hidden=False):
         """
         Inserts category to database
@@ -175,8 +454,11 @@ class Databaser:
         except Exception as e:
             print(e)
             return responser.communication_error(str(e))
+        self.index.update(renamed=[(None, alias, category_id)])
+        self.data_changed(["category:{}".format(category_id), "category:{}".format(alias), "categories_index"])
         return responser.json_response(["category_id"], (category_id,))
 
+    @pooled
     def modify_category(self, category_id, category_name=None, alias=None, category_description=None,
                         hidden=None):
         """
@@ -195,7 +477,7 @@ class Databaser:
             return responser.connection_error()
         new_values = (category_name, category_description, hidden, alias)
         try:
-            cursor.execute("SELECT * FROM category WHERE photo_id=%s", [category_id])
+            cursor.execute("SELECT * FROM categories WHERE category_id=%s", [category_id])
             self.connection.commit()
         except Exception as e:
             self.connection.rollback()
@@ -219,32 +501,50 @@ class Databaser:
             changed_columns = ", ".join(changed_columns)
             values = tuple([x for x in new_values if x is not None])
             try:
-                cursor.execute("""UPDATE category SET {}
+                cursor.execute("""UPDATE categories SET {}
                                WHERE category_id=%s""".format(changed_columns), values + (category_id,))
                 self.connection.commit()
             except Exception as e:
                 self.connection.rollback()
                 print(e)
                 return responser.communication_error(str(e))
+        old_alias = q[0][columns.index("alias") + 1]
+        tags = ["category:{}".format(int(category_id)), "category:{}".format(old_alias), "categories_index"]
+        if alias is not None:
+            self.index.update(renamed=[(old_alias, alias, int(category_id))])
+            # listings requested by the old alias are gone, the new alias could be cached as absent
+            tags += ["category:{}".format(alias), "photos_of_category:{}".format(old_alias),
+                     "photos_of_category:{}".format(alias)]
+        self.data_changed(tags + self.relation_tags(category_ids=[category_id]))
         return responser.simple_response()
 
+    @pooled
     def assign_category_to_photos(self, category_id, photo_ids):
         """
-        Creates assignment of the photo id with the category ids
+        Creates assignment of the category id with the photo ids in one statement.
+        Existing assignments are kept, ids that are not found are reported in errors
         :return: json with errors and success status
         """
         responser = Responser()
         responser.request = {"category_id": category_id, "expected": "photos assignment"}
         if not self.check_connection():
             return responser.connection_error()
-        if len(photo_ids) > 0:
-            for photo_id in photo_ids:
-                responser.errors += self.assign_photo_category(photo_id, category_id)
+        try:
+            errors, pairs = self.insert_relations(photo_ids, [category_id])
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            print(e)
+            return responser.communication_error(str(e))
+        responser.errors += errors
+        self.index.update(added=pairs)
+        self.data_changed(self.pairs_tags(pairs))
         return responser.simple_response()
 
+    @pooled
     def modify_category_to_photos(self, category_id, photo_ids):
         """
-        Re-assigns photos with specified category
+        Re-assigns photos with specified category in one transaction
         :param category_id: target category
         :param photo_ids: list of photos to assign with this category
         :return: json with errors and success status
@@ -253,38 +553,49 @@ class Databaser:
         responser.request = {"category_id": category_id, "expected": "photos re-assignment"}
         if not self.check_connection():
             return responser.connection_error()
-        delete = self.delete_category_to_photos(category_id)
-        if "success" in json.loads(delete)["response"]:
-            return self.assign_category_to_photos(category_id, photo_ids)
-        else:
-            return delete
+        try:
+            deleted = self.delete_relations(category_id=category_id)
+            errors, pairs = self.insert_relations(photo_ids, [category_id])
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            print(e)
+            return responser.communication_error(str(e))
+        responser.errors += errors
+        self.index.update(removed=deleted, added=pairs)
+        self.data_changed(self.pairs_tags(deleted + pairs))
+        return responser.simple_response()
 
+    @pooled
     def delete_category_to_photos(self, category_id):
         """
         Deletes all assignment of specified category
         :param category_id: category to unassign
         :return: json with errors and success status
         """
-        cursor = self.cursor
         responser = Responser()
         responser.request = {"category_id": category_id, "expected": "photos un-assignment"}
         if not self.check_connection():
             return responser.connection_error()
         try:
-            cursor.execute("DELETE FROM photos_categories WHERE category_id=%s", [category_id])
+            deleted = self.delete_relations(category_id=category_id)
             self.connection.commit()
         except Exception as e:
             self.connection.rollback()
             print(e)
             return responser.communication_error(str(e))
+        self.index.update(removed=deleted)
+        self.data_changed(self.pairs_tags(deleted) + self.category_tags([category_id]))
         return responser.simple_response()
 
-    def get_photo_by_id(self, photo_id, return_hidden=False, return_incomplete=False):
+    @pooled
+    def get_photo_by_id(self, photo_id, return_hidden=False, return_incomplete=False, hrefs=False):
         """
         Return photo from database by id
         :param photo_id: requested photo id
         :param return_hidden: if the method should return hidden photos
         :param return_incomplete: if the method should return incomplete photos
+        :param hrefs: if fresh hrefs of the photo should be embedded
         :return: json with data
         """
         cursor = self.cursor
@@ -292,17 +603,8 @@ class Databaser:
         responser.request = {"photo_id": photo_id, "expected": "photo by id"}
         if not self.check_connection():
             return responser.connection_error()
-        if return_hidden:
-            hidden_mark = (True, False)
-        else:
-            hidden_mark = (False,)
-        if return_incomplete:
-            incomplete_mark = (True, False)
-        else:
-            incomplete_mark = (False,)
         try:
-            cursor.execute("SELECT * FROM photos WHERE photo_id=%s and hidden in %s and incomplete in %s",
-                           (photo_id, hidden_mark, incomplete_mark))
+            self.preparer.execute(cursor, *self.photo_by_id_query(photo_id, return_hidden, return_incomplete, hrefs))
             self.connection.commit()
         except Exception as e:
             self.connection.commit()
@@ -316,42 +618,99 @@ class Databaser:
         if len(result) == 0:
             return responser.id_not_found_error()
         columns = self.current_columns_names()
+        if hrefs:
+            self.note_href_reads([result[0][0]])
         return responser.json_response(columns, result[0])
 
-    def get_categories_by_photo(self, photo_id, return_hidden=False):
+    @pooled
+    def get_photos_by_ids(self, photo_ids, return_hidden=False, return_incomplete=False, hrefs=False):
         """
-        Returns categories that are assigned with specified photo id
-        :param photo_id:
+        Returns photos from database by list of ids in one query
+        :param photo_ids: list of requested photo ids
+        :param return_hidden: if the method should return hidden photos
+        :param return_incomplete: if the method should return incomplete photos
+        :param hrefs: if fresh hrefs of photos should be embedded
+        :return: json with photos mapped by id, null for not found ones
+        """
+        cursor = self.cursor
+        responser = Responser()
+        responser.request = {"photo_ids": photo_ids, "expected": "photos by ids"}
+        if not self.check_connection():
+            return responser.connection_error()
+        try:
+            self.preparer.execute(cursor, *self.photos_by_ids_query(photo_ids, return_hidden, return_incomplete, hrefs))
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            print(e)
+            return responser.communication_error(str(e))
+        try:
+            data = cursor.fetchall()
+        except Exception as e:
+            print(e)
+            return responser.communication_error(str(e))
+        columns = self.current_columns_names()
+        if hrefs:
+            self.note_href_reads([row[0] for row in data])
+        return responser.map_response(columns, data, photo_ids)
+
+    @pooled
+    def get_categories_by_photos(self, photo_ids, return_hidden=False):
+        """
+        Returns categories that are assigned with each of specified photos in one query
+        :param photo_ids: list of photo ids
         :param return_hidden: True If hidden categories are needed too
-        :return: json with data and errors
+        :return: json with lists of categories mapped by photo id
         """
         cursor = self.cursor
         responser = Responser()
-        responser.request = {"photo_id": photo_id, "expected": "categories by photo"}
+        responser.request = {"photo_ids": photo_ids, "expected": "categories by photos"}
         if not self.check_connection():
             return responser.connection_error()
+        categories = None
+        name, query, values = self.categories_by_photos_query(photo_ids, return_hidden)
+        if self.index_enabled and self.index.ready:
+            name, query, values, categories = self.indexed_categories_by_photos_query(photo_ids, return_hidden)
         try:
-            cursor.execute("SELECT * FROM photos_categories WHERE photo_id=%s", [photo_id])
+            self.preparer.execute(cursor, name, query, values)
             self.connection.commit()
         except Exception as e:
             self.connection.rollback()
             print(e)
             return responser.communication_error(str(e))
         try:
-            result = cursor.fetchall()
+            data = cursor.fetchall()
         except Exception as e:
             print(e)
             return responser.communication_error(str(e))
-        if len(result) == 0:
-            return responser.id_not_found_error()
-        raw_categories = [tup[1] for tup in result]
-        if return_hidden:
-            hidden_mark = (True, False)
-        else:
-            hidden_mark = (False,)
+        columns = self.current_columns_names()
+        if categories is not None:
+            columns, data = self.categories_of_photos_rows(categories, columns, data)
+        return responser.map_response(columns, data, photo_ids, grouped=True)
+
+    @pooled
+    def get_categories_by_photo(self, photo_id, return_hidden=False):
+        """
+        Returns categories that are assigned with specified photo id
+        :param photo_id:
+        :param return_hidden: True If hidden categories are needed too
+        :return: json with data and errors
+        """
+        cursor = self.cursor
+        responser = Responser()
+        responser.request = {"photo_id": photo_id, "expected": "categories by photo"}
+        if not self.check_connection():
+            return responser.connection_error()
+        name, query, values = self.categories_by_photo_query(photo_id, return_hidden)
+        if self.index_enabled and self.index.ready:
+            try:
+                name, query, values = self.indexed_categories_by_photo_query(photo_id, return_hidden)
+            except ValueError as e:
+                return responser.communication_error(str(e))
+            if query is None:
+                return responser.id_not_found_error()
         try:
-            cursor.execute("select * from categories where category_id in %s and hidden in %s",
-                           (tuple(raw_categories), hidden_mark))
+            self.preparer.execute(cursor, name, query, values)
             self.connection.commit()
         except Exception as e:
             self.connection.rollback()
@@ -363,8 +722,11 @@ class Databaser:
         except Exception as e:
             print(e)
             return responser.communication_error(str(e))
+        if len(data) == 0:
+            return responser.id_not_found_error()
         return responser.json_response(columns, data)
 
+    @pooled
     def get_category_by_id(self, category_id, return_hidden=False):
         """
         Return category from database by id
@@ -377,13 +739,11 @@ class Databaser:
         responser.request = {"category_id": category_id, "expected": "category by id"}
         if not self.check_connection():
             return responser.connection_error()
-        if return_hidden:
-            hidden_mark = (True, False)
-        else:
-            hidden_mark = (False,)
         try:
-            cursor.execute("select * from categories where category_id=%s and hidden in %s",
-                           (category_id, hidden_mark))
+            self.preparer.execute(cursor, self.flagged("category_by_id", return_hidden),
+                                  "select {} from categories where category_id=%s and {}".format(
+                                      self.columns("categories"), self.visible("categories", return_hidden)),
+                                  [category_id])
             self.connection.commit()
         except Exception as e:
             self.connection.rollback()
@@ -399,6 +759,7 @@ class Databaser:
         columns = self.current_columns_names()
         return responser.json_response(columns, result[0])
 
+    @pooled
     def get_category_by_label(self, category_label, return_hidden=False):
         """
         Return category from database by label (id or alias)
@@ -406,13 +767,29 @@ class Databaser:
         :param return_hidden: if the method should return hidden category
         :return: json with data
         """
+        cursor = self.cursor
         responser = Responser()
         responser.request = {"category_label": category_label, "expected": "category by label"}
-        category_id = self.get_category_by_label(category_label)
-        if category_id == "-1":
+        if not self.check_connection():
+            return responser.connection_error()
+        try:
+            self.preparer.execute(cursor, *self.category_by_label_query(category_label, return_hidden))
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            print(e)
+            return responser.communication_error(str(e))
+        try:
+            result = cursor.fetchall()
+        except Exception as e:
+            print(e)
+            return responser.communication_error(str(e))
+        if len(result) == 0:
             return responser.id_not_found_error()
-        return self.get_category_by_id(category_id, return_hidden)
+        columns = self.current_columns_names()
+        return responser.json_response(columns, result[0])
 
+    @pooled
     def get_category_id_by_label(self, category_label):
         """
         Returns category id by its label (id or alias)
@@ -422,10 +799,12 @@ class Databaser:
         try:
             int(category_label)
         except ValueError:
+            if not self.check_connection():
+                return "-1"
             cursor = self.cursor
             try:
-                cursor.execute("select category_id from categories where alias=%s",
-                               [category_label])
+                self.preparer.execute(cursor, "category_id_by_alias",
+                                      "select category_id from categories where alias=%s", [category_label])
                 self.connection.commit()
             except Exception as e:
                 self.connection.rollback()
@@ -437,91 +816,223 @@ class Databaser:
                 return "-1"
             if len(result) == 0:
                 return "-1"
-            return result[0]
+            return result[0][0]
         return category_label
 
-    def get_photos_by_category(self, category_id, return_hidden=False, return_incomplete=False):
+    @pooled
+    def get_photos_by_category(self, category_label, return_hidden=False, return_incomplete=False, stream=False,
+                               hrefs=False):
         """
         Json-constructed (Responser) array in parent photos
-        :param category_id: requested category id
+        :param category_label: requested category label (id or alias)
         :param return_hidden: if the method should return hidden photos
         :param return_incomplete: if the method should return incomplete photos
-        :return:
+        :param stream: if the response should be generated incrementally from a server-side cursor
+        :param hrefs: if fresh hrefs of photos should be embedded
+        :return: json response, generator of json chunks if streamed successfully
         """
         responser = Responser()
-        responser.request = {"category_id": category_id, "expected": "photos by category"}
+        responser.request = {"category_label": category_label, "expected": "photos by category"}
         if not self.check_connection():
             return responser.connection_error()
         cursor = self.cursor
+        name, query, values = self.photos_by_category_query(category_label, return_hidden, return_incomplete, hrefs)
+        if stream:
+            return self.stream_query(responser, query, values)
+        if self.index_enabled and self.index.ready:
+            name, query, values = self.indexed_photos_by_category_query(category_label, return_hidden,
+                                                                        return_incomplete, hrefs)
+            if query is None:
+                return responser.id_not_found_error()
         try:
-            cursor.execute("SELECT * FROM photos_categories WHERE category_id=%s", [category_id])
+            self.preparer.execute(cursor, name, query, values)
             self.connection.commit()
         except Exception as e:
             self.connection.rollback()
             print(e)
             return responser.communication_error(str(e))
 
+        columns = self.current_columns_names()
         try:
-            result = cursor.fetchall()
+            data = cursor.fetchall()
         except Exception as e:
             print(e)
             return responser.communication_error(str(e))
-        if len(result) == 0:
+        if len(data) == 0:
             return responser.id_not_found_error()
+        if hrefs:
+            self.note_href_reads([row[0] for row in data])
+        return responser.json_response(columns, data)
 
-        raw_photos = [tup[0] for tup in result]
-        if return_hidden:
-            hidden_mark = (True, False)
-        else:
-            hidden_mark = (False,)
-        if return_incomplete:
-            incomplete_mark = (True, False)
+    @pooled
+    def get_gallery_index(self, categories=False, return_hidden=False, return_incomplete=False, limit=None,
+                          after=None, stream=False, hrefs=False):
+        """
+        Returns json with all photos that are not hidden, ordered by id
+        :param categories: if the index of categories is requested instead of photos
+        :param return_hidden: if the method should return hidden entries
+        :param return_incomplete: if the method should return incomplete photos
+        :param limit: optional - page size; the whole index is returned if not specified
+        :param after: optional - keyset cursor, id of the last entry of the previous page
+        :param stream: if the response should be generated incrementally from a server-side cursor
+        :param hrefs: if fresh hrefs of photos should be embedded, photos index only
+        :return: json response, with next_cursor if there are more pages;
+        generator of json chunks if streamed successfully
+        """
+        responser = Responser()
+        if categories:
+            responser.request = {"expected": "categories index"}
         else:
-            incomplete_mark = (False,)
+            responser.request = {"expected": "photos index"}
+        if limit is not None:
+            responser.request["limit"] = limit
+            responser.request["after"] = after
+        if not self.check_connection():
+            return responser.connection_error()
+        cursor = self.cursor
+        name, query, values, id_column = self.gallery_index_query(categories, return_hidden, return_incomplete,
+                                                                  limit, after, hrefs)
+        if stream:
+            return self.stream_query(responser, query, values, id_column, limit)
+        try:
+            self.preparer.execute(cursor, name, query, values)
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            print(e)
+            return responser.communication_error(str(e))
+        columns = self.current_columns_names()
+        try:
+            index = cursor.fetchall()
+        except Exception as e:
+            print(e)
+            return responser.communication_error(str(e))
+        if limit is not None and len(index) > limit:
+            index = index[:limit]
+            responser.next_cursor = index[-1][columns.index(id_column)]
+        if hrefs and not categories:
+            self.note_href_reads([row[0] for row in index])
+        return responser.json_response(columns, index)
+
+    @pooled
+    def get_photos_by_filter(self, expression, return_hidden=False, return_incomplete=False, limit=None, after=None,
+                             hrefs=False):
+        """
+        Returns photos matching boolean expression over category labels, ordered by id.
+        The expression is evaluated on the membership index if it is ready, in sql otherwise
+        :param expression: expression text, see expressions.parse
+        :param return_hidden: if the method should return hidden photos
+        :param return_incomplete: if the method should return incomplete photos
+        :param limit: optional - page size
+        :param after: optional - id cursor of the previous page
+        :param hrefs: if fresh hrefs of photos should be embedded
+        :return: json response, with next_cursor if there are more pages
+        """
+        responser = Responser()
+        responser.request = {"expression": expression, "expected": "photos by filter"}
+        if limit is not None:
+            responser.request["limit"] = limit
+            responser.request["after"] = after
+        if not self.check_connection():
+            return responser.connection_error()
+        tree = parse(expression)
+        cursor = self.cursor
+        data = []
+        columns = None
         try:
-            cursor.execute("select * from photos where photo_id in %s and hidden in %s and incomplete in %s",
-                           (tuple(raw_photos), hidden_mark, incomplete_mark))
+            name, query, values = self.category_ids_query(labels(tree))
+            self.preparer.execute(cursor, name, query, values)
+            category_ids, responser.errors = self.label_ids(labels(tree), cursor.fetchall())
+            for condition, condition_values in self.filter_plan(tree, category_ids, after, limit):
+                cursor.execute(*self.photos_filter_query(condition, condition_values, return_hidden,
+                                                         return_incomplete, limit, after, hrefs))
+                columns = self.current_columns_names()
+                data += cursor.fetchall()
+                if limit is not None and len(data) > limit:
+                    break
             self.connection.commit()
         except Exception as e:
             self.connection.rollback()
             print(e)
             return responser.communication_error(str(e))
+        if limit is not None and len(data) > limit:
+            data = data[:limit]
+            responser.next_cursor = data[-1][0]
+        if hrefs:
+            self.note_href_reads([row[0] for row in data])
+        return responser.json_response(columns or [], data)
 
+    @pooled
+    def get_search_results(self, terms, categories=False, return_hidden=False, return_incomplete=False, limit=100,
+                           after=None, hrefs=False):
+        """
+        Full-text search of photos or categories by name and description, every term is matched as a prefix.
+        Results are ordered by rank, then by id
+        :param terms: list of search terms
+        :param categories: if categories should be searched instead of photos
+        :param return_hidden: if the method should return hidden entries
+        :param return_incomplete: if the method should return incomplete photos
+        :param limit: page size
+        :param after: optional - (rank, id) cursor of the previous page
+        :param hrefs: if fresh hrefs of photos should be embedded
+        :return: json response, with "rank:id" next_cursor if there are more pages
+        """
+        responser = Responser()
+        responser.request = {"terms": terms, "expected": "categories search" if categories else "photos search",
+                             "limit": limit, "after": self.search_cursor(after)}
+        if not self.check_connection():
+            return responser.connection_error()
+        cursor = self.cursor
+        name, query, values, id_column = self.search_query(terms, categories, return_hidden, return_incomplete, limit,
+                                                           after, hrefs)
+        try:
+            self.preparer.execute(cursor, name, query, values)
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            print(e)
+            return responser.communication_error(str(e))
         columns = self.current_columns_names()
         try:
             data = cursor.fetchall()
         except Exception as e:
             print(e)
             return responser.communication_error(str(e))
+        if len(data) > limit:
+            data = data[:limit]
+            responser.next_cursor = self.search_cursor((data[-1][columns.index("rank")],
+                                                        data[-1][columns.index(id_column)]))
+        if hrefs and not categories:
+            self.note_href_reads([row[0] for row in data])
         return responser.json_response(columns, data)
 
-    def get_gallery_index(self, categories=False, return_hidden=False, return_incomplete=False):
+    @pooled
+    def get_timeline(self, date_from=None, date_to=None, return_hidden=False, return_incomplete=False, limit=None,
+                     after=None, hrefs=False):
         """
-        Returns json with all photos that are not hidden
-        :return: json response
+        Returns photos taken within a date range, ordered by date taken, then by id; photos without date are left out
+        :param date_from: optional - datetime, inclusive lower bound
+        :param date_to: optional - datetime, exclusive upper bound
+        :param return_hidden: if the method should return hidden photos
+        :param return_incomplete: if the method should return incomplete photos
+        :param limit: optional - page size
+        :param after: optional - (date taken, id) cursor of the previous page
+        :param hrefs: if fresh hrefs of photos should be embedded
+        :return: json response, with "date:id" next_cursor if there are more pages
         """
         responser = Responser()
-        if categories:
-            responser.request = {"expected": "categories index"}
-        else:
-            responser.request = {"expected": "photos index"}
+        responser.request = {"expected": "photos timeline", "from": self.timeline_date(date_from),
+                             "to": self.timeline_date(date_to)}
+        if limit is not None:
+            responser.request["limit"] = limit
+            responser.request["after"] = self.timeline_cursor(after)
         if not self.check_connection():
             return responser.connection_error()
         cursor = self.cursor
-        if categories:
-            index_type = "categories"
-        else:
-            index_type = "photos"
-        if return_hidden:
-            hidden_mark = (True, False)
-        else:
-            hidden_mark = (False,)
-        if return_incomplete and not categories:
-            incomplete_mark = " and incomplete in (True, False)"
-        else:
-            incomplete_mark = ""
+        name, query, values = self.timeline_query(date_from, date_to, return_hidden, return_incomplete, limit, after,
+                                                  hrefs)
         try:
-            cursor.execute("select * from {} where hidden in %s{}".format(index_type, incomplete_mark), [hidden_mark])
+            self.preparer.execute(cursor, name, query, values)
             self.connection.commit()
         except Exception as e:
             self.connection.rollback()
@@ -529,67 +1040,83 @@ class Databaser:
             return responser.communication_error(str(e))
         columns = self.current_columns_names()
         try:
-            index = cursor.fetchall()
+            data = cursor.fetchall()
         except Exception as e:
             print(e)
             return responser.communication_error(str(e))
-        return responser.json_response(columns, index)
+        if limit is not None and len(data) > limit:
+            data = data[:limit]
+            responser.next_cursor = self.timeline_cursor((data[-1][columns.index("date_taken")],
+                                                          data[-1][columns.index("photo_id")]))
+        if hrefs:
+            self.note_href_reads([row[0] for row in data])
+        return responser.json_response(columns, data)
 
-    def assign_photo_category(self, photo_id, category_id):
+    @pooled
+    def get_timeline_counts(self, group, date_from=None, date_to=None, return_hidden=False, return_incomplete=False):
         """
-        Creates assignment of specified photo and category
-        :param photo_id: photo id
-        :param category_id: category id
-        :return: json with list of errors
+        Returns numbers of photos taken per year, month or day within a date range, counted by the database
+        :param group: year, month or day
+        :param date_from: optional - datetime, inclusive lower bound
+        :param date_to: optional - datetime, exclusive upper bound
+        :param return_hidden: if the method should count hidden photos
+        :param return_incomplete: if the method should count incomplete photos
+        :return: json response, periods in chronological order with their counts
         """
+        responser = Responser()
+        responser.request = {"expected": "timeline counts", "group": group, "from": self.timeline_date(date_from),
+                             "to": self.timeline_date(date_to)}
+        if not self.check_connection():
+            return responser.connection_error()
         cursor = self.cursor
+        name, query, values = self.timeline_counts_query(group, date_from, date_to, return_hidden, return_incomplete)
         try:
-            cursor.execute("INSERT INTO photos_categories VALUES (%s, %s)", (photo_id, category_id))
+            self.preparer.execute(cursor, name, query, values)
             self.connection.commit()
         except Exception as e:
             self.connection.rollback()
             print(e)
-            return [{"error_id": 0, "raw_error": str(e)}]
-        return []
+            return responser.communication_error(str(e))
+        columns = self.current_columns_names()
+        try:
+            data = cursor.fetchall()
+        except Exception as e:
+            print(e)
+            return responser.communication_error(str(e))
+        return responser.json_response(columns, data)
 
+    @pooled
     def sync_hrefs_elements(self):
         """
-        Synchronizes elements in hrefs table with photos table
+        Synchronizes elements in hrefs table with photos table.
+        Hrefs are fetched concurrently and saved in batches, photos with all hrefs found become complete
         :return: json report
         """
         cursor = self.cursor
         responser = Responser()
         responser.request = {"expected": "hrefs synchronization"}
-        api = API()
+        if not self.check_connection():
+            return responser.connection_error()
 
         # get list of incomplete photo ids
         try:
             cursor.execute("select photo_id from photos where incomplete=true")
             self.connection.commit()
-            ids_list = cursor.fetchall()
+            ids_list = [tup[0] for tup in cursor.fetchall()]
         except Exception as e:
             self.connection.rollback()
             print(e)
             return responser.communication_error(str(e))
 
         # fetch and save hrefs
-        for photo_id in ids_list:
-            hrefs = api.get_hrefs_by_id(photo_id)
-            try:
-                cursor.execute("""insert into hrefs (photo_id, href_preview, href_medium, href_large)
-                               values (%s, %s, %s, %s)""",
-                               (photo_id, hrefs["preview"], hrefs["medium"], hrefs["large"]))
-                # update incomplete flag for changed photo
-                cursor.execute("UPDATE photos SET incomplete=false where photo_id=%s", [photo_id])
-                self.connection.commit()
-            except Exception as e:
-                self.connection.rollback()
-                print(e)
-                responser.errors += [{"error_id": 0,
-                                      "error_description": f"error while inserting {photo_id} into hrefs",
-                                      "raw_error": str(e)}]
+        synced_ids = self.save_hrefs(responser, ids_list)
+        # photos which are not incomplete anymore appear in listings
+        if len(synced_ids) > 0:
+            self.data_changed(["photo:{}".format(photo_id) for photo_id in synced_ids] + ["photos_index"] +
+                              self.relation_tags(photo_ids=synced_ids))
         return responser.simple_response()
 
+    @pooled
     def update_hrefs(self):
         """
         Updates hrefs of every element of hrefs table
@@ -597,39 +1124,1039 @@ class Databaser:
         """
         cursor = self.cursor
         responser = Responser()
-        api = API()
+        responser.request = {"expected": "hrefs update"}
+        if not self.check_connection():
+            return responser.connection_error()
         try:
             cursor.execute("select photo_id from hrefs")
             self.connection.commit()
-            ids = cursor.fetchall()
+            ids = [tup[0] for tup in cursor.fetchall()]
         except Exception as e:
             self.connection.rollback()
             print(e)
             return responser.communication_error(str(e))
-        for photo_id in ids:
-            hrefs = api.get_hrefs_by_id(photo_id)
-            try:
-                cursor.execute("""update hrefs set href_preview=%s, href_medium=%s, href_large=%s where photo_id=%s""",
-                               hrefs["preview"], hrefs["medium"], hrefs["large"])
-                self.connection.commit()
-            except Exception as e:
-                responser.errors += [{"error_id": 0,
-                                      "error_description": f"error while updating {photo_id} in hrefs",
-                                      "raw_error": str(e)}]
+        self.save_hrefs(responser, ids)
         return responser.simple_response()
 
-    def current_columns_names(self):
-        """
-        Columns of database request
-        :return: list of columns after a database request
-        """
-        return [desc[0] for desc in self.cursor.description]
-
-    def check_connection(self):
+    @pooled
+    def refresh_expiring_hrefs(self, batch_size):
         """
-        Checks connection with database
-        :return: connection status
+        Refreshes a batch of hrefs that are close to expiry, the most read ones first
+        :param batch_size: maximum number of photos to refresh
+        :return: json report
         """
-        if self.connection is None or self.connection.closed:
-            return False
-        return True
+        cursor = self.cursor
+        responser = Responser()
+        responser.request = {"expected": "expiring hrefs refresh"}
+        if not self.check_connection():
+            return responser.connection_error()
+        try:
+            cursor.execute(*self.expiring_hrefs_query(batch_size))
+            self.connection.commit()
+            candidates = [tup[0] for tup in cursor.fetchall()]
+        except Exception as e:
+            self.connection.rollback()
+            print(e)
+            return responser.communication_error(str(e))
+        if len(candidates) == 0:
+            return responser.simple_response()
+        chosen = self.popular_hrefs(candidates, batch_size)
+        try:
+            cursor.execute(HREFS_ATTEMPT, [chosen])
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            print(e)
+            return responser.communication_error(str(e))
+        self.save_hrefs(responser, chosen, discovery="lookup")
+        return responser.simple_response()
+
+    @staticmethod
+    def expiring_hrefs_query(batch_size):
+        """
+        Query of hrefs close to expiry, oldest first, several batches of them to choose the most read ones from.
+        Hrefs whose refresh failed are retried after the refresh interval, doubled with every failed attempt
+        up to the ttl, so hrefs of missing files do not fill every batch
+        :param batch_size: maximum number of photos to refresh
+        :return: query and values
+        """
+        refresh = Configurator().hrefs_refresh()
+        return ("""select photo_id from hrefs where fetched_at < now() - make_interval(secs => %s)
+                and (refresh_attempted_at is null or refresh_attempted_at <
+                     now() - make_interval(secs => least(%s * power(2, refresh_attempts - 1), %s)))
+                order by fetched_at limit %s""",
+                [refresh["ttl"] - refresh["margin"], refresh["interval"], refresh["ttl"], batch_size * 4])
+
+    def popular_hrefs(self, candidates, batch_size):
+        """
+        Chooses the most read of expiring hrefs and resets their read counts
+        :param candidates: ids of photos with expiring hrefs
+        :param batch_size: maximum number of photos to choose
+        :return: chosen ids of photos
+        """
+        with self.reads_lock:
+            chosen = sorted(candidates, key=lambda photo_id: -self.href_reads[photo_id])[:batch_size]
+            for photo_id in chosen:
+                del self.href_reads[photo_id]
+        return chosen
+
+    def note_href_reads(self, photo_ids):
+        """
+        Counts reads of hrefs to refresh the popular ones first
+        :param photo_ids: ids of photos whose hrefs have been read
+        """
+        with self.reads_lock:
+            self.href_reads.update(photo_ids)
+
+    def save_hrefs(self, responser, photo_ids, discovery=None):
+        """
+        Fetches hrefs of photos concurrently and saves them in batches.
+        Photos with every href found are marked complete, the others are reported in errors
+        :param responser: responser of the calling method
+        :param photo_ids: ids of photos
+        :param discovery: optional - listing or lookup, overrides the configured discovery mode
+        :return: ids of saved photos
+        """
+        try:
+            api = self.yadisk()
+        except Exception as e:
+            print(e)
+            responser.errors += [{"error_id": 0, "error_description": "yandex disk api is not configured",
+                                  "raw_error": str(e)}]
+            return []
+        sync = Configurator().yadisk_sync()
+        if discovery is None:
+            discovery = sync["discovery"]
+        if discovery == "listing":
+            results = api.resolve_hrefs(photo_ids, sync["page_size"])
+        else:
+            results = api.fetch_hrefs(photo_ids)
+        saved_ids = []
+        batch = []
+        for photo_id, hrefs, error in results:
+            if error is not None:
+                print(error)
+                responser.errors += [{"error_id": 0,
+                                      "error_description": f"error while fetching hrefs of {photo_id}",
+                                      "raw_error": str(error)}]
+            elif "" in (hrefs["preview"], hrefs["medium"], hrefs["large"]):
+                responser.errors += [{"error_id": 0,
+                                      "error_description": f"not every href of {photo_id} is found"}]
+            else:
+                batch += [(photo_id, hrefs["preview"], hrefs["medium"], hrefs["large"])]
+            if len(batch) >= sync["batch_size"]:
+                saved_ids += self.write_hrefs(responser, batch)
+                batch = []
+        if len(batch) > 0:
+            saved_ids += self.write_hrefs(responser, batch)
+        return saved_ids
+
+    def write_hrefs(self, responser, batch):
+        """
+        Saves batch of hrefs and marks their photos complete in one transaction
+        :param responser: responser of the calling method
+        :param batch: list of (photo_id, href_preview, href_medium, href_large)
+        :return: ids of saved photos
+        """
+        photo_ids = [row[0] for row in batch]
+        try:
+            execute_values(self.cursor, HREFS_UPSERT.format("%s"), batch, template="(%s, %s, %s, %s, now())")
+            self.cursor.execute(HREFS_COMPLETE, [photo_ids])
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            print(e)
+            responser.errors += [{"error_id": 0,
+                                  "error_description": f"error while saving hrefs of {photo_ids}",
+                                  "raw_error": str(e)}]
+            return []
+        self.hrefs_changed()
+        return photo_ids
+
+    def subscribe(self, callback):
+        """
+        Registers a callback to be notified of committed data changes, e.g. by the static exporter
+        :param callback: function of the list of tags of changed data, must not block
+        """
+        with self.version_lock:
+            self.subscribers += [callback]
+
+    def unsubscribe(self, callback):
+        """
+        Stops notifying a callback registered with subscribe
+        :param callback: registered function
+        """
+        with self.version_lock:
+            self.subscribers = [subscriber for subscriber in self.subscribers if subscriber != callback]
+
+    def data_changed(self, tags):
+        """
+        Drops cached responses that depend on changed data, bumps gallery data version and notifies subscribers.
+        Called after the write is committed, the version is bumped for other processes in its own transaction
+        :param tags: tags of changed data
+        """
+        self.cache.invalidate(tags)
+        self.bump_version(DATA_VERSION_BUMP)
+        with self.version_lock:
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            try:
+                callback(tags)
+            except Exception as e:
+                print(e)
+
+    def hrefs_changed(self, versions=None):
+        """
+        Drops cached responses with embedded hrefs and bumps hrefs version
+        :param versions: optional - versions row already bumped by the caller, e.g. by async refresh
+        """
+        self.cache.invalidate(["hrefs"])
+        if versions is None:
+            self.bump_version(HREFS_VERSION_BUMP)
+        else:
+            self.set_version(versions)
+
+    def bump_version(self, query):
+        """
+        Bumps version in the database on the connection of the calling write
+        :param query: DATA_VERSION_BUMP or HREFS_VERSION_BUMP
+        """
+        try:
+            self.cursor.execute(query)
+            versions = self.cursor.fetchone()
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            print(e)
+            versions = None
+        self.set_version(versions)
+
+    @pooled
+    def read_version(self):
+        """
+        Reads versions of the database, which are bumped by writes of other processes as well
+        :return: if the versions were read
+        """
+        versions = None
+        if self.check_connection():
+            try:
+                self.cursor.execute(DATA_VERSION)
+                versions = self.cursor.fetchone()
+                self.connection.commit()
+            except Exception as e:
+                self.connection.rollback()
+                print(e)
+        self.set_version(versions, polled=True)
+        return versions is not None
+
+    def set_version(self, versions, polled=False):
+        """
+        Keeps versions of the database in memory. Versions changed by other processes drop cached responses,
+        as tags of their changes are not known, and outdate the membership index
+        :param versions: version, hrefs version and their modification times; None if they are unknown,
+        conditional requests are not answered until they are read again
+        :param polled: if versions are read rather than bumped by this process
+        """
+        with self.version_lock:
+            previous = (self.version, self.hrefs_version)
+            if versions is None:
+                self.version = self.hrefs_version = self.modified = self.hrefs_modified = None
+                return
+            if None not in previous and (versions[0] < previous[0] or versions[1] < previous[1]):
+                # read or bumped before versions that are already known, e.g. by the poll of a concurrent write
+                return
+            if polled and previous[0] != versions[0]:
+                # before the version is published, so reads with its etag do not use the outdated index
+                self.index.invalidate()
+            self.version, self.hrefs_version = versions[0], versions[1]
+            self.modified, self.hrefs_modified = [value.astimezone(datetime.timezone.utc).replace(microsecond=0)
+                                                  for value in (versions[2], versions[3])]
+        if polled and previous[0] != versions[0]:
+            self.cache.clear()
+        elif polled and previous[1] != versions[1]:
+            self.cache.invalidate(["hrefs"])
+
+    def data_version(self, hrefs=False):
+        """
+        Current gallery data version, does not touch the database
+        :param hrefs: if the version should account for embedded hrefs
+        :return: entity tag and last modification time, both None if the version is unknown
+        """
+        with self.version_lock:
+            if self.version is None:
+                return None, None
+            if hrefs:
+                return "{}-{}".format(self.version, self.hrefs_version), max(self.modified, self.hrefs_modified)
+            return str(self.version), self.modified
+
+    def relation_tags(self, photo_ids=(), category_ids=()):
+        """
+        Cache tags of relation listings that contain specified photos or categories
+        :param photo_ids: changed photos - photos listings of their categories are tagged
+        :param category_ids: changed categories - categories listings of their photos are tagged
+        :return: list of tags, the whole cache is dropped if relations can not be fetched
+        """
+        tags = []
+        try:
+            if len(photo_ids) > 0:
+                self.cursor.execute("""SELECT DISTINCT categories.category_id, categories.alias FROM photos_categories
+                                    JOIN categories ON categories.category_id=photos_categories.category_id
+                                    WHERE photos_categories.photo_id in %s""", [tuple(photo_ids)])
+                tags += ["photos_of_category:{}".format(label) for tup in self.cursor.fetchall() for label in tup]
+            if len(category_ids) > 0:
+                self.cursor.execute("SELECT DISTINCT photo_id FROM photos_categories WHERE category_id in %s",
+                                    [tuple(category_ids)])
+                tags += ["categories_of_photo:{}".format(tup[0]) for tup in self.cursor.fetchall()]
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            print(e)
+            self.cache.clear()
+        return tags
+
+    def category_tags(self, category_ids):
+        """
+        Cache tags of photos listings of specified categories, requested either by id or by alias
+        :param category_ids: categories whose photos listings changed
+        :return: list of tags, the whole cache is dropped if aliases can not be fetched
+        """
+        tags = ["photos_of_category:{}".format(int(category_id)) for category_id in category_ids]
+        try:
+            self.cursor.execute("SELECT alias FROM categories WHERE category_id in %s", [tuple(category_ids)])
+            tags += ["photos_of_category:{}".format(tup[0]) for tup in self.cursor.fetchall()]
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            print(e)
+            self.cache.clear()
+        return tags
+
+    def insert_relations(self, photo_ids, category_ids):
+        """
+        Assigns every specified photo with every specified category in one statement, skipping existing
+        assignments. Does not commit - runs in the transaction of the caller
+        :param photo_ids: list of photo ids
+        :param category_ids: list of category ids
+        :return: list of errors for ids that are not found, list of assigned (photo_id, category_id) pairs
+        """
+        requested = {"photo_id": photo_ids, "category_id": category_ids}
+        valid = {}
+        for column in requested:
+            valid[column] = []
+            for value in requested[column]:
+                try:
+                    valid[column] += [int(value)]
+                except (TypeError, ValueError):
+                    pass
+        # ids are looked up in their own tables, so a missing photo does not hide existing categories and vice versa
+        found = {"photo_id": set(), "category_id": set()}
+        if len(valid["photo_id"]) > 0 or len(valid["category_id"]) > 0:
+            self.cursor.execute("""WITH found_photos AS (SELECT photo_id FROM photos WHERE photo_id = ANY(%s)),
+                                found_categories AS (
+                                    SELECT category_id FROM categories WHERE category_id = ANY(%s)),
+                                inserted AS (
+                                    INSERT INTO photos_categories (photo_id, category_id)
+                                    SELECT photo_id, category_id FROM found_photos, found_categories
+                                    ON CONFLICT DO NOTHING)
+                                SELECT 'photo_id', photo_id FROM found_photos
+                                UNION ALL SELECT 'category_id', category_id FROM found_categories""",
+                                (valid["photo_id"], valid["category_id"]))
+            for column, value in self.cursor.fetchall():
+                found[column].add(value)
+        pairs = [(photo_id, category_id) for photo_id in sorted(found["photo_id"])
+                 for category_id in sorted(found["category_id"])]
+        errors = []
+        for column in requested:
+            for value in requested[column]:
+                try:
+                    if int(value) in found[column]:
+                        continue
+                except (TypeError, ValueError):
+                    pass
+                errors += [{"error_id": -1, "error_description": "id not found",
+                            "raw_error": "{} {}".format(column, value)}]
+        return errors, pairs
+
+    def delete_relations(self, photo_id=None, category_id=None):
+        """
+        Deletes all assignments of specified photo or category.
+        Does not commit - runs in the transaction of the caller
+        :param photo_id: photo to unassign
+        :param category_id: category to unassign
+        :return: list of deleted (photo_id, category_id) pairs
+        """
+        if photo_id is not None:
+            self.cursor.execute("DELETE FROM photos_categories WHERE photo_id=%s RETURNING photo_id, category_id",
+                                [photo_id])
+        else:
+            self.cursor.execute("DELETE FROM photos_categories WHERE category_id=%s RETURNING photo_id, category_id",
+                                [category_id])
+        return self.cursor.fetchall()
+
+    @pooled
+    def upgrade_schema(self):
+        """
+        Upgrades database schema to the latest version
+        :return: list of applied versions
+        """
+        if not self.check_connection():
+            return []
+        try:
+            return Migrator(self.connection).upgrade()
+        except Exception as e:
+            print(e)
+            return []
+
+    @pooled
+    def build_index(self):
+        """
+        Loads all assignments into the membership index in one query.
+        Assignments committed meanwhile are recorded by the index and replayed over the loaded ones
+        :return: if the index was built
+        """
+        if not self.check_connection():
+            return False
+        self.index.begin()
+        try:
+            self.cursor.execute("SELECT photo_id, category_id FROM photos_categories ORDER BY photo_id, category_id")
+            pairs = self.cursor.fetchall()
+            self.cursor.execute("SELECT alias, category_id FROM categories")
+            aliases = self.cursor.fetchall()
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            self.index.cancel()
+            print(e)
+            return False
+        self.index.build(pairs, aliases)
+        return True
+
+    @pooled
+    def export_rows(self, name, query, values):
+        """
+        Reads rows of a query built by one of the *_query builders for the static exporter
+        :param name: statement name
+        :param query: query
+        :param values: query values
+        :return: column names and list of rows
+        :raise ConnectionError: if there is no database connection
+        :raise Exception: if the query fails, the export is retried by the exporter
+        """
+        if not self.check_connection():
+            raise ConnectionError("no database connection")
+        try:
+            self.preparer.execute(self.cursor, name, query, values)
+            rows = self.cursor.fetchall()
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        return self.current_columns_names(), rows
+
+    def pairs_tags(self, pairs):
+        """
+        Cache tags of relation listings affected by changed assignments
+        :param pairs: list of (photo_id, category_id) pairs
+        :return: list of tags
+        """
+        tags = ["categories_of_photo:{}".format(photo_id) for photo_id in {pair[0] for pair in pairs}]
+        category_ids = {pair[1] for pair in pairs}
+        if len(category_ids) > 0:
+            tags += self.category_tags(category_ids)
+        return tags
+
+    @staticmethod
+    def visible(table, return_hidden=False, return_incomplete=True):
+        """
+        Condition on flags of entries a read may return. Flags are inlined rather than passed as values,
+        so partial indexes of public entries match the query plans
+        :param table: photos or categories
+        :param return_hidden: if hidden entries are included
+        :param return_incomplete: if incomplete entries are included, photos only
+        :return: sql condition
+        """
+        conditions = ["{}.hidden = false".format(table)] * (not return_hidden)
+        conditions += ["{}.incomplete = false".format(table)] * (not return_incomplete)
+        return " and ".join(conditions) or "true"
+
+    @staticmethod
+    def flagged(name, return_hidden=False, return_incomplete=False):
+        """
+        Statement name of a query shape with inlined flags
+        :return: statement name with suffixes of included flagged entries
+        """
+        return name + "_hidden" * bool(return_hidden) + "_incomplete" * bool(return_incomplete)
+
+    def photo_by_id_query(self, photo_id, return_hidden=False, return_incomplete=False, hrefs=False):
+        """
+        Photo by id query, shared by sync and async readers as all the *_query builders
+        :return: statement name, query and values
+        """
+        select, join = self.photo_columns(hrefs)
+        return (self.flagged("photo_by_id_hrefs" if hrefs else "photo_by_id", return_hidden, return_incomplete),
+                "SELECT {} FROM photos{} WHERE photos.photo_id=%s and {}".format(
+                    select, join, self.visible("photos", return_hidden, return_incomplete)),
+                [photo_id])
+
+    def photos_by_ids_query(self, photo_ids, return_hidden=False, return_incomplete=False, hrefs=False):
+        """
+        Photos by list of ids query
+        :return: statement name, query and values
+        """
+        select, join = self.photo_columns(hrefs)
+        return (self.flagged("photos_by_ids_hrefs" if hrefs else "photos_by_ids", return_hidden, return_incomplete),
+                "SELECT {} FROM photos{} WHERE photos.photo_id = ANY(%s) and {} ORDER BY photos.photo_id".format(
+                    select, join, self.visible("photos", return_hidden, return_incomplete)),
+                [list(photo_ids)])
+
+    def categories_by_photos_query(self, photo_ids, return_hidden=False):
+        """
+        Categories of several photos query, rows start with photo id
+        :return: statement name, query and values
+        """
+        return (self.flagged("categories_by_photos", return_hidden),
+                """SELECT photos_categories.photo_id, {} FROM photos_categories
+                JOIN categories ON categories.category_id=photos_categories.category_id
+                WHERE photos_categories.photo_id = ANY(%s) and {}
+                ORDER BY photos_categories.photo_id, categories.category_id""".format(
+                    self.columns("categories"), self.visible("categories", return_hidden)),
+                [list(photo_ids)])
+
+    def categories_by_photo_query(self, photo_id, return_hidden=False):
+        """
+        Categories of photo query
+        :return: statement name, query and values
+        """
+        return (self.flagged("categories_by_photo", return_hidden),
+                """SELECT {} FROM photos_categories
+                JOIN categories ON categories.category_id=photos_categories.category_id
+                WHERE photos_categories.photo_id=%s and {}
+                ORDER BY categories.category_id""".format(self.columns("categories"),
+                                                          self.visible("categories", return_hidden)),
+                [photo_id])
+
+    def categories_by_ids_query(self, category_ids, return_hidden=False):
+        """
+        Categories by list of ids query
+        :return: statement name, query and values
+        """
+        return (self.flagged("categories_by_ids", return_hidden),
+                """SELECT {} FROM categories WHERE categories.category_id = ANY(%s) and {}
+                ORDER BY categories.category_id""".format(self.columns("categories"),
+                                                          self.visible("categories", return_hidden)),
+                [list(category_ids)])
+
+    def indexed_categories_by_photo_query(self, photo_id, return_hidden=False):
+        """
+        Categories of photo query planned with the membership index: categories are fetched by primary key
+        :return: statement name, query and values; None query if the photo has no categories
+        :raise ValueError: if photo id is not a number
+        """
+        category_ids = self.index.category_ids(photo_id)
+        if len(category_ids) == 0:
+            return None, None, None
+        return self.categories_by_ids_query(category_ids, return_hidden)
+
+    def indexed_categories_by_photos_query(self, photo_ids, return_hidden=False):
+        """
+        Categories of several photos query planned with the membership index: categories of all the photos are
+        fetched by primary key at once, then grouped by photo with categories_of_photos_rows
+        :return: statement name, query, values and category ids of every photo
+        """
+        categories = {int(photo_id): self.index.category_ids(photo_id) for photo_id in photo_ids}
+        name, query, values = self.categories_by_ids_query(sorted(set(itertools.chain(*categories.values()))),
+                                                           return_hidden)
+        return name, query, values, categories
+
+    @staticmethod
+    def categories_of_photos_rows(categories, columns, rows):
+        """
+        Rows of categories of several photos, as selected by categories_by_photos_query
+        :param categories: category ids of every photo
+        :param columns: columns of categories
+        :param rows: rows of categories_by_ids_query, categories that are not visible are left out
+        :return: columns and rows that start with photo id
+        """
+        found = {row[0]: tuple(row) for row in rows}
+        return ["photo_id"] + list(columns), [(photo_id,) + found[category_id] for photo_id in sorted(categories)
+                                              for category_id in categories[photo_id] if category_id in found]
+
+    def category_by_label_query(self, category_label, return_hidden=False):
+        """
+        Category by label (id or alias) query
+        :return: statement name, query and values
+        """
+        condition, values = self.category_condition(category_label)
+        return (self.flagged("category_by_" + ("alias" if "alias" in condition else "label_id"), return_hidden),
+                "select {} from categories where {} and {}".format(self.columns("categories"), condition,
+                                                                  self.visible("categories", return_hidden)),
+                values)
+
+    def photos_by_category_query(self, category_label, return_hidden=False, return_incomplete=False, hrefs=False):
+        """
+        Photos of category query, category is given by label (id or alias)
+        :return: statement name, query and values
+        """
+        condition, values = self.category_condition(category_label)
+        select, join = self.photo_columns(hrefs)
+        return (self.flagged("photos_by_category_" + ("alias" if "alias" in condition else "id") + "_hrefs" * hrefs,
+                             return_hidden, return_incomplete),
+                """SELECT {} FROM categories
+                JOIN photos_categories ON photos_categories.category_id=categories.category_id
+                JOIN photos ON photos.photo_id=photos_categories.photo_id{}
+                WHERE {} and {}
+                ORDER BY photos.photo_id""".format(select, join, condition,
+                                                   self.visible("photos", return_hidden, return_incomplete)),
+                values)
+
+    def indexed_photos_by_category_query(self, category_label, return_hidden=False, return_incomplete=False,
+                                         hrefs=False):
+        """
+        Photos of category query planned with the membership index: members of a small category are fetched
+        by primary key, larger categories and aliases missing from the index are read with the join query
+        :return: statement name, query and values; None query if the category has no photos
+        """
+        category_id = self.index.category_id(category_label)
+        if category_id is None:
+            # an alias of another process, resolved by the join itself
+            return self.photos_by_category_query(category_label, return_hidden, return_incomplete, hrefs)
+        count = self.index.count(category_id)
+        if count == 0:
+            return None, None, None
+        if count > self.index_max_photos:
+            return self.photos_by_category_query(str(category_id), return_hidden, return_incomplete, hrefs)
+        return self.photos_by_ids_query(self.index.photo_ids(category_id), return_hidden, return_incomplete, hrefs)
+
+    def gallery_index_query(self, categories=False, return_hidden=False, return_incomplete=False, limit=None,
+                            after=None, hrefs=False):
+        """
+        Photos or categories index query, ordered by id, with one extra row over limit to tell if there is a next page
+        :return: statement name, query, values and keyset column
+        """
+        if categories:
+            index_type = "categories"
+            id_column = "category_id"
+        else:
+            index_type = "photos"
+            id_column = "photo_id"
+        conditions = [self.visible(index_type, return_hidden, return_incomplete or categories)]
+        values = []
+        select, join = self.columns("categories"), ""
+        if not categories:
+            select, join = self.photo_columns(hrefs)
+        if after is not None:
+            conditions += ["{}.{} > %s".format(index_type, id_column)]
+            values += [after]
+        query = "select {} from {}{} where {} order by {}.{}".format(select, index_type, join, " and ".join(conditions),
+                                                                    index_type, id_column)
+        if limit is not None:
+            query += " limit %s"
+            values += [limit + 1]
+        # every combination of flags is a distinct query shape with its own statement
+        name = "index_" + index_type + "".join(["_hrefs" * (hrefs and not categories), "_after" * (after is not None),
+                                                "_limit" * (limit is not None)])
+        return self.flagged(name, return_hidden, return_incomplete and not categories), query, values, id_column
+
+    def photos_range_query(self, first_id, last_id, return_hidden=False, return_incomplete=False):
+        """
+        Photos with ids in a range query, ordered by id
+        :param first_id: first id of the range
+        :param last_id: id after the range
+        :return: statement name, query and values
+        """
+        return (self.flagged("photos_range", return_hidden, return_incomplete),
+                """SELECT {} FROM photos WHERE photos.photo_id >= %s and photos.photo_id < %s and {}
+                ORDER BY photos.photo_id""".format(self.columns("photos"),
+                                                     self.visible("photos", return_hidden, return_incomplete)),
+                [first_id, last_id])
+
+    def last_photo_id_query(self, return_hidden=False, return_incomplete=False):
+        """
+        Greatest photo id query, 0 if there are no photos
+        :return: statement name, query and values
+        """
+        return (self.flagged("last_photo_id", return_hidden, return_incomplete),
+                "SELECT coalesce(max(photos.photo_id), 0) FROM photos WHERE {}".format(
+                    self.visible("photos", return_hidden, return_incomplete)),
+                [])
+
+    def category_ids_query(self, category_labels):
+        """
+        Ids of categories by aliases query, labels that are ids are selected as they are
+        :param category_labels: list of category labels (ids or aliases)
+        :return: statement name, query and values
+        """
+        return ("category_ids_by_labels",
+                "select alias, category_id from categories where alias = ANY(%s)",
+                [[label for label in category_labels if self.label_id(label) is None]])
+
+    def label_ids(self, category_labels, rows):
+        """
+        Maps category labels to ids
+        :param category_labels: list of category labels (ids or aliases)
+        :param rows: (alias, category_id) rows of category_ids_query
+        :return: dict of label to category id, -1 for unknown aliases, and list of errors for them
+        """
+        aliases = dict(rows)
+        category_ids = {}
+        errors = []
+        for label in category_labels:
+            category_ids[label] = self.label_id(label)
+            if category_ids[label] is None:
+                category_ids[label] = aliases.get(label, -1)
+            if category_ids[label] == -1:
+                errors += [{"error_id": -1, "error_description": "id not found",
+                            "raw_error": "category_label {}".format(label)}]
+        return category_ids, errors
+
+    def filter_plan(self, tree, category_ids, after=None, limit=None):
+        """
+        Conditions on photos that select the ones matching an expression, to be queried in order until a page is full.
+        Ids matched on the membership index are passed in windows, so a page does not carry the whole result
+        :param tree: parsed expression
+        :param category_ids: category id of every label of the expression
+        :param after: optional - id cursor of the previous page
+        :param limit: optional - page size
+        :return: list of sql conditions and their values
+        """
+        if not (self.index_enabled and self.index.ready):
+            return [self.filter_condition(tree, category_ids)]
+        bits, complement = self.index.evaluate(tree, category_ids)
+        photo_ids = self.index.ids(bits)
+        if complement:
+            return [("NOT photos.photo_id = ANY(%s)", [photo_ids])]
+        if after is not None:
+            photo_ids = photo_ids[bisect.bisect_right(photo_ids, after):]
+        window = len(photo_ids) if limit is None else max(self.filter_window, limit + 1)
+        return [("photos.photo_id = ANY(%s)", [photo_ids[start:start + window]])
+                for start in range(0, len(photo_ids), max(window, 1))]
+
+    @classmethod
+    def filter_condition(cls, tree, category_ids):
+        """
+        Sql condition on photos that selects the ones matching an expression
+        :param tree: parsed expression
+        :param category_ids: category id of every label of the expression
+        :return: sql condition and list of its values
+        """
+        if tree[0] == "label":
+            return ("EXISTS (SELECT 1 FROM photos_categories WHERE photos_categories.photo_id=photos.photo_id "
+                    "and photos_categories.category_id=%s)"), [category_ids[tree[1]]]
+        if tree[0] == "not":
+            condition, values = cls.filter_condition(tree[1], category_ids)
+            return "NOT " + condition, values
+        left, left_values = cls.filter_condition(tree[1], category_ids)
+        right, right_values = cls.filter_condition(tree[2], category_ids)
+        return "({} {} {})".format(left, tree[0].upper(), right), left_values + right_values
+
+    def photos_filter_query(self, condition, values, return_hidden=False, return_incomplete=False, limit=None,
+                            after=None, hrefs=False):
+        """
+        Photos by filter condition query, ordered by id, with one extra row over limit to tell if there is a next page
+        :return: query and values
+        """
+        select, join = self.photo_columns(hrefs)
+        query = "SELECT {} FROM photos{} WHERE {} and {}".format(select, join, condition,
+                                                                  self.visible("photos", return_hidden, return_incomplete))
+        values = list(values)
+        if after is not None:
+            query += " and photos.photo_id > %s"
+            values += [after]
+        query += " ORDER BY photos.photo_id"
+        if limit is not None:
+            query += " LIMIT %s"
+            values += [limit + 1]
+        return query, values
+
+    def search_query(self, terms, categories=False, return_hidden=False, return_incomplete=False, limit=100,
+                     after=None, hrefs=False):
+        """
+        Ranked full-text search query over the stored search documents,
+        with one extra row over limit to tell if there is a next page
+        :return: statement name, query, values and id column
+        """
+        if categories:
+            table, id_column = "categories", "category_id"
+            select, join = self.columns("categories"), ""
+        else:
+            table, id_column = "photos", "photo_id"
+            select, join = self.photo_columns(hrefs)
+        # double precision, so both drivers read the rank and format cursors exactly
+        rank = "ts_rank({}.search_document, search)::float8".format(table)
+        conditions = ["{}.search_document @@ search".format(table),
+                      self.visible(table, return_hidden, return_incomplete or categories)]
+        values = [" & ".join(term + ":*" for term in terms)]
+        if after is not None:
+            conditions += ["({} < %s or ({} = %s and {}.{} > %s))".format(rank, rank, table, id_column)]
+            values += [after[0], after[0], after[1]]
+        values += [limit + 1]
+        query = """SELECT {}, {} AS rank FROM {}{}, to_tsquery('simple', %s) search WHERE {}
+                ORDER BY rank DESC, {}.{} LIMIT %s""".format(select, rank, table, join, " and ".join(conditions),
+                                                             table, id_column)
+        name = self.flagged("search_" + table + "_hrefs" * (hrefs and not categories) + "_after" * (after is not None),
+                            return_hidden, return_incomplete and not categories)
+        return name, query, values, id_column
+
+    @staticmethod
+    def search_cursor(after):
+        """
+        Formats search keyset cursor
+        :param after: (rank, id) or None
+        :return: "rank:id" string or None
+        """
+        return None if after is None else "{!r}:{}".format(float(after[0]), after[1])
+
+    def timeline_conditions(self, date_from, date_to, return_hidden, return_incomplete):
+        """
+        Conditions of photos taken within a date range, matching the partial index of public photos by date taken
+        :return: list of sql conditions, their values and statement name suffix
+        """
+        conditions = ["photos.date_taken IS NOT NULL", self.visible("photos", return_hidden, return_incomplete)]
+        values = []
+        if date_from is not None:
+            conditions += ["photos.date_taken >= %s"]
+            values += [date_from]
+        if date_to is not None:
+            conditions += ["photos.date_taken < %s"]
+            values += [date_to]
+        return conditions, values, "_from" * (date_from is not None) + "_to" * (date_to is not None)
+
+    def timeline_query(self, date_from=None, date_to=None, return_hidden=False, return_incomplete=False, limit=None,
+                       after=None, hrefs=False):
+        """
+        Photos within a date range query, ordered by date taken and id,
+        with one extra row over limit to tell if there is a next page
+        :return: statement name, query and values
+        """
+        select, join = self.photo_columns(hrefs)
+        conditions, values, suffix = self.timeline_conditions(date_from, date_to, return_hidden, return_incomplete)
+        if after is not None:
+            conditions += ["(photos.date_taken, photos.photo_id) > (%s, %s)"]
+            values += list(after)
+        query = "SELECT {} FROM photos{} WHERE {} ORDER BY photos.date_taken, photos.photo_id".format(
+            select, join, " and ".join(conditions))
+        if limit is not None:
+            query += " LIMIT %s"
+            values += [limit + 1]
+        name = self.flagged("timeline" + suffix + "".join(["_hrefs" * hrefs, "_after" * (after is not None),
+                                                           "_limit" * (limit is not None)]),
+                            return_hidden, return_incomplete)
+        return name, query, values
+
+    def timeline_counts_query(self, group, date_from=None, date_to=None, return_hidden=False, return_incomplete=False):
+        """
+        Numbers of photos per period query. Periods run between the first and the last date taken, which the index
+        of public photos by date taken gives at once, and every period is counted by a range scan of that index,
+        so rows are neither fetched nor sorted; periods without photos are left out
+        :param group: one of timeline_groups
+        :return: statement name, query and values
+        """
+        conditions, values, suffix = self.timeline_conditions(date_from, date_to, return_hidden, return_incomplete)
+        condition = " and ".join(conditions)
+        query = """SELECT to_char(period, %s) AS period, counts.count FROM
+                (SELECT min(photos.date_taken) AS first, max(photos.date_taken) AS last FROM photos WHERE {}) bounds,
+                generate_series(date_trunc(%s, bounds.first), bounds.last, ('1 ' || %s)::interval) period,
+                LATERAL (SELECT count(*) AS count FROM photos WHERE {} and photos.date_taken >= period
+                and photos.date_taken < period + ('1 ' || %s)::interval) counts
+                WHERE counts.count > 0 ORDER BY period""".format(condition, condition)
+        return (self.flagged("timeline_counts" + suffix, return_hidden, return_incomplete), query,
+                [self.timeline_groups[group]] + values + [group, group] + values + [group])
+
+    @staticmethod
+    def timeline_date(value):
+        """
+        Formats date range bound for request info
+        :param value: datetime or None
+        :return: iso formatted date or None
+        """
+        return None if value is None else value.isoformat()
+
+    @staticmethod
+    def timeline_cursor(after):
+        """
+        Formats timeline keyset cursor
+        :param after: (date taken, id) or None
+        :return: "date:id" string or None
+        """
+        return None if after is None else "{}:{}".format(after[0].isoformat(), after[1])
+
+    def photo_columns(self, hrefs):
+        """
+        Select list and join of photos queries, optionally with hrefs of photos.
+        Hrefs that are older than their ttl are returned as null, so readers never get an expired href
+        :param hrefs: if hrefs should be selected
+        :return: select list and join clause
+        """
+        if not hrefs:
+            return self.columns("photos"), ""
+        fresh = "hrefs.fetched_at > now() - make_interval(secs => {:f})".format(self.href_ttl)
+        select = ", ".join([self.columns("photos")] + ["CASE WHEN {} THEN hrefs.{} END AS {}".format(fresh, column, column)
+                                           for column in ("href_preview", "href_medium", "href_large")])
+        return select, " LEFT JOIN hrefs ON hrefs.photo_id=photos.photo_id"
+
+    @staticmethod
+    def columns(table):
+        """
+        Select list of columns returned by reads of a table
+        :param table: photos or categories
+        :return: qualified column names
+        """
+        return ", ".join("{}.{}".format(table, column) for column in COLUMNS[table])
+
+    @staticmethod
+    def label_id(category_label):
+        """
+        Category id of a label that is an id
+        :param category_label: category label
+        :return: category id, None if the label is an alias
+        """
+        try:
+            return int(category_label)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def category_condition(category_label):
+        """
+        Condition on categories table that selects category by its label (id or alias)
+        :param category_label: category label
+        :return: sql condition and list of its values
+        """
+        try:
+            return "categories.category_id=%s", [int(category_label)]
+        except ValueError:
+            return "categories.alias=%s", [category_label]
+
+    def stream_query(self, responser, query, values, id_column=None, limit=None):
+        """
+        Streams rows of query through the responser. The stream checks out its own connection when it is started
+        and returns it to the pool when it is exhausted or closed, a stream that is closed before it is started
+        (e.g. the body of a HEAD request) holds no connection. Errors are reported in the tail of the stream
+        :param responser: responser of the calling method
+        :param query: select query
+        :param values: query values
+        :param id_column: optional - keyset column for next_cursor
+        :param limit: optional - page size; the query is expected to select one extra row
+        :return: generator of json chunks
+        """
+        # the pool may be replaced by a config reload meanwhile, the connection goes back where it came from
+        return self.stream_chunks(responser, self.pool, self.cursor.query, query, values, id_column, limit)
+
+    def stream_chunks(self, responser, pool, method, query, values, id_column, limit):
+        """
+        Yields json parts of rows fetched in chunks from a named (server-side) cursor, then closes it
+        and returns the connection to the pool
+        :param method: name of the calling Databaser method, statements are measured under it
+        :return: generator of json prepared response parts
+        """
+        yield responser.stream_head()
+        try:
+            connection = pool.getconn()
+        except Exception as e:
+            print(e)
+            responser.errors += [{"error_id": -3, "error_description": "database connection issue",
+                                  "raw_error": str(e)}]
+            yield responser.stream_tail()
+            return
+        first = True
+        sent = 0
+        last_row = None
+        cursor = None
+        try:
+            cursor = connection.cursor(name="stream_{}".format(next(self.stream_names)),
+                                       cursor_factory=MeasuredCursor)
+            cursor.query = method
+            cursor.itersize = self.stream_chunk_size
+            cursor.execute(query, values)
+            rows = cursor.fetchmany(self.stream_chunk_size)
+            columns = [desc[0] for desc in cursor.description]
+            while len(rows) > 0:
+                if limit is not None and sent + len(rows) > limit:
+                    # the extra row only marks that there is a next page
+                    rows = rows[:limit - sent]
+                    if len(rows) > 0:
+                        last_row = rows[-1]
+                        yield responser.stream_part(columns, rows, first)
+                    responser.next_cursor = last_row[columns.index(id_column)]
+                    break
+                sent += len(rows)
+                last_row = rows[-1]
+                yield responser.stream_part(columns, rows, first)
+                first = False
+                rows = cursor.fetchmany(self.stream_chunk_size)
+        except Exception as e:
+            print(e)
+            responser.errors += [{"error_id": -2, "error_description": "database communication issue",
+                                  "raw_error": str(e)}]
+        finally:
+            try:
+                if cursor is not None:
+                    cursor.close()
+                connection.rollback()
+            except Exception as e:
+                print(e)
+            pool.putconn(connection)
+        yield responser.stream_tail()
+
+    def current_columns_names(self):
+        """
+        Columns of database request
+        :return: list of columns after a database request
+        """
+        return [desc[0] for desc in self.cursor.description]
+
+    def check_connection(self):
+        """
+        Checks connection with database
+        :return: connection status
+        """
+        if self.connection is None or self.connection.closed:
+            return False
+        return True
+
+
+class Versioner(threading.Thread):
+    def __init__(self, database):
+        """
+        Background thread that reads versions of the database, picking up writes of other processes
+        :param database: Databaser instance
+        """
+        super().__init__(name="data-versioner", daemon=True)
+        self.database = database
+        self.interval = None
+        self.woken = threading.Event()
+        self.stopped = threading.Event()
+        self.reconfigure(Configurator())
+        Configurator.subscribe(self.reconfigure)
+
+    def reconfigure(self, config):
+        """
+        Applies poll interval of the reloaded config, the current wait is restarted with it
+        :param config: Configurator
+        """
+        interval = config.data_version()["poll_interval"]
+        if interval != self.interval:
+            self.interval = interval
+            self.woken.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            # a zero interval disables polling, the thread waits for another interval or stop
+            woken = self.woken.wait(self.interval if self.interval > 0 else None)
+            self.woken.clear()
+            if woken:
+                continue
+            try:
+                self.database.read_version()
+                # the index outdated by writes of other processes is rebuilt right away, reads use joins meanwhile
+                if self.database.index_enabled and not self.database.index.ready:
+                    self.database.build_index()
+            except Exception as e:
+                print(e)
+
+    def stop(self):
+        """
+        Stops reading
+        """
+        self.stopped.set()
+        self.woken.set()
@@ -0,0 +1,337 @@
+"""
+Static snapshot of the public gallery, for a cdn or web server to serve without the application:
+
+    index/photos.json             shards of the photos index and their sizes
+    index/photos/<shard>.json     public photos with ids from shard * shard_size up to the next shard
+    index/categories.json         public categories index
+    categories/<category_id>.json public photos of a category
+    photos/<shard>/<photo_id>.json public photo
+
+Files are formatted as the responses of the corresponding client requests, without hrefs, which expire.
+Every file has a .gz sibling for precompressed serving. Files are replaced atomically and only if their content
+changed, so unchanged files keep their modification times and cached copies.
+
+Run from the repository root to export once: python exporter.py [directory]
+"""
+import gzip
+import os
+import shutil
+import sys
+import threading
+import time
+from config import Configurator
+from responses import Responser
+
+
+class Exporter(threading.Thread):
+    def __init__(self, database):
+        """
+        Background thread that keeps the static snapshot up to date. After writes only files of changed entries,
+        found by the cache tags of the writes, are regenerated; the whole snapshot is compared at startup
+        and every full_interval, which picks up writes of other processes
+        :param database: Databaser instance
+        """
+        super().__init__(name="static-exporter", daemon=True)
+        self.database = database
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        self.stopped = threading.Event()
+        self.tags = set()
+        self.full = True
+        # monotonic time of the last full export
+        self.exported_at = 0.0
+        # exported shards and their sizes, ids of exported categories
+        self.shards = {}
+        self.categories = set()
+        self.written = 0
+        self.removed = 0
+        self.directory = None
+        self.shard_size = None
+        self.enabled = False
+        self.reconfigure(Configurator())
+        Configurator.subscribe(self.reconfigure)
+        self.changed.set()
+
+    def reconfigure(self, config):
+        """
+        Applies export settings of the reloaded config, a new directory or shard size is exported in full.
+        Changes are collected only while the export is enabled, it is exported in full when enabled again
+        :param config: Configurator
+        """
+        export = config.static_export()
+        if export["enabled"] and not self.enabled:
+            self.database.subscribe(self.data_changed)
+        elif self.enabled and not export["enabled"]:
+            self.database.unsubscribe(self.data_changed)
+        with self.lock:
+            if export["enabled"] != self.enabled:
+                self.tags = set()
+                self.full = True
+                self.changed.set()
+            if (export["directory"], export["shard_size"]) != (self.directory, self.shard_size):
+                self.full = True
+                self.changed.set()
+            self.enabled = export["enabled"]
+            self.directory = export["directory"]
+            self.shard_size = export["shard_size"]
+        self.delay = export["delay"]
+        self.full_interval = export["full_interval"]
+        self.gzip_level = export["gzip_level"]
+
+    def data_changed(self, tags):
+        """
+        Collects tags of committed changes for the next export
+        :param tags: tags of changed data
+        """
+        with self.lock:
+            self.tags.update(tags)
+        self.changed.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            timeout = None
+            if self.full_interval > 0 and self.enabled:
+                timeout = max(self.exported_at + self.full_interval - time.monotonic(), 0)
+            self.changed.wait(timeout)
+            # writes of a burst are exported together
+            if self.stopped.wait(self.delay):
+                return
+            self.changed.clear()
+            if not self.enabled:
+                continue
+            try:
+                self.export()
+            except Exception as e:
+                print(e)
+
+    def stop(self):
+        """
+        Stops exporting after the current export
+        """
+        self.stopped.set()
+        self.changed.set()
+
+    def export(self):
+        """
+        Regenerates files of entries changed since the previous export, or the whole snapshot if it is due.
+        A failed export is redone in full
+        :return: numbers of written and removed files
+        """
+        with self.lock:
+            tags, self.tags = self.tags, set()
+            full = self.full or 0 < self.full_interval <= time.monotonic() - self.exported_at
+            self.full = False
+            directory, shard_size = self.directory, self.shard_size
+        if directory == "":
+            raise ValueError("static export directory is not configured")
+        self.written = self.removed = 0
+        try:
+            if full:
+                self.export_all(directory, shard_size)
+            else:
+                self.export_changed(directory, shard_size, tags)
+        except Exception:
+            with self.lock:
+                self.full = True
+            raise
+        return self.written, self.removed
+
+    def export_all(self, directory, shard_size):
+        """
+        Compares the whole snapshot with the database, files of deleted and hidden entries are removed
+        :param directory: snapshot directory
+        :param shard_size: photos index shard size
+        """
+        started = time.monotonic()
+        (last_id,), = self.database.export_rows(*self.database.last_photo_id_query())[1]
+        self.shards = {}
+        shards = range(last_id // shard_size + 1)
+        for shard in shards:
+            self.export_shard(directory, shard_size, shard)
+        self.prune(os.path.join(directory, "index", "photos"), ["{}.json".format(shard) for shard in self.shards])
+        photos = os.path.join(directory, "photos")
+        for name in os.listdir(photos) if os.path.isdir(photos) else []:
+            if name.isdigit() and int(name) not in shards:
+                shutil.rmtree(os.path.join(photos, name), ignore_errors=True)
+        self.export_shards(directory, shard_size)
+        self.export_categories(directory)
+        for category_id in self.categories:
+            self.export_category(directory, category_id)
+        self.prune(os.path.join(directory, "categories"),
+                   ["{}.json".format(category_id) for category_id in self.categories])
+        self.exported_at = started
+
+    def export_changed(self, directory, shard_size, tags):
+        """
+        Regenerates files of entries of changed data tags. Photos are exported with the whole shard of their ids
+        :param directory: snapshot directory
+        :param shard_size: photos index shard size
+        :param tags: tags of changed data
+        """
+        shards = {photo_id // shard_size for photo_id in self.tagged(tags, "photo")}
+        for shard in sorted(shards):
+            self.export_shard(directory, shard_size, shard)
+        if len(shards) > 0:
+            self.export_shards(directory, shard_size)
+        if "categories_index" in tags:
+            self.export_categories(directory)
+        for category_id in sorted(self.tagged(tags, "category", "photos_of_category")):
+            if category_id in self.categories:
+                self.export_category(directory, category_id)
+            else:
+                self.remove(os.path.join(directory, "categories", "{}.json".format(category_id)))
+
+    def export_shard(self, directory, shard_size, shard):
+        """
+        Exports photos index shard and files of its photos
+        :param directory: snapshot directory
+        :param shard_size: photos index shard size
+        :param shard: shard number
+        """
+        columns, rows = self.database.export_rows(*self.database.photos_range_query(shard * shard_size,
+                                                                                    (shard + 1) * shard_size))
+        folder = os.path.join(directory, "photos", str(shard))
+        for row in rows:
+            responser = Responser()
+            responser.request = {"photo_id": str(row[0]), "expected": "photo by id"}
+            self.write(os.path.join(folder, "{}.json".format(row[0])), responser.json_response(columns, row))
+        self.prune(folder, ["{}.json".format(row[0]) for row in rows])
+        path = os.path.join(directory, "index", "photos", "{}.json".format(shard))
+        if len(rows) == 0:
+            self.shards.pop(shard, None)
+            self.remove(path)
+            return
+        self.shards[shard] = len(rows)
+        responser = Responser()
+        responser.request = {"expected": "photos index", "shard": shard}
+        self.write(path, responser.json_response(columns, rows))
+
+    def export_shards(self, directory, shard_size):
+        """
+        Exports list of photos index shards
+        :param directory: snapshot directory
+        :param shard_size: photos index shard size
+        """
+        responser = Responser()
+        responser.request = {"expected": "photos index shards", "shard_size": shard_size}
+        self.write(os.path.join(directory, "index", "photos.json"),
+                   responser.json_response(["shard", "count"], sorted(self.shards.items())))
+
+    def export_categories(self, directory):
+        """
+        Exports categories index and remembers ids of public categories
+        :param directory: snapshot directory
+        """
+        name, query, values, _ = self.database.gallery_index_query(categories=True)
+        columns, rows = self.database.export_rows(name, query, values)
+        self.categories = {row[0] for row in rows}
+        responser = Responser()
+        responser.request = {"expected": "categories index"}
+        self.write(os.path.join(directory, "index", "categories.json"), responser.json_response(columns, rows))
+
+    def export_category(self, directory, category_id):
+        """
+        Exports photos of category, a category without public photos has an empty list
+        :param directory: snapshot directory
+        :param category_id: category id
+        """
+        columns, rows = self.database.export_rows(*self.database.photos_by_category_query(category_id))
+        responser = Responser()
+        responser.request = {"category_label": str(category_id), "expected": "photos by category"}
+        self.write(os.path.join(directory, "categories", "{}.json".format(category_id)),
+                   responser.json_response(columns, rows))
+
+    def write(self, path, content):
+        """
+        Replaces file and its .gz sibling atomically, unless the file has the same content already
+        :param path: file path
+        :param content: json text
+        """
+        data = content.encode()
+        try:
+            with open(path, "rb") as file:
+                if file.read() == data and os.path.exists(path + ".gz"):
+                    return
+        except OSError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the sibling goes first, a reader of the new file never gets a stale .gz
+        self.replace(path + ".gz", gzip.compress(data, self.gzip_level, mtime=0))
+        self.replace(path, data)
+        self.written += 1
+
+    @staticmethod
+    def replace(path, data):
+        """
+        Writes file to a hidden temporary file in the same directory and renames it over the path
+        :param path: file path
+        :param data: file content
+        """
+        folder, name = os.path.split(path)
+        temporary = os.path.join(folder, ".{}.{}.tmp".format(name, os.getpid()))
+        try:
+            with open(temporary, "wb") as file:
+                file.write(data)
+            os.replace(temporary, path)
+        except OSError:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    def remove(self, path):
+        """
+        Removes file and its .gz sibling if they exist
+        :param path: file path
+        """
+        removed = False
+        for name in (path, path + ".gz"):
+            try:
+                os.remove(name)
+                removed = True
+            except FileNotFoundError:
+                pass
+        self.removed += removed
+
+    def prune(self, folder, names):
+        """
+        Removes files that do not belong to the snapshot from a folder, temporary files are left to their writers
+        :param folder: snapshot folder
+        :param names: names of files that belong to the folder, without .gz siblings
+        """
+        listed = os.listdir(folder) if os.path.isdir(folder) else []
+        stale = {name[:-3] if name.endswith(".gz") else name for name in listed if not name.startswith(".")}
+        for name in stale - set(names):
+            self.remove(os.path.join(folder, name))
+
+    @staticmethod
+    def tagged(tags, *kinds):
+        """
+        Ids in data tags of given kinds, tags of aliases are skipped
+        :param tags: tags of changed data
+        :param kinds: tag kinds, e.g. photo
+        :return: set of ids
+        """
+        ids = set()
+        for tag in tags:
+            kind, _, label = tag.partition(":")
+            if kind in kinds and label.isdigit():
+                ids.add(int(label))
+        return ids
+
+
+def main():
+    from db import Databaser
+
+    exporter = Exporter(Databaser())
+    if len(sys.argv) > 1:
+        exporter.directory = sys.argv[1]
+    if exporter.directory == "":
+        sys.exit("static export directory is neither configured nor given")
+    started = time.monotonic()
+    written, removed = exporter.export()
+    print("exported to {}: {} files written, {} removed in {:.1f}s".format(
+        exporter.directory, written, removed, time.monotonic() - started))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import re
+
+TOKENS = re.compile(r"\(|\)|[^\s()]+")
+OPERATORS = ("and", "or", "not")
+# bounds the size of parsed trees and of the queries compiled from them
+MAX_TOKENS = 64
+
+
+def parse(expression):
+    """
+    Parses boolean expression over category labels (ids or aliases), e.g. "landscape and 2023 and not drafts".
+    Operators are and, or, not in any case, in order of precedence not, and, or; parentheses group
+    :param expression: expression text
+    :return: tree of tuples: ("label", label), ("not", node), ("and", left, right), ("or", left, right)
+    :raise ValueError: if expression is empty, malformed or too long
+    """
+    tokens = TOKENS.findall(expression or "")
+    if not 0 < len(tokens) <= MAX_TOKENS:
+        raise ValueError("expression length out of range")
+    tree, position = parse_or(tokens, 0)
+    if position != len(tokens):
+        raise ValueError("unexpected {}".format(tokens[position]))
+    return tree
+
+
+def parse_or(tokens, position):
+    left, position = parse_and(tokens, position)
+    while position < len(tokens) and tokens[position].lower() == "or":
+        right, position = parse_and(tokens, position + 1)
+        left = ("or", left, right)
+    return left, position
+
+
+def parse_and(tokens, position):
+    left, position = parse_not(tokens, position)
+    while position < len(tokens) and tokens[position].lower() == "and":
+        right, position = parse_not(tokens, position + 1)
+        left = ("and", left, right)
+    return left, position
+
+
+def parse_not(tokens, position):
+    if position >= len(tokens):
+        raise ValueError("unexpected end of expression")
+    token = tokens[position]
+    if token.lower() == "not":
+        node, position = parse_not(tokens, position + 1)
+        return ("not", node), position
+    if token == "(":
+        node, position = parse_or(tokens, position + 1)
+        if position >= len(tokens) or tokens[position] != ")":
+            raise ValueError("unbalanced parentheses")
+        return node, position + 1
+    if token == ")" or token.lower() in OPERATORS:
+        raise ValueError("unexpected {}".format(token))
+    return ("label", token), position + 1
+
+
+def labels(tree):
+    """
+    Category labels of parsed expression
+    :param tree: parsed expression
+    :return: list of unique labels in order of appearance
+    """
+    if tree[0] == "label":
+        return [tree[1]]
+    found = []
+    for node in tree[1:]:
+        found += [label for label in labels(node) if label not in found]
+    return found
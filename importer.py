@@ -0,0 +1,84 @@
+import csv
+import datetime
+import io
+import json
+
+# fields of an imported photo, as of the insert photo master request, and aliases of its categories
+FIELDS = ("name", "description", "timestamp", "hidden", "categories")
+FLAGS = {"": False, "0": False, "false": False, "1": True, "true": True}
+# escapes of the text format of COPY
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def records(stream, csv_format=False):
+    """
+    Reads rows of an import body one by one, without loading the whole body
+    :param stream: binary stream of json lines, or of csv with a header line of FIELDS
+    :param csv_format: if the body is csv
+    :return: generator of (row number, record): json text for json lines, dict for csv; rows are numbered from 1,
+    csv header and blank lines are not counted
+    :raise UnicodeDecodeError, csv.Error: if the body is not utf-8 text or not csv
+    """
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="" if csv_format else None)
+    if csv_format:
+        for number, record in enumerate(csv.DictReader(text), 1):
+            yield number, record
+        return
+    number = 0
+    for line in text:
+        if line.strip() != "":
+            number += 1
+            yield number, line
+
+
+def photo(record):
+    """
+    Validates imported photo. Empty csv values stand for missing ones, csv categories are separated by spaces
+    :param record: record of records
+    :return: name, description, date taken, hidden flag and list of unique category aliases
+    :raise ValueError: with the reason the row is rejected
+    """
+    if isinstance(record, str):
+        record = json.loads(record)
+        if not isinstance(record, dict):
+            raise ValueError("row is not an object")
+    elif None in record:
+        raise ValueError("more values than columns")
+    else:
+        record = {key: value for key, value in record.items() if value not in ("", None)}
+        if "categories" in record:
+            record["categories"] = record["categories"].split()
+    unknown = sorted(set(record) - set(FIELDS))
+    if unknown:
+        raise ValueError("unknown field " + unknown[0])
+    name, description = record.get("name"), record.get("description")
+    if not isinstance(name, str) or name.strip() == "":
+        raise ValueError("name is required")
+    if description is not None and not isinstance(description, str):
+        raise ValueError("description is not a string")
+    timestamp = record.get("timestamp")
+    if timestamp is not None:
+        if not isinstance(timestamp, str):
+            raise ValueError("timestamp is not a string")
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+    hidden = record.get("hidden", False)
+    if isinstance(hidden, str):
+        hidden = FLAGS.get(hidden.strip().lower())
+    if not isinstance(hidden, bool):
+        raise ValueError("hidden is not a flag")
+    aliases = record.get("categories", [])
+    if not isinstance(aliases, list) or not all(isinstance(alias, str) for alias in aliases):
+        raise ValueError("categories is not a list of aliases")
+    if any("\x00" in text for text in [name, description or ""] + aliases):
+        raise ValueError("text contains null character")
+    return name, description, timestamp, hidden, list(dict.fromkeys(aliases))
+
+
+def copy_line(values):
+    """
+    Formats row of the text format of COPY
+    :param values: row values, None for null
+    :return: line
+    """
+    return "\t".join("\\N" if value is None else value.translate(COPY_ESCAPES) if isinstance(value, str) else str(value)
+                     for value in values) + "\n"
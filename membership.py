@@ -0,0 +1,335 @@
+import collections
+import itertools
+import operator
+import re
+import threading
+from array import array
+from config import Configurator
+
+# positions of set bits of every byte value
+BYTE_BITS = [tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)]
+NONZERO = re.compile(b"[^\x00]")
+# categories with less than one photo per this many ids up to their largest one keep sorted arrays of 4 byte ids,
+# denser ones keep bitsets of an eighth of a byte per id, whichever is smaller
+SPARSE_RATIO = 32
+
+
+class Indexer:
+    def __init__(self):
+        """
+        In-memory index of category membership: photo ids per category, category ids per photo and category id
+        per alias.
+        Photos of dense categories are kept as bitsets, Python integers with bit n standing for photo id n,
+        so set operations run in C; sparse categories are kept as sorted arrays of ids and turned into bitsets
+        only while an expression is evaluated. Categories of photos are kept in one array ordered by photo,
+        with offsets of every photo id; photos changed since the build are kept aside until the next one
+        """
+        self.lock = threading.Lock()
+        self.photos_of_category = {}
+        self.categories_of_photos = array("I")
+        self.photo_offsets = array("I", [0])
+        self.changed_photos = {}
+        self.category_of_alias = {}
+        self.ready = False
+        # updates committed while a build is loading, replayed over the loaded snapshot
+        self.pending = None
+        # if writes of other processes were seen while a build was loading, its snapshot may miss them
+        self.outdated = False
+
+    def begin(self):
+        """
+        Starts recording updates before the bulk query of a build
+        """
+        with self.lock:
+            self.pending = []
+            self.outdated = False
+
+    def build(self, pairs, aliases=()):
+        """
+        Replaces the index with assignments and aliases loaded in bulk, then replays updates recorded since begin
+        :param pairs: list of (photo_id, category_id), ordered by photo id and category id
+        :param aliases: list of (alias, category_id)
+        """
+        photos_of_category = {category_id: self.packed(photo_ids)
+                              for category_id, photo_ids in self.grouped(pairs, 1, 0).items()}
+        categories_of_photos = array("I", map(operator.itemgetter(1), pairs))
+        counts = collections.Counter(map(operator.itemgetter(0), pairs))
+        # categories of photo n start after the categories of the photos before it
+        photo_ids = range(pairs[-1][0] + 1 if len(pairs) > 0 else 0)
+        photo_offsets = array("I", itertools.accumulate(map(counts.get, photo_ids, itertools.repeat(0)), initial=0))
+        with self.lock:
+            pending, self.pending = self.pending or [], None
+            self.photos_of_category = photos_of_category
+            self.categories_of_photos, self.photo_offsets = categories_of_photos, photo_offsets
+            self.changed_photos = {}
+            self.category_of_alias = dict(aliases)
+            for removed, added, renamed in pending:
+                self.apply(removed, added, renamed)
+            self.ready = not self.outdated
+
+    def cancel(self):
+        """
+        Stops recording updates after a failed build, the previous index stays in use
+        """
+        with self.lock:
+            self.pending = None
+
+    def invalidate(self):
+        """
+        Marks the index outdated by writes of other processes, reads go to the database until it is rebuilt
+        """
+        with self.lock:
+            self.ready = False
+            self.outdated = self.pending is not None
+
+    def update(self, removed=(), added=(), renamed=()):
+        """
+        Applies committed changes of assignments, removals first, and of aliases
+        :param removed: list of deleted (photo_id, category_id)
+        :param added: list of assigned (photo_id, category_id)
+        :param renamed: list of (old alias or None, new alias, category_id)
+        """
+        with self.lock:
+            if self.pending is not None:
+                self.pending += [(removed, added, renamed)]
+            self.apply(removed, added, renamed)
+
+    def apply(self, removed, added, renamed=()):
+        """
+        Applies changes of assignments and aliases, the lock is held by the caller
+        """
+        for category_id, photo_ids in self.grouped(removed, 1, 0).items():
+            members = self.photos_of_category.get(category_id, 0)
+            if isinstance(members, int):
+                members = self.repacked(members & ~self.bitset(photo_ids))
+            else:
+                members = self.packed(sorted(set(members).difference(photo_ids)))
+            self.photos_of_category[category_id] = members
+        for category_id, photo_ids in self.grouped(added, 1, 0).items():
+            members = self.photos_of_category.get(category_id, 0)
+            if isinstance(members, int):
+                members = self.repacked(members | self.bitset(photo_ids))
+            else:
+                members = self.packed(sorted(set(members).union(photo_ids)))
+            self.photos_of_category[category_id] = members
+        for photo_id, category_ids in self.grouped(removed, 0, 1).items():
+            self.changed_photos[photo_id] = tuple(sorted(set(self.categories_of(photo_id)).difference(category_ids)))
+        for photo_id, category_ids in self.grouped(added, 0, 1).items():
+            self.changed_photos[photo_id] = tuple(sorted(set(self.categories_of(photo_id)).union(category_ids)))
+        for old_alias, alias, category_id in renamed:
+            if self.category_of_alias.get(old_alias) == category_id:
+                del self.category_of_alias[old_alias]
+            self.category_of_alias[alias] = category_id
+
+    def bits(self, category_id):
+        """
+        Bitset of photos of category
+        :param category_id: category id
+        :return: integer bitset, 0 for unknown categories
+        """
+        with self.lock:
+            return self.as_bits(self.photos_of_category.get(int(category_id), 0))
+
+    def photo_ids(self, category_id):
+        """
+        Photos of category
+        :param category_id: category id
+        :return: ascending list of photo ids
+        """
+        with self.lock:
+            members = self.photos_of_category.get(int(category_id), 0)
+        return self.ids(members) if isinstance(members, int) else list(members)
+
+    def category_ids(self, photo_id):
+        """
+        Categories of photo
+        :param photo_id: photo id
+        :return: ascending list of category ids
+        """
+        with self.lock:
+            return list(self.categories_of(int(photo_id)))
+
+    def categories_of(self, photo_id):
+        """
+        Categories of photo, the lock is held by the caller
+        :return: ascending sequence of category ids
+        """
+        if photo_id in self.changed_photos:
+            return self.changed_photos[photo_id]
+        if not 0 <= photo_id < len(self.photo_offsets) - 1:
+            return ()
+        return self.categories_of_photos[self.photo_offsets[photo_id]:self.photo_offsets[photo_id + 1]]
+
+    def count(self, category_id):
+        """
+        Number of photos of category
+        :param category_id: category id
+        :return: number of photos, 0 for unknown categories
+        """
+        with self.lock:
+            members = self.photos_of_category.get(int(category_id), 0)
+        return members.bit_count() if isinstance(members, int) else len(members)
+
+    def category_id(self, category_label):
+        """
+        Category id by label
+        :param category_label: category label (id or alias)
+        :return: category id, None for aliases that are not indexed
+        """
+        try:
+            return int(category_label)
+        except ValueError:
+            with self.lock:
+                return self.category_of_alias.get(category_label)
+
+    def evaluate(self, tree, category_ids):
+        """
+        Photos matching a boolean expression over categories.
+        Negations are kept as complements, so only a negation of the whole expression needs the set of all photos
+        :param tree: parsed expression, see expressions.parse
+        :param category_ids: category id of every label of the expression, -1 for unknown labels
+        :return: bitset and if it is a complement - matching photos are the ones not in it
+        """
+        with self.lock:
+            return self.evaluated(tree, category_ids)
+
+    def evaluated(self, tree, category_ids):
+        """
+        Evaluates expression node, the lock is held by the caller
+        :return: bitset and if it is a complement
+        """
+        if tree[0] == "label":
+            return self.as_bits(self.photos_of_category.get(category_ids[tree[1]], 0)), False
+        if tree[0] == "not":
+            bits, complement = self.evaluated(tree[1], category_ids)
+            return bits, not complement
+        left, left_complement = self.evaluated(tree[1], category_ids)
+        right, right_complement = self.evaluated(tree[2], category_ids)
+        if left_complement and not right_complement:
+            left, left_complement, right, right_complement = right, right_complement, left, left_complement
+        if tree[0] == "and":
+            if not left_complement and not right_complement:
+                return left & right, False
+            if not left_complement:
+                return left & ~right, False
+            return left | right, True
+        if not left_complement and not right_complement:
+            return left | right, False
+        if not left_complement:
+            return right & ~left, True
+        return left & right, True
+
+    @staticmethod
+    def grouped(pairs, key, value):
+        """
+        Groups pairs by one of their elements
+        :return: dict of key element to list of value elements
+        """
+        groups = {}
+        for pair in pairs:
+            groups.setdefault(pair[key], []).append(pair[value])
+        return groups
+
+    @classmethod
+    def packed(cls, ids):
+        """
+        Packs ids into the smaller of a sorted array and a bitset
+        :param ids: ascending list of non-negative ids
+        :return: array of ids or integer bitset
+        """
+        if len(ids) == 0 or len(ids) * SPARSE_RATIO <= ids[-1]:
+            return array("I", ids)
+        return cls.bitset(ids)
+
+    @classmethod
+    def repacked(cls, bits):
+        """
+        Turns a bitset that became sparse into an array
+        :param bits: integer bitset
+        :return: array of ids or the bitset
+        """
+        if bits.bit_count() * SPARSE_RATIO <= bits.bit_length() - 1:
+            return array("I", cls.ids(bits))
+        return bits
+
+    @classmethod
+    def as_bits(cls, members):
+        """
+        Bitset of photos of category
+        :param members: array of ids or integer bitset
+        :return: integer bitset
+        """
+        return members if isinstance(members, int) else cls.bitset(members)
+
+    @staticmethod
+    def bitset(ids):
+        """
+        Packs ids into a bitset
+        :param ids: list of non-negative ids
+        :return: integer bitset
+        """
+        if len(ids) == 0:
+            return 0
+        array = bytearray(max(ids) // 8 + 1)
+        for unit_id in ids:
+            array[unit_id // 8] |= 1 << unit_id % 8
+        return int.from_bytes(array, "little")
+
+    @staticmethod
+    def ids(bits):
+        """
+        Unpacks bitset; zero bytes are skipped by the regex engine, so the cost follows the number of set bits
+        :param bits: integer bitset
+        :return: ascending list of ids of set bits
+        """
+        data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+        ids = []
+        for match in NONZERO.finditer(data):
+            position = match.start()
+            ids += [position * 8 + bit for bit in BYTE_BITS[data[position]]]
+        return ids
+
+
+class Rebuilder(threading.Thread):
+    def __init__(self, database):
+        """
+        Background thread that periodically rebuilds the membership index from the database,
+        picking up assignments changed by other processes
+        :param database: Databaser instance
+        """
+        super().__init__(name="membership-rebuilder", daemon=True)
+        self.database = database
+        self.interval = None
+        self.woken = threading.Event()
+        self.stopped = threading.Event()
+        self.reconfigure(Configurator())
+        Configurator.subscribe(self.reconfigure)
+
+    def reconfigure(self, config):
+        """
+        Applies rebuild interval of the reloaded config, the current wait is restarted with it
+        :param config: Configurator
+        """
+        interval = config.membership_index()["rebuild_interval"]
+        if interval != self.interval:
+            self.interval = interval
+            self.woken.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            # a zero interval disables rebuilding, the thread waits for another interval or stop
+            woken = self.woken.wait(self.interval if self.interval > 0 else None)
+            self.woken.clear()
+            if woken:
+                continue
+            try:
+                self.database.build_index()
+            except Exception as e:
+                print(e)
+
+    def stop(self):
+        """
+        Stops rebuilding
+        """
+        self.stopped.set()
+        self.woken.set()
@@ -0,0 +1,157 @@
+import threading
+import time
+from bisect import bisect_left
+
+# upper bounds of latency buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# upper bounds of row count buckets
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        Thread-safe histogram of observations, split by label values
+        :param name: metric name
+        :param description: metric help text
+        :param labels: label names
+        :param buckets: sorted upper bounds of buckets, +Inf bucket is implicit
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.enabled = True
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """
+        Records an observation
+        :param value: observed value
+        :param label_values: values of labels in order of label names
+        """
+        if not self.enabled:
+            return
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                # bucket counts, then sum and count of observations
+                series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[bucket] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, *label_values):
+        """
+        Measures duration of a with block
+        :param label_values: values of labels in order of label names
+        :return: context manager
+        """
+        return Timer(self, label_values)
+
+    def exposition(self):
+        """
+        Renders histogram in Prometheus text format
+        :return: list of lines
+        """
+        with self.lock:
+            series = {label_values: list(counts) for label_values, counts in self.series.items()}
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} histogram".format(self.name)]
+        for label_values in sorted(series):
+            counts = series[label_values]
+            labels = ['{}="{}"'.format(name, escape(value)) for name, value in zip(self.labels, label_values)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines += ["{}_bucket{{{}}} {}".format(self.name, ",".join(labels + ['le="{}"'.format(bound)]),
+                                                      cumulative)]
+            suffix = "{" + ",".join(labels) + "}" if labels else ""
+            lines += ["{}_sum{} {}".format(self.name, suffix, counts[-2]),
+                      "{}_count{} {}".format(self.name, suffix, counts[-1])]
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+class Measurer:
+    def __init__(self):
+        """
+        Registry of process metrics
+        """
+        self.histograms = []
+        self.collectors = []
+        self.enabled = True
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        Creates and registers a histogram
+        :param name: metric name
+        :param description: metric help text
+        :param labels: label names
+        :param buckets: sorted upper bounds of buckets
+        :return: histogram
+        """
+        histogram = Histogram(name, description, labels, buckets)
+        histogram.enabled = self.enabled
+        self.histograms += [histogram]
+        return histogram
+
+    def collector(self, name, description, metric_type, collect):
+        """
+        Registers a metric read from its owner at exposition time
+        :param name: metric name
+        :param description: metric help text
+        :param metric_type: gauge or counter
+        :param collect: function returning dict of label values to metric values
+        """
+        self.collectors += [(name, description, metric_type, collect)]
+
+    def enable(self, enabled):
+        """
+        Turns recording of observations on or off
+        :param enabled: recording status
+        """
+        self.enabled = enabled
+        for histogram in self.histograms:
+            histogram.enabled = enabled
+
+    def exposition(self):
+        """
+        Renders every metric in Prometheus text format
+        :return: metrics text
+        """
+        lines = []
+        for histogram in self.histograms:
+            lines += histogram.exposition()
+        for name, description, metric_type, collect in self.collectors:
+            lines += ["# HELP {} {}".format(name, description), "# TYPE {} {}".format(name, metric_type)]
+            for label, value in sorted(collect().items()):
+                lines += ['{}{{name="{}"}} {}'.format(name, escape(label), value)]
+        return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    """
+    Escapes label value for Prometheus text format
+    :param value: label value
+    :return: escaped string
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# registry shared by every module of the process
+measurer = Measurer()
@@ -0,0 +1,145 @@
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class Pooler:
+    def __init__(self, dsn, min_connections=1, max_connections=10, checkout_timeout=10.0,
+                 health_check_interval=30.0):
+        """
+        Thread-safe pool of database connections
+        :param dsn: database connection string
+        :param min_connections: connections opened at startup and kept open
+        :param max_connections: upper bound of simultaneously checked out connections
+        :param checkout_timeout: seconds to wait for a free connection before giving up
+        :param health_check_interval: idle seconds after which a connection is pinged before checkout
+        """
+        self.pool = ThreadedConnectionPool(min_connections, max_connections, dsn)
+        self.max_connections = max_connections
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.retired = False
+        self.last_used = {}
+        self.metrics = {"checkouts": 0, "timeouts": 0, "discarded": 0, "in_use": 0,
+                        "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+
+    def getconn(self):
+        """
+        Checks out a healthy connection, waiting for a free one if the pool is exhausted
+        :return: psycopg2 connection
+        """
+        started = time.monotonic()
+        if not self.slots.acquire(timeout=self.checkout_timeout):
+            with self.lock:
+                self.metrics["timeouts"] += 1
+            raise PoolTimeout(f"no free database connection in {self.checkout_timeout}s")
+        waited = time.monotonic() - started
+        try:
+            connection = self.pool.getconn()
+            for _ in range(self.max_connections):
+                if self.healthy(connection):
+                    break
+                self.discard(connection)
+                connection = self.pool.getconn()
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.metrics["checkouts"] += 1
+            self.metrics["in_use"] += 1
+            self.metrics["wait_seconds_total"] += waited
+            self.metrics["wait_seconds_max"] = max(self.metrics["wait_seconds_max"], waited)
+        return connection
+
+    def putconn(self, connection):
+        """
+        Returns connection to the pool, dropping it if it is broken
+        :param connection: connection got from getconn
+        """
+        try:
+            if connection.closed or self.retired:
+                self.discard(connection)
+                return
+            status = connection.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                self.discard(connection)
+                return
+            if status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    self.discard(connection)
+                    return
+            with self.lock:
+                self.last_used[id(connection)] = time.monotonic()
+            self.pool.putconn(connection)
+        finally:
+            with self.lock:
+                self.metrics["in_use"] -= 1
+                drained = self.retired and self.metrics["in_use"] == 0
+            self.slots.release()
+            if drained:
+                self.close()
+
+    def healthy(self, connection):
+        """
+        Checks the connection, pinging the server if it has been idle for too long
+        :param connection: connection to check
+        :return: health status
+        """
+        if connection.closed:
+            return False
+        with self.lock:
+            last_used = self.last_used.get(id(connection))
+        if last_used is None or time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def discard(self, connection):
+        """
+        Closes connection and removes it from the pool
+        :param connection: broken connection
+        """
+        with self.lock:
+            self.last_used.pop(id(connection), None)
+            self.metrics["discarded"] += 1
+        self.pool.putconn(connection, close=True)
+
+    def stats(self):
+        """
+        Pool usage and checkout wait metrics
+        :return: dict of metrics
+        """
+        with self.lock:
+            return dict(self.metrics)
+
+    def retire(self):
+        """
+        Closes the pool once every checked out connection is returned, for replacement with a new pool
+        """
+        with self.lock:
+            self.retired = True
+            drained = self.metrics["in_use"] == 0
+        if drained:
+            self.close()
+
+    def close(self):
+        """
+        Closes every connection of the pool
+        """
+        self.pool.closeall()
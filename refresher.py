@@ -0,0 +1,39 @@
+import threading
+from config import Configurator
+
+
+class Refresher(threading.Thread):
+    def __init__(self, database):
+        """
+        Background thread that refreshes expiring hrefs in small batches
+        :param database: Databaser instance
+        """
+        super().__init__(name="hrefs-refresher", daemon=True)
+        self.database = database
+        self.interval = None
+        self.batch_size = None
+        self.reconfigure(Configurator())
+        Configurator.subscribe(self.reconfigure)
+        self.stopped = threading.Event()
+
+    def reconfigure(self, config):
+        """
+        Applies refresh settings of the reloaded config from the next batch on
+        :param config: Configurator
+        """
+        refresh = config.hrefs_refresh()
+        self.interval = refresh["interval"]
+        self.batch_size = refresh["batch_size"]
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.database.refresh_expiring_hrefs(self.batch_size)
+            except Exception as e:
+                print(e)
+
+    def stop(self):
+        """
+        Stops refreshing after the current batch
+        """
+        self.stopped.set()
@@ -1,12 +1,44 @@
 import json
+import time
 from typing import Union
 import datetime
+from metrics import measurer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """
+    Serializes object to json with orjson if it is installed, with standard json otherwise
+    :param obj: object to serialize
+    :return: json string
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+
+SERIALIZATION_SECONDS = measurer.histogram("gallery_serialization_seconds",
+                                           "Response serialization time by response kind", ["kind"])
+
+
+def format_timestamp(value: datetime.datetime):
+    """
+    Formats timestamp as "%d.%m.%y %H:%M" without the strftime overhead
+    :param value: timestamp
+    :return: formatted timestamp
+    """
+    return "%02d.%02d.%02d %02d:%02d" % (value.day, value.month, value.year % 100, value.hour, value.minute)
 
 
 class Responser:
     def __init__(self):
         self.errors = []
         self.request = None
+        self.next_cursor = None
 
     def json_response(self, keys: list, data: Union[list, tuple]):
         """
@@ -15,31 +47,140 @@ class Responser:
         :param data: data to assign with keys
         :return: json prepared response
         """
+        started = time.perf_counter()
         to_dump = {}
         if self.request is not None:
             to_dump["request"] = self.request
         if type(data) == list:
-            pre_json = []
-            for unit in data:
-                pre_json += [{}]
-                for key_i in range(len(keys)):
-                    if type(unit[key_i]) == datetime.datetime:
-                        pre_json[-1][keys[key_i]] = unit[key_i].strftime("%d.%m.%y %H:%M")
-                    else:
-                        pre_json[-1][keys[key_i]] = unit[key_i]
+            pre_json = self.units_to_dicts(keys, data, self.column_plan(keys, data))
+        else:
+            pre_json = self.units_to_dicts(keys, [data], self.column_plan(keys, [data]))[0]
+        to_dump["response"] = pre_json
+        if self.next_cursor is not None:
+            to_dump["next_cursor"] = self.next_cursor
+        to_dump["errors"] = self.errors
+        response = dumps(to_dump)
+        self.flush()
+        SERIALIZATION_SECONDS.observe(time.perf_counter() - started, "json")
+        return response
+
+    def map_response(self, keys: list, data: list, ids: list, grouped=False):
+        """
+        Generates json with request, errors info and response - data units mapped by their first column
+        :param keys: key names, the first one is the mapping key
+        :param data: list of data units
+        :param ids: requested ids, ids without data are mapped to null (or empty list if grouped)
+        :param grouped: if several units are mapped to one id; the mapping column is left out of units
+        :return: json prepared response
+        """
+        started = time.perf_counter()
+        to_dump = {}
+        if self.request is not None:
+            to_dump["request"] = self.request
+        if grouped:
+            stripped = [unit[1:] for unit in data]
+            units = self.units_to_dicts(keys[1:], stripped, self.column_plan(keys[1:], stripped))
+            pre_json = {str(unit_id): [] for unit_id in ids}
+            for unit, unit_dict in zip(data, units):
+                pre_json[str(unit[0])] += [unit_dict]
         else:
-            pre_json = {}
-            for key_i in range(len(keys)):
-                if type(data[key_i]) == datetime.datetime:
-                    pre_json[keys[key_i]] = data[key_i].strftime("%d.%m.%y %H:%M")
-                else:
-                    pre_json[keys[key_i]] = data[key_i]
+            units = self.units_to_dicts(keys, data, self.column_plan(keys, data))
+            pre_json = dict.fromkeys([str(unit_id) for unit_id in ids])
+            for unit, unit_dict in zip(data, units):
+                pre_json[str(unit[0])] = unit_dict
         to_dump["response"] = pre_json
         to_dump["errors"] = self.errors
-        response = json.dumps(to_dump)
+        response = dumps(to_dump)
         self.flush()
+        SERIALIZATION_SECONDS.observe(time.perf_counter() - started, "map")
         return response
 
+    def stream_head(self):
+        """
+        Opening part of a streamed response
+        :return: json prepared response part
+        """
+        head = "{"
+        if self.request is not None:
+            head += '"request": ' + dumps(self.request) + ", "
+        return head + '"response": ['
+
+    def stream_part(self, keys: list, chunk: list, first: bool):
+        """
+        Part of a streamed response with a chunk of data
+        :param keys: key names
+        :param chunk: non-empty list of data units
+        :param first: if it is the first chunk of the response
+        :return: json prepared response part
+        """
+        started = time.perf_counter()
+        # strip brackets of the dumped chunk list to join it into one array
+        part = dumps(self.units_to_dicts(keys, chunk, self.column_plan(keys, chunk)))[1:-1]
+        SERIALIZATION_SECONDS.observe(time.perf_counter() - started, "stream_chunk")
+        if first:
+            return part
+        return ", " + part
+
+    def stream_tail(self):
+        """
+        Closing part of a streamed response with next cursor and errors collected while streaming
+        :return: json prepared response part
+        """
+        tail = "]"
+        if self.next_cursor is not None:
+            tail += ', "next_cursor": ' + dumps(self.next_cursor)
+        tail += ', "errors": ' + dumps(self.errors) + "}"
+        self.flush()
+        return tail
+
+    @staticmethod
+    def is_successful(response):
+        """
+        Checks if json prepared response has no errors
+        :param response: json prepared response
+        :return: success status
+        """
+        return isinstance(response, str) and response.endswith(('"errors": []}', '"errors":[]}'))
+
+    @staticmethod
+    def column_plan(keys: list, data: list):
+        """
+        Finds columns that need timestamp formatting, judging by the first non-empty value of every column
+        :param keys: key names
+        :param data: list of data units
+        :return: indexes of timestamp columns
+        """
+        undecided = set(range(len(keys)))
+        timestamps = []
+        for unit in data:
+            for key_i in tuple(undecided):
+                if unit[key_i] is not None:
+                    undecided.discard(key_i)
+                    if type(unit[key_i]) == datetime.datetime:
+                        timestamps += [key_i]
+            if len(undecided) == 0:
+                break
+        return timestamps
+
+    @staticmethod
+    def units_to_dicts(keys: list, data: list, timestamps: list):
+        """
+        Assigns data units to keys, formatting timestamp columns only
+        :param keys: key names
+        :param data: list of data units
+        :param timestamps: column plan - indexes of timestamp columns
+        :return: list of dicts
+        """
+        if len(timestamps) == 0:
+            return [dict(zip(keys, unit)) for unit in data]
+        pre_json = []
+        for unit in data:
+            pre_json += [dict(zip(keys, unit))]
+            for key_i in timestamps:
+                if unit[key_i] is not None:
+                    pre_json[-1][keys[key_i]] = format_timestamp(unit[key_i])
+        return pre_json
+
     def simple_response(self, success=True):
         """
         Generates simple response with success status, request and errors info
@@ -50,7 +191,7 @@ class Responser:
         to_dump["request"] = self.request
         to_dump["response"] = {"success": success}
         to_dump["errors"] = self.errors
-        response = json.dumps(to_dump)
+        response = dumps(to_dump)
         self.flush()
         return response
 
@@ -138,7 +279,7 @@ class Responser:
         to_dump["request"] = self.request
         to_dump["response"] = {"success": False}
         to_dump["errors"] = self.errors
-        response = json.dumps(to_dump)
+        response = dumps(to_dump)
         self.flush()
         return response
 
@@ -148,3 +289,4 @@ class Responser:
         """
         self.errors = []
         self.request = None
+        self.next_cursor = None
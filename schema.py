@@ -0,0 +1,161 @@
+"""
+Versioned schema of the gallery database, see tables.txt for the description of tables.
+
+Migrations are applied in order, each in one transaction together with its record in schema_version,
+so a failed migration leaves the schema at the previous version. Statements are idempotent, databases
+created before versioning are upgraded in place.
+
+Run from the repository root: python schema.py [status|upgrade]
+"""
+import sys
+
+# searchable document of photos and categories, stored as a generated column so ranking does not parse texts;
+# names weigh more than descriptions, words are not stemmed as the gallery is not of one language
+SEARCH_DOCUMENT = """setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(description, '')), 'B')"""
+
+# columns returned by reads, search documents are kept out of responses
+COLUMNS = {
+    "photos": ("photo_id", "name", "description", "date_taken", "hidden", "incomplete"),
+    "categories": ("category_id", "name", "description", "hidden", "alias"),
+}
+
+MIGRATIONS = (
+    (1, "gallery tables", [
+        """CREATE TABLE IF NOT EXISTS photos (photo_id serial PRIMARY KEY, name text NOT NULL, description text,
+        date_taken timestamp, hidden boolean NOT NULL DEFAULT false, incomplete boolean NOT NULL DEFAULT true)""",
+        """CREATE TABLE IF NOT EXISTS categories (category_id serial PRIMARY KEY, name text NOT NULL, description text,
+        hidden boolean NOT NULL DEFAULT false, alias text NOT NULL UNIQUE)""",
+        """CREATE TABLE IF NOT EXISTS photos_categories (photo_id integer REFERENCES photos,
+        category_id integer REFERENCES categories, PRIMARY KEY (photo_id, category_id))""",
+        """CREATE TABLE IF NOT EXISTS hrefs (photo_id integer PRIMARY KEY REFERENCES photos, href_preview text NOT NULL,
+        href_medium text NOT NULL, href_large text NOT NULL)""",
+    ]),
+    (2, "age of hrefs", [
+        "ALTER TABLE hrefs ADD COLUMN IF NOT EXISTS fetched_at timestamp NOT NULL DEFAULT now()",
+    ]),
+    (3, "indexes of hot reads", [
+        # photos of category; covering, so category listings and relation tags are read from the index only
+        """CREATE INDEX IF NOT EXISTS photos_categories_category_id
+        ON photos_categories (category_id, photo_id)""",
+        # public photos index and filters, flags are inlined by Databaser.visible to match the predicate
+        """CREATE INDEX IF NOT EXISTS photos_public_photo_id
+        ON photos (photo_id) WHERE hidden = false AND incomplete = false""",
+        # public photos by date taken
+        """CREATE INDEX IF NOT EXISTS photos_public_date_taken
+        ON photos (date_taken, photo_id) WHERE hidden = false AND incomplete = false""",
+        # photos waiting for hrefs synchronization
+        """CREATE INDEX IF NOT EXISTS photos_incomplete_photo_id
+        ON photos (photo_id) WHERE incomplete = true""",
+        # public categories index
+        """CREATE INDEX IF NOT EXISTS categories_public_category_id
+        ON categories (category_id) WHERE hidden = false""",
+        # hrefs close to expiry, oldest first
+        "CREATE INDEX IF NOT EXISTS hrefs_fetched_at ON hrefs (fetched_at)",
+        "ANALYZE photos, categories, photos_categories, hrefs",
+    ]),
+    (4, "full-text search", [
+        """ALTER TABLE photos ADD COLUMN IF NOT EXISTS search_document tsvector
+        GENERATED ALWAYS AS ({}) STORED""".format(SEARCH_DOCUMENT),
+        """ALTER TABLE categories ADD COLUMN IF NOT EXISTS search_document tsvector
+        GENERATED ALWAYS AS ({}) STORED""".format(SEARCH_DOCUMENT),
+        "CREATE INDEX IF NOT EXISTS photos_search_document ON photos USING gin (search_document)",
+        "CREATE INDEX IF NOT EXISTS categories_search_document ON categories USING gin (search_document)",
+        "ANALYZE photos, categories",
+    ]),
+    (5, "refresh attempts of hrefs", [
+        # failed refreshes leave fetched_at as is, attempts back them off so they do not crowd out the other hrefs
+        "ALTER TABLE hrefs ADD COLUMN IF NOT EXISTS refresh_attempts integer NOT NULL DEFAULT 0",
+        "ALTER TABLE hrefs ADD COLUMN IF NOT EXISTS refresh_attempted_at timestamp",
+    ]),
+    (6, "data version", [
+        # one row of versions of conditional requests, bumped by writes of every process
+        """CREATE TABLE IF NOT EXISTS data_version (singleton boolean PRIMARY KEY DEFAULT true CHECK (singleton),
+        version bigint NOT NULL DEFAULT 1, modified timestamptz NOT NULL DEFAULT now(),
+        hrefs_version bigint NOT NULL DEFAULT 1, hrefs_modified timestamptz NOT NULL DEFAULT now())""",
+        "INSERT INTO data_version DEFAULT VALUES ON CONFLICT DO NOTHING",
+    ]),
+)
+
+# advisory lock serializing upgrades of processes starting at the same time
+LOCK_KEY = 7203401
+
+
+class Migrator:
+    def __init__(self, connection):
+        """
+        Schema upgrades on a connection
+        :param connection: psycopg2 connection, transactions are committed by the migrator
+        """
+        self.connection = connection
+
+    def version(self):
+        """
+        Current schema version
+        :return: version number, 0 for a database without versioning
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+            if not cursor.fetchone()[0]:
+                self.connection.commit()
+                return 0
+            cursor.execute("SELECT coalesce(max(version), 0) FROM schema_version")
+            version = cursor.fetchone()[0]
+        self.connection.commit()
+        return version
+
+    def pending(self):
+        """
+        Migrations that are not applied yet
+        :return: list of (version, description, statements)
+        """
+        version = self.version()
+        return [migration for migration in MIGRATIONS if migration[0] > version]
+
+    def upgrade(self, target=None):
+        """
+        Applies pending migrations up to target version
+        :param target: optional - version to stop at, the latest one by default
+        :return: list of applied versions
+        """
+        applied = []
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s)", [LOCK_KEY])
+            try:
+                cursor.execute("""CREATE TABLE IF NOT EXISTS schema_version (version integer PRIMARY KEY,
+                               description text NOT NULL, applied_at timestamp NOT NULL DEFAULT now())""")
+                self.connection.commit()
+                for version, description, statements in self.pending():
+                    if target is not None and version > target:
+                        break
+                    for statement in statements:
+                        cursor.execute(statement)
+                    cursor.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                                   [version, description])
+                    self.connection.commit()
+                    applied += [version]
+            finally:
+                # a failed migration is rolled back before the lock is released
+                self.connection.rollback()
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [LOCK_KEY])
+                self.connection.commit()
+        return applied
+
+
+def main():
+    import psycopg2
+    from config import Configurator
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+    connection = psycopg2.connect(Configurator().database())
+    migrator = Migrator(connection)
+    if command == "upgrade":
+        print("applied versions:", migrator.upgrade() or "none")
+    elif command != "status":
+        sys.exit("unknown command " + command)
+    print("schema version:", migrator.version(), "of", MIGRATIONS[-1][0])
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
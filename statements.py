@@ -0,0 +1,71 @@
+import re
+import threading
+import weakref
+
+from psycopg2 import errors
+
+
+class Preparer:
+    def __init__(self, enabled=True):
+        """
+        Registry of prepared statements of hot queries.
+        Statements are prepared on first use on every connection and executed by name afterwards,
+        so Postgres parses and plans them once per connection instead of once per request
+        :param enabled: if statements should be prepared, queries are executed as is otherwise
+        """
+        self.enabled = enabled
+        # connection to statements prepared on it, by name; reconnected connections start empty
+        self.prepared = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def execute(self, cursor, name, query, values):
+        """
+        Executes query as a prepared statement of the cursor connection
+        :param cursor: cursor to execute with
+        :param name: statement name
+        :param query: query with %s placeholders
+        :param values: query values, lists are passed as arrays
+        """
+        if not self.enabled:
+            cursor.execute(query, values)
+            return
+        connection = cursor.connection
+        with self.lock:
+            prepared = self.prepared.setdefault(connection, {}).get(name)
+        if prepared != query:
+            if prepared is not None:
+                # query text changed after a config reload
+                cursor.execute("DEALLOCATE " + name)
+            self.prepare(cursor, name, query)
+        execute = "EXECUTE {} ({})".format(name, ", ".join(["%s"] * len(values))) if values else "EXECUTE " + name
+        try:
+            cursor.execute(execute, values)
+        except (errors.InvalidSqlStatementName, errors.FeatureNotSupported):
+            # statement was dropped by the server or its result type changed after a schema upgrade
+            connection.rollback()
+            cursor.execute("DEALLOCATE ALL")
+            with self.lock:
+                self.prepared[connection] = {}
+            self.prepare(cursor, name, query)
+            cursor.execute(execute, values)
+
+    def prepare(self, cursor, name, query):
+        """
+        Prepares query on the cursor connection
+        :param cursor: cursor to prepare with
+        :param name: statement name
+        :param query: query with %s placeholders
+        """
+        cursor.execute("PREPARE {} AS {}".format(name, numbered(query)))
+        with self.lock:
+            self.prepared.setdefault(cursor.connection, {})[name] = query
+
+
+def numbered(query):
+    """
+    Replaces %s placeholders with numbered $n ones of server-side statements
+    :param query: query with %s placeholders
+    :return: query with $1, $2... placeholders
+    """
+    counter = iter(range(1, query.count("%s") + 1))
+    return re.sub("%s", lambda match: "$" + str(next(counter)), query)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules of the api are imported from the repository root, as the app runs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,58 @@
+import time
+
+from cache import Cacher
+
+
+def cached(cache, key, value, tags):
+    _, since = cache.get(key)
+    cache.put(key, value, tags, since)
+
+
+def test_lru_eviction():
+    cache = Cacher(max_entries=2)
+    cached(cache, "a", 1, [])
+    cached(cache, "b", 2, [])
+    assert cache.get("a") == (1, None)
+    cached(cache, "c", 3, [])
+    assert cache.get("b")[0] is None
+    assert cache.get("a") == (1, None)
+    assert cache.get("c") == (3, None)
+    assert cache.stats()["evictions"] == 1
+
+
+def test_ttl():
+    cache = Cacher(ttl=0.01)
+    cached(cache, "a", 1, [])
+    time.sleep(0.02)
+    assert cache.get("a")[0] is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_invalidate_by_tag():
+    cache = Cacher()
+    cached(cache, "photo", 1, ["photo:1", "photos_index"])
+    cached(cache, "index", 2, ["photos_index"])
+    cached(cache, "category", 3, ["category:1"])
+    cache.invalidate(["photos_index"])
+    assert cache.get("photo")[0] is None
+    assert cache.get("index")[0] is None
+    assert cache.get("category") == (3, None)
+    assert "photo:1" not in cache.tagged
+
+
+def test_response_computed_before_invalidation_is_not_cached():
+    cache = Cacher()
+    _, since = cache.get("photo")
+    cache.invalidate(["photo:1"])
+    cache.put("photo", "stale", ["photo:1"], since)
+    assert cache.get("photo")[0] is None
+    _, since = cache.get("other")
+    cache.clear()
+    cache.put("other", "stale", ["photo:2"], since)
+    assert cache.get("other")[0] is None
+
+
+def test_disabled():
+    cache = Cacher(max_entries=0)
+    cached(cache, "a", 1, [])
+    assert cache.get("a")[0] is None
@@ -0,0 +1,43 @@
+"""
+Query plans of client reads against the database of config.ini, skipped if no database is configured.
+Needs enough data for the planner to prefer indexes, e.g. python -m benchmarks.load seed --photos 100000
+"""
+import pytest
+
+from config import Configurator
+
+# smaller galleries are scanned sequentially by design of the planner
+MIN_PHOTOS = 10000
+
+
+@pytest.fixture(scope="module")
+def database():
+    if not Configurator().config.has_section("DATABASE"):
+        pytest.skip("no database configured in config.ini")
+    psycopg2 = pytest.importorskip("psycopg2")
+    from db import Databaser
+
+    connection = psycopg2.connect(Configurator().database())
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM photos")
+        if cursor.fetchone()[0] < MIN_PHOTOS:
+            connection.close()
+            pytest.skip("database has less than {} photos".format(MIN_PHOTOS))
+    connection.rollback()
+    yield Databaser(), connection
+    connection.close()
+
+
+@pytest.mark.parametrize("generic", [False, True], ids=["custom", "generic"])
+def test_no_sequential_scans(database, generic):
+    from benchmarks.explain import LARGE_TABLES, explain, queries
+
+    databaser, connection = database
+    with connection.cursor() as cursor:
+        checked = queries(databaser, cursor)
+    connection.rollback()
+    sequential = []
+    for name, query, values in checked:
+        sequential += [(name, relation) for node, relation, _ in explain(connection, name, query, values, generic)
+                       if node == "Seq Scan" and relation in LARGE_TABLES]
+    assert sequential == []
@@ -0,0 +1,158 @@
+import gzip
+import os
+
+import pytest
+
+import exporter
+from exporter import Exporter
+
+
+class Configurator:
+    directory = ""
+
+    def static_export(self):
+        return {"enabled": True, "directory": self.directory, "shard_size": 10, "delay": 0.0, "full_interval": 0.0,
+                "gzip_level": 1}
+
+    @staticmethod
+    def subscribe(callback):
+        pass
+
+
+class Database:
+    """
+    Gallery of public photos 1-3 and 12 in categories 1 and 2, the *_query builders return keys of export_rows
+    """
+    def __init__(self):
+        self.photos = {1: "one", 2: "two", 3: "three", 12: "twelve"}
+        self.members = {1: [1, 2], 2: [3, 12]}
+        self.queries = []
+        self.failing = False
+
+    def subscribe(self, callback):
+        pass
+
+    def unsubscribe(self, callback):
+        pass
+
+    @staticmethod
+    def last_photo_id_query():
+        return "last_photo_id", "last_photo_id", []
+
+    @staticmethod
+    def photos_range_query(first_id, last_id):
+        return "photos_range", "photos_range", [first_id, last_id]
+
+    @staticmethod
+    def gallery_index_query(categories=False):
+        return "categories_index", "categories_index", [], "category_id"
+
+    @staticmethod
+    def photos_by_category_query(category_id):
+        return "photos_by_category", "photos_by_category", [category_id]
+
+    def export_rows(self, name, query, values):
+        self.queries += [(name, *values)]
+        if self.failing:
+            raise ConnectionError("no database connection")
+        if name == "last_photo_id":
+            return ["max"], [(max(self.photos, default=0),)]
+        if name == "photos_range":
+            return ["photo_id", "name"], [(photo_id, self.photos[photo_id]) for photo_id in sorted(self.photos)
+                                          if values[0] <= photo_id < values[1]]
+        if name == "categories_index":
+            return ["category_id"], [(category_id,) for category_id in sorted(self.members)]
+        return ["photo_id", "name"], [(photo_id, self.photos[photo_id]) for photo_id in self.members[values[0]]]
+
+
+@pytest.fixture
+def snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(Configurator, "directory", str(tmp_path))
+    monkeypatch.setattr(exporter, "Configurator", Configurator)
+    database = Database()
+    snapshot = Exporter(database)
+    snapshot.export()
+    database.queries = []
+    return snapshot
+
+
+def files(directory):
+    return sorted(os.path.relpath(os.path.join(folder, name), directory)
+                  for folder, _, names in os.walk(directory) for name in names)
+
+
+def test_export_all(snapshot, tmp_path):
+    assert files(tmp_path) == sorted(name + suffix for suffix in ("", ".gz") for name in [
+        "categories/1.json", "categories/2.json", "index/categories.json", "index/photos.json",
+        "index/photos/0.json", "index/photos/1.json", "photos/0/1.json", "photos/0/2.json", "photos/0/3.json",
+        "photos/1/12.json"])
+    for name in files(tmp_path):
+        if not name.endswith(".gz"):
+            with open(tmp_path / name, "rb") as file, gzip.open(tmp_path / (name + ".gz")) as compressed:
+                assert file.read() == compressed.read()
+
+
+def test_unchanged_files_are_kept(snapshot, tmp_path):
+    modified = {name: os.stat(tmp_path / name).st_mtime_ns for name in files(tmp_path)}
+    snapshot.full = True
+    assert snapshot.export() == (0, 0)
+    assert {name: os.stat(tmp_path / name).st_mtime_ns for name in files(tmp_path)} == modified
+
+
+def test_replace_is_atomic(snapshot, tmp_path, monkeypatch):
+    path = str(tmp_path / "categories" / "1.json")
+    with open(path, "rb") as file:
+        content = file.read()
+
+    def failing(source, target):
+        raise OSError("disk full")
+    monkeypatch.setattr(exporter.os, "replace", failing)
+    with pytest.raises(OSError):
+        snapshot.write(path, "{}")
+    with open(path, "rb") as file:
+        assert file.read() == content
+    assert not any(name.endswith(".tmp") for name in files(tmp_path))
+
+
+def test_prune(snapshot, tmp_path):
+    for name in ("categories/3.json", "categories/3.json.gz", "index/photos/5.json", "photos/0/4.json.gz",
+                 "photos/5/50.json", "categories/.3.json.1.tmp"):
+        os.makedirs(os.path.dirname(tmp_path / name), exist_ok=True)
+        (tmp_path / name).write_text("{}")
+    snapshot.full = True
+    assert snapshot.export() == (0, 3)
+    assert not (tmp_path / "photos" / "5").exists()
+    assert (tmp_path / "categories" / ".3.json.1.tmp").exists()
+    assert "categories/3.json" not in files(tmp_path)
+
+
+def test_export_changed(snapshot, tmp_path):
+    snapshot.database.photos[13] = "thirteen"
+    snapshot.database.members[2] += [13]
+    snapshot.data_changed({"photo:13", "photos_of_category:2", "photos_of_category:landscape"})
+    assert snapshot.export() == (4, 0)
+    assert snapshot.database.queries == [("photos_range", 10, 20), ("photos_by_category", 2)]
+    assert "photos/1/13.json" in files(tmp_path)
+    del snapshot.database.members[1]
+    snapshot.data_changed({"category:1", "categories_index"})
+    assert snapshot.export() == (1, 1)
+    assert "categories/1.json" not in files(tmp_path)
+
+
+def test_failed_export_is_redone_in_full(snapshot):
+    snapshot.database.failing = True
+    snapshot.data_changed({"photo:2"})
+    with pytest.raises(ConnectionError):
+        snapshot.export()
+    snapshot.database.failing = False
+    snapshot.database.queries = []
+    snapshot.export()
+    assert snapshot.database.queries[0] == ("last_photo_id",)
+
+
+def test_tagged():
+    tags = {"photo:1", "photo:22", "category:3", "category:landscape", "photos_of_category:4",
+            "photos_of_category:landscape", "categories_of_photo:5", "photos_index"}
+    assert Exporter.tagged(tags, "photo") == {1, 22}
+    assert Exporter.tagged(tags, "category", "photos_of_category") == {3, 4}
+    assert Exporter.tagged(tags, "hrefs") == set()
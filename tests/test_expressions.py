@@ -0,0 +1,31 @@
+import pytest
+
+from expressions import MAX_TOKENS, labels, parse
+
+
+def test_precedence():
+    assert parse("a or b and not c") == ("or", ("label", "a"), ("and", ("label", "b"), ("not", ("label", "c"))))
+
+
+def test_parentheses_and_case():
+    assert parse("(a OR b) And NOT (c)") == ("and", ("or", ("label", "a"), ("label", "b")), ("not", ("label", "c")))
+
+
+def test_left_associative():
+    assert parse("a and b and c") == ("and", ("and", ("label", "a"), ("label", "b")), ("label", "c"))
+
+
+@pytest.mark.parametrize("expression", ["", None, "a and", "and a", "(a or b", "a or b)", "a b", "not", "()"])
+def test_malformed(expression):
+    with pytest.raises(ValueError):
+        parse(expression)
+
+
+def test_too_long():
+    parse(" or ".join(["a"] * (MAX_TOKENS // 2)))
+    with pytest.raises(ValueError):
+        parse(" or ".join(["a"] * (MAX_TOKENS // 2 + 1)))
+
+
+def test_labels_unique_in_order():
+    assert labels(parse("b and (a or b) and not c or a")) == ["b", "a", "c"]
@@ -0,0 +1,44 @@
+import datetime
+import io
+
+import pytest
+
+from importer import copy_line, photo, records
+
+
+def test_json_photo():
+    assert photo('{"name": "sea", "timestamp": "2023-06-01T12:00:00", "hidden": true, '
+                 '"categories": ["a", "b", "a"]}') == ("sea", None, datetime.datetime(2023, 6, 1, 12), True, ["a", "b"])
+
+
+def test_csv_photo():
+    record = {"name": "sea", "description": "", "timestamp": "", "hidden": "0", "categories": "a  b"}
+    assert photo(record) == ("sea", None, None, False, ["a", "b"])
+
+
+@pytest.mark.parametrize("record", [
+    "[1]",
+    '{"description": "no name"}',
+    '{"name": " "}',
+    '{"name": "sea", "color": "blue"}',
+    '{"name": "sea", "timestamp": "yesterday"}',
+    '{"name": "sea", "timestamp": 1}',
+    '{"name": "sea", "hidden": "maybe"}',
+    '{"name": "sea", "categories": "a"}',
+    '{"name": "se\\u0000a"}',
+    {"name": "sea", None: ["extra"]},
+])
+def test_rejected(record):
+    with pytest.raises(ValueError):
+        photo(record)
+
+
+def test_records_numbering():
+    body = io.BytesIO(b'{"name": "a"}\n\n{"name": "b"}\n')
+    assert list(records(body)) == [(1, '{"name": "a"}\n'), (2, '{"name": "b"}\n')]
+    body = io.BytesIO(b"name,hidden\na,1\nb,\n")
+    assert [(number, record["name"]) for number, record in records(body, csv_format=True)] == [(1, "a"), (2, "b")]
+
+
+def test_copy_line():
+    assert copy_line(["a\tb\\c\n", None, 1, True]) == "a\\tb\\\\c\\n\t\\N\t1\tTrue\n"
@@ -0,0 +1,143 @@
+import time
+
+import pytest
+
+from expressions import parse
+from membership import Indexer, Rebuilder
+
+PAIRS = [(1, 10), (2, 10), (3, 10), (2, 20), (3, 20), (4, 20), (5, 30)]
+IDS = {"a": 10, "b": 20, "c": 30, "missing": -1}
+
+
+@pytest.fixture
+def index():
+    index = Indexer()
+    index.begin()
+    index.build(sorted(PAIRS), [("alias-a", 10)])
+    return index
+
+
+def matching(index, expression, universe=range(8)):
+    bits, complement = index.evaluate(parse(expression), IDS)
+    ids = set(Indexer.ids(bits))
+    return sorted(set(universe) - ids) if complement else sorted(ids)
+
+
+@pytest.mark.parametrize("expression, expected", [
+    ("a", [1, 2, 3]),
+    ("a and b", [2, 3]),
+    ("a or c", [1, 2, 3, 5]),
+    ("a and not b", [1]),
+    ("not a and b", [4]),
+    ("not a", [0, 4, 5, 6, 7]),
+    ("not a and not b", [0, 5, 6, 7]),
+    ("not a or b", [0, 2, 3, 4, 5, 6, 7]),
+    ("not (a or b) or c", [0, 5, 6, 7]),
+    ("missing", []),
+    ("a and missing", []),
+    ("a or not missing", list(range(8))),
+])
+def test_evaluate(index, expression, expected):
+    assert matching(index, expression) == expected
+
+
+def test_update_and_replay():
+    index = Indexer()
+    index.begin()
+    # committed while the bulk query was loading, replayed over its snapshot
+    index.update(removed=[(1, 10)], added=[(6, 10)], renamed=[("alias-a", "renamed", 10)])
+    index.build(sorted(PAIRS), [("alias-a", 10)])
+    assert index.photo_ids(10) == [2, 3, 6]
+    assert index.count(10) == 3
+    assert index.category_id("renamed") == 10
+    assert index.category_id("alias-a") is None
+    assert index.category_id("42") == 42
+
+
+def test_bitset_round_trip():
+    ids = [0, 7, 8, 1000, 4097]
+    assert Indexer.ids(Indexer.bitset(ids)) == ids
+    assert Indexer.bitset([]) == 0
+    assert Indexer.ids(0) == []
+
+
+def test_sparse_and_dense_categories():
+    index = Indexer()
+    index.begin()
+    index.build(sorted([(photo_id, 1) for photo_id in (5, 600000, 1100000)] +
+                       [(photo_id, 2) for photo_id in range(0, 1000, 2)]))
+    assert not isinstance(index.photos_of_category[1], int)
+    assert isinstance(index.photos_of_category[2], int)
+    assert index.photo_ids(1) == [5, 600000, 1100000]
+    assert index.count(2) == 500
+    # a dense category that loses most of its photos turns into an array and back
+    index.update(removed=[(photo_id, 2) for photo_id in range(0, 998, 2)])
+    assert not isinstance(index.photos_of_category[2], int)
+    index.update(added=[(photo_id, 2) for photo_id in range(1, 1000, 2)])
+    assert isinstance(index.photos_of_category[2], int)
+    assert index.photo_ids(2) == list(range(1, 998, 2)) + [998, 999]
+    index.update(added=[(7, 1)], removed=[(600000, 1)])
+    assert index.photo_ids(1) == [5, 7, 1100000]
+    bits, complement = index.evaluate(("and", ("label", "a"), ("label", "b")), {"a": 1, "b": 2})
+    assert (Indexer.ids(bits), complement) == ([5, 7], False)
+
+
+def test_categories_of_photo(index):
+    assert index.category_ids(2) == [10, 20]
+    assert index.category_ids(6) == []
+    assert index.category_ids(100) == []
+    index.update(removed=[(2, 10)], added=[(2, 30), (100, 10)])
+    assert index.category_ids(2) == [20, 30]
+    assert index.category_ids(100) == [10]
+    assert index.category_ids(3) == [10, 20]
+
+
+
+class Configurator:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+
+    def membership_index(self):
+        return {"rebuild_interval": self.interval}
+
+    @staticmethod
+    def subscribe(callback):
+        pass
+
+
+class Database:
+    def __init__(self):
+        self.builds = 0
+
+    def build_index(self):
+        self.builds += 1
+
+
+def test_rebuilder_waits_while_disabled(monkeypatch):
+    monkeypatch.setattr("membership.Configurator", Configurator)
+    database = Database()
+    rebuilder = Rebuilder(database)
+    rebuilder.start()
+    time.sleep(0.1)
+    assert database.builds > 0
+    rebuilder.reconfigure(Configurator(0))
+    time.sleep(0.02)
+    builds = database.builds
+    time.sleep(0.1)
+    assert database.builds == builds
+    rebuilder.stop()
+    rebuilder.join(1)
+    assert not rebuilder.is_alive()
+
+
+def test_invalidate(index):
+    index.invalidate()
+    assert not index.ready
+    index.begin()
+    index.build(sorted(PAIRS))
+    assert index.ready
+    # writes of other processes seen while a build loads may be missing from its snapshot
+    index.begin()
+    index.invalidate()
+    index.build(sorted(PAIRS))
+    assert not index.ready
@@ -1,5 +1,56 @@
+import asyncio
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from config import Configurator
+from metrics import measurer
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+SUFFIXES = ("preview", "medium", "large")
+
+API_SECONDS = measurer.histogram("gallery_yadisk_seconds", "Yandex Disk api call latency including retries",
+                                 ["call", "status"])
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        """
+        Spreads calls evenly to keep their rate under the limit
+        :param rate: calls per second, 0 - unlimited
+        """
+        self.interval = 1 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        """
+        Blocks until the next call is allowed
+        """
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def reserve(self):
+        """
+        Takes the next call slot
+        :return: seconds to wait before the call
+        """
+        if self.interval == 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        return slot - now
 
 
 class API:
@@ -8,20 +59,212 @@ class API:
         self.token, self.remote_folder = c.yadisk_api()
         if self.token == "":
             raise Exception("No token specified in the config")
+        sync = c.yadisk_sync()
+        self.api_url = sync["api_url"].rstrip("/")
+        self.concurrency = sync["concurrency"]
+        self.timeout = sync["timeout"]
+        self.limiter = RateLimiter(sync["rate_limit"])
+
+        # keep-alive connections shared by all workers, failed and throttled calls are retried with backoff
+        retry = Retry(total=sync["retries"], backoff_factor=sync["backoff"],
+                      status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(["GET"]),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency, max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = "OAuth " + self.token
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def get_file_info(self, filepath):
-        info = requests.get("https://cloud-api.yandex.net/v1/disk/resources", params={"path": filepath},
-                            headers={"Authorization": "OAuth " + self.token})
+        self.limiter.wait()
+        info = self.get("resource", {"path": filepath})
         return info.json(), info.status_code
 
+    def get(self, call, params):
+        """
+        Requests resources api, measuring latency of the call
+        :param call: name of the call for metrics
+        :param params: query parameters
+        :return: requests response
+        """
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = self.session.get(self.api_url + "/v1/disk/resources", params=params, timeout=self.timeout)
+            status = str(response.status_code)
+            return response
+        finally:
+            API_SECONDS.observe(time.perf_counter() - started, call, status)
+
     def get_hrefs_by_id(self, photo_id):
         hrefs = {}
-        suffixes = ["preview", "medium", "large"]
-        for suffix in suffixes:
-            filepath = self.remote_folder + suffix + photo_id + f"_{suffix}.jpg"
+        for suffix in SUFFIXES:
+            filepath = self.remote_folder + suffix + "/" + str(photo_id) + f"_{suffix}.jpg"
             info, status_code = self.get_file_info(filepath)
             if status_code == 200:
                 hrefs[suffix] = info["file"]
             else:
                 hrefs[suffix] = ""
         return hrefs
+
+    def fetch_hrefs(self, photo_ids):
+        """
+        Fetches hrefs of photos concurrently with a bounded pool of workers
+        :param photo_ids: ids of photos
+        :return: generator of (photo_id, hrefs, error) in order of completion; hrefs is None if fetching failed
+        """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self.get_hrefs_by_id, photo_id): photo_id for photo_id in photo_ids}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except Exception as e:
+                    yield futures[future], None, e
+
+    def list_folder(self, folder, page_size):
+        """
+        Lists files of a folder page by page
+        :param folder: path of folder
+        :param page_size: files per request
+        :return: generator of file items
+        """
+        offset = 0
+        while True:
+            self.limiter.wait()
+            info = self.get("listing", {"path": folder, "limit": page_size, "offset": offset,
+                                        "fields": "_embedded.items.name,_embedded.items.file"})
+            if info.status_code != 200:
+                raise Exception(f"listing of {folder} failed with status {info.status_code}")
+            items = info.json()["_embedded"]["items"]
+            yield from items
+            if len(items) < page_size:
+                return
+            offset += len(items)
+
+    def discover_hrefs(self, page_size):
+        """
+        Builds map of hrefs from listings of size folders, listed concurrently
+        :param page_size: files per listing request
+        :return: dict of photo id to hrefs
+        """
+        def list_size(suffix):
+            pattern = re.compile(r"^(\d+)_{}\.jpg$".format(suffix))
+            found = {}
+            for item in self.list_folder(self.remote_folder + suffix, page_size):
+                match = pattern.match(item.get("name", ""))
+                if match is not None and item.get("file"):
+                    found[int(match.group(1))] = item["file"]
+            return suffix, found
+
+        hrefs = {}
+        with ThreadPoolExecutor(max_workers=len(SUFFIXES)) as executor:
+            for suffix, found in executor.map(list_size, SUFFIXES):
+                for photo_id in found:
+                    hrefs.setdefault(photo_id, dict.fromkeys(SUFFIXES, ""))[suffix] = found[photo_id]
+        return hrefs
+
+    def resolve_hrefs(self, photo_ids, page_size):
+        """
+        Resolves hrefs of photos from folder listings instead of looking up every file
+        :param photo_ids: ids of photos
+        :param page_size: files per listing request
+        :return: generator of (photo_id, hrefs, error); hrefs is None if listing failed
+        """
+        try:
+            hrefs = self.discover_hrefs(page_size)
+        except Exception as e:
+            for photo_id in photo_ids:
+                yield photo_id, None, e
+            return
+        for photo_id in photo_ids:
+            yield photo_id, hrefs.get(int(photo_id), dict.fromkeys(SUFFIXES, "")), None
+
+    def close(self):
+        """
+        Closes keep-alive connections
+        """
+        self.session.close()
+
+
+class AsyncAPI:
+    # statuses of throttled and failed calls that are retried with backoff
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self):
+        """
+        Yandex Disk client of the async serving mode, with the same settings as the sync one
+        """
+        if httpx is None:
+            raise Exception("httpx is required for the async mode")
+        c = Configurator()
+        self.token, self.remote_folder = c.yadisk_api()
+        if self.token == "":
+            raise Exception("No token specified in the config")
+        sync = c.yadisk_sync()
+        self.api_url = sync["api_url"].rstrip("/")
+        self.retries = sync["retries"]
+        self.backoff = sync["backoff"]
+        self.limiter = RateLimiter(sync["rate_limit"])
+        self.slots = asyncio.Semaphore(sync["concurrency"])
+        self.client = httpx.AsyncClient(headers={"Authorization": "OAuth " + self.token}, timeout=sync["timeout"],
+                                        limits=httpx.Limits(max_connections=sync["concurrency"]))
+
+    async def get(self, call, params):
+        """
+        Requests resources api, retrying failed and throttled calls and measuring latency of the call
+        :param call: name of the call for metrics
+        :param params: query parameters
+        :return: httpx response
+        """
+        started = time.perf_counter()
+        status = "error"
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+                await asyncio.sleep(self.limiter.reserve())
+                try:
+                    response = await self.client.get(self.api_url + "/v1/disk/resources", params=params)
+                except httpx.TransportError:
+                    if attempt == self.retries:
+                        raise
+                    continue
+                status = str(response.status_code)
+                if response.status_code not in self.retry_statuses:
+                    break
+            return response
+        finally:
+            API_SECONDS.observe(time.perf_counter() - started, call, status)
+
+    async def get_hrefs_by_id(self, photo_id):
+        hrefs = {}
+        for suffix in SUFFIXES:
+            filepath = self.remote_folder + suffix + "/" + str(photo_id) + f"_{suffix}.jpg"
+            async with self.slots:
+                info = await self.get("resource", {"path": filepath})
+            if info.status_code == 200:
+                hrefs[suffix] = info.json()["file"]
+            else:
+                hrefs[suffix] = ""
+        return hrefs
+
+    async def fetch_hrefs(self, photo_ids):
+        """
+        Fetches hrefs of photos concurrently, bounded by the configured concurrency
+        :param photo_ids: ids of photos
+        :return: async generator of (photo_id, hrefs, error) in order of completion; hrefs is None if fetching failed
+        """
+        async def fetch(photo_id):
+            try:
+                return photo_id, await self.get_hrefs_by_id(photo_id), None
+            except Exception as e:
+                return photo_id, None, e
+
+        for result in asyncio.as_completed([fetch(photo_id) for photo_id in photo_ids]):
+            yield await result
+
+    async def close(self):
+        """
+        Closes keep-alive connections
+        """
+        await self.client.aclose()